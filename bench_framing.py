@@ -0,0 +1,74 @@
+import optparse
+import time
+
+import server
+
+class NullCollection:
+  def find(self, *args, **kwargs):
+    return iter(())
+
+class NullHandle:
+  def write(self, data):
+    return True
+
+class LegacyClient(server.Client):
+  # The str based framing Client used before LineBuffer, for comparison.
+  def __init__(self, handle, addr):
+    server.Client.__init__(self, handle, addr)
+    self.read_buffer = ''
+
+  def add_data(self, data):
+    self.read_buffer += data.decode('ascii')
+
+  def has_msg(self):
+    return self.read_buffer.find('\n') != -1
+
+  def pop_msg(self):
+    msg, sep, rest = self.read_buffer.partition('\n')
+    if msg:
+      self.read_buffer = rest
+      return msg.strip()
+    return None
+
+def make_chunks(lines, recv_size):
+  stream = b'BRD KLH 1\n' * lines
+  return [stream[i:i + recv_size] for i in range(0, len(stream), recv_size)]
+
+def run(client_class, chunks, bursts):
+  client_manager = server.ClientManager(NullCollection(), NullCollection())
+  handle = NullHandle()
+  client_manager.clients[handle] = client_class(handle, '127.0.0.1')
+  start = time.perf_counter()
+  for i in range(bursts):
+    # A whole pipelined burst lands before the loop gets to the client.
+    client = client_manager.clients[handle]
+    for chunk in chunks[:-1]:
+      client.add_data(chunk)
+    client_manager.client_data(handle, chunks[-1])
+  elapsed = time.perf_counter() - start
+  client_manager.close()
+  return elapsed
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-l', '--lines', dest='lines',
+                    default='10,1000,10000,100000',
+                    help='Comma separated lines per burst')
+  parser.add_option('-s', '--recv-size', dest='recv_size', type='int',
+                    default=4096, help='Bytes per recv')
+  parser.add_option('-n', '--messages', dest='messages', type='int',
+                    default=200000, help='Approximate messages per run')
+  (options, args) = parser.parse_args()
+
+  print('%8s %10s %10s %10s %8s' % (
+      'LINES', 'LEGACY', 'BUFFER', 'MSGS/S', 'SPEEDUP'))
+  for lines in [int(i) for i in options.lines.split(',')]:
+    chunks = make_chunks(lines, options.recv_size)
+    bursts = max(options.messages // lines, 1)
+    legacy = run(LegacyClient, chunks, bursts)
+    buffered = run(server.Client, chunks, bursts)
+    print('%8d %9.3fs %9.3fs %10.0f %7.1fx' % (
+        lines, legacy, buffered, lines * bursts / buffered, legacy / buffered))
+
+if __name__ == '__main__':
+  main()
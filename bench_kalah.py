@@ -0,0 +1,98 @@
+import optparse
+import random
+import sys
+import time
+
+from kalah import KalahBoard, PITS, STORES
+from test_game import LegacyBoard, legal_moves, random_position
+
+def check(games, seed):
+  rng = random.Random(seed)
+  moves = 0
+  for game in range(games):
+    if game % 2:
+      pits = random_position(rng)
+    else:
+      pits = [rng.randint(1, KalahBoard.max_seeds)] * PITS
+      pits[STORES[0]] = pits[STORES[1]] = 0
+    legacy = LegacyBoard(pits)
+    board = KalahBoard.from_pits(pits)
+    player = 0
+    while not legacy.has_won():
+      pos = rng.choice(legal_moves(legacy.board, player))
+      expected = legacy.move_seeds(player, pos)
+      got = board.sow(player, pos)
+      moves += 1
+      if (expected != got or legacy.board != list(board.pits) or
+          legacy.get_points() != board.points() or
+          legacy.has_won() != board.finished()):
+        print('Mismatch after player %d sowed %d from %s' % (player, pos, pits))
+        print('  legacy %s %s' % (legacy.board, expected))
+        print('  board  %s %s' % (list(board.pits), got))
+        return False
+      if not expected:
+        player = 1 - player
+    if not board.finished():
+      print('Board did not finish with legacy from %s' % pits)
+      return False
+  print('Differential check passed: %d games, %d moves' % (games, moves))
+  return True
+
+def play(board_class, sequences):
+  start = time.perf_counter()
+  for seeds, seq in sequences:
+    if board_class is LegacyBoard:
+      board = LegacyBoard(KalahBoard(seeds).pits)
+      for player, pos in seq:
+        board.move_seeds(player, pos)
+        board.has_won()
+    else:
+      board = KalahBoard(seeds)
+      for player, pos in seq:
+        board.sow(player, pos)
+        board.finished()
+  return time.perf_counter() - start
+
+def record_games(games, seeds, seed):
+  rng = random.Random(seed)
+  sequences = []
+  for i in range(games):
+    board = KalahBoard(seeds)
+    player = 0
+    seq = []
+    while not board.finished():
+      pos = rng.choice(legal_moves(board.pits, player))
+      seq.append((player, pos))
+      if not board.sow(player, pos):
+        player = 1 - player
+    sequences.append((seeds, seq))
+  return sequences
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-c', '--check-games', dest='check_games', type='int',
+                    default=20000,
+                    help='Games to run in the differential check')
+  parser.add_option('-g', '--games', dest='games', type='int', default=20000,
+                    help='Games to time')
+  parser.add_option('-s', '--seeds', dest='seeds', default='3,6,12',
+                    help='Comma separated seeds per house to time')
+  parser.add_option('--seed', dest='seed', type='int', default=3001,
+                    help='Random seed')
+  (options, args) = parser.parse_args()
+
+  if not check(options.check_games, options.seed):
+    sys.exit(1)
+
+  print('%6s %10s %10s %12s %8s' % (
+      'SEEDS', 'LEGACY', 'BOARD', 'MOVES/S', 'SPEEDUP'))
+  for seeds in [int(i) for i in options.seeds.split(',')]:
+    sequences = record_games(options.games, seeds, options.seed)
+    moves = sum(len(seq) for _, seq in sequences)
+    legacy = play(LegacyBoard, sequences)
+    board = play(KalahBoard, sequences)
+    print('%6d %9.3fs %9.3fs %12.0f %7.1fx' % (
+        seeds, legacy, board, moves / board, legacy / board))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,101 @@
+import optparse
+import random
+import sys
+import time
+
+from kalah import PITS, STORES, KalahBoard
+import random_bot
+
+def random_position(rng, chain_bias):
+  # Arbitrary positions; with chain_bias, houses are often given exactly the
+  # seeds that reach the store so that long chains of extra moves come up.
+  f = bytearray(PITS)
+  for i in range(PITS):
+    if i in STORES:
+      f[i] = rng.randint(0, 20)
+    elif rng.random() < chain_bias:
+      f[i] = STORES[i > STORES[0]] - i
+    elif rng.random() < 0.8:
+      f[i] = rng.randint(0, 15)
+  for p in (0, 1):
+    if not any(f[i] for i in random_bot.HOUSES[p]):
+      f[random_bot.HOUSES[p][0]] = 1
+  return f
+
+def legacy_board(f):
+  return [list(f[:7]), list(f[7:])]
+
+def server_result(f, p, ms):
+  board = KalahBoard.from_pits(f)
+  for m in ms:
+    board.sow(p, m)
+  return board.pits
+
+def check(positions):
+  # The generator must find the same moves as the original code, leave the
+  # board as it found it, and play each move by the server's rules.
+  generator = random_bot.MoveGenerator()
+  sequences = 0
+  for f, p in positions:
+    before = bytes(f)
+    expected = sorted(tuple(m + 7 * p for m in ms)
+                      for ms in random_bot.moves(legacy_board(f), p))
+    got = sorted(generator.moves(f, p))
+    if got != expected or bytes(f) != before:
+      print('Moves differ for player %d at %s' % (p, list(before)))
+      print('  legacy    %s' % expected)
+      print('  generator %s' % got)
+      return False
+    for ms in got:
+      g = bytearray(f)
+      generator.move(g, p, ms)
+      if g != server_result(f, p, ms):
+        print('Move %s for player %d at %s differs from the server' % (
+            ms, p, list(before)))
+        return False
+      sequences += 1
+  print('Differential check passed: %d positions, %d moves' % (
+      len(positions), sequences))
+  return True
+
+def time_legacy(positions):
+  start = time.perf_counter()
+  for f, p in positions:
+    random_bot.moves(legacy_board(f), p)
+  return time.perf_counter() - start
+
+def time_generator(positions):
+  generator = random_bot.MoveGenerator()
+  start = time.perf_counter()
+  for f, p in positions:
+    generator.moves(f, p)
+  return time.perf_counter() - start, generator
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-n', '--positions', dest='positions', type='int',
+                    default=20000, help='Random positions per run')
+  parser.add_option('-c', '--chain-bias', dest='chain_bias',
+                    default='0,0.3,0.6',
+                    help='Comma separated chances of a house reaching the '
+                         'store')
+  parser.add_option('--seed', dest='seed', type='int', default=3001,
+                    help='Random seed')
+  (options, args) = parser.parse_args()
+
+  rng = random.Random(options.seed)
+  print('%6s %10s %10s %10s %8s %10s' % (
+      'BIAS', 'LEGACY', 'GENERATOR', 'POS/S', 'SPEEDUP', 'BRANCHING'))
+  for bias in [float(i) for i in options.chain_bias.split(',')]:
+    positions = [(random_position(rng, bias), rng.randint(0, 1))
+                 for i in range(options.positions)]
+    if not check(positions):
+      sys.exit(1)
+    legacy = time_legacy(positions)
+    generated, generator = time_generator(positions)
+    print('%6.2f %9.3fs %9.3fs %10.0f %7.1fx %10.2f' % (
+        bias, legacy, generated, len(positions) / generated,
+        legacy / generated, generator.branchingFactor()))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,113 @@
+import optparse
+import selectors
+import socket
+import threading
+import time
+
+from network import NetworkEngine, raise_fd_limit
+
+SELECTORS = {
+  'default': selectors.DefaultSelector,
+  'select': selectors.SelectSelector,
+  'poll': getattr(selectors, 'PollSelector', None),
+  'epoll': getattr(selectors, 'EpollSelector', None),
+}
+
+class EchoHandler:
+  def __init__(self):
+    self.clients = 0
+
+  def add_client(self, handle, addr):
+    self.clients += 1
+
+  def client_data(self, handle, data):
+    handle.write(data)
+    return True
+
+  def remove_client(self, handle):
+    self.clients -= 1
+
+  def update(self):
+    pass
+
+  def next_timeout(self):
+    return None
+
+def open_connections(address, count):
+  conns = []
+  for i in range(count):
+    conn = socket.create_connection(address)
+    conn.setblocking(False)
+    conns.append(conn)
+  return conns
+
+def ping_all(conns, rounds):
+  sel = selectors.DefaultSelector()
+  for conn in conns:
+    sel.register(conn, selectors.EVENT_READ)
+  start = time.monotonic()
+  for r in range(rounds):
+    for conn in conns:
+      conn.send(b'PNG\n')
+    pending = len(conns)
+    while pending:
+      for key, _ in sel.select(10):
+        if key.fileobj.recv(4096):
+          pending -= 1
+  sel.close()
+  return time.monotonic() - start
+
+def run(count, rounds, selector_class):
+  handler = EchoHandler()
+  engine = NetworkEngine(handler, ('127.0.0.1', 0),
+                         selector_class=selector_class, timeout=0.05,
+                         verbose=False)
+  address = engine.listen()
+  thread = threading.Thread(target=engine.run)
+  thread.daemon = True
+  thread.start()
+
+  start = time.monotonic()
+  conns = open_connections(address, count)
+  while handler.clients < count:
+    time.sleep(0.01)
+  connect_time = time.monotonic() - start
+  ping_time = ping_all(conns, rounds)
+
+  for conn in conns:
+    conn.close()
+  while handler.clients:
+    time.sleep(0.01)
+  engine.stop()
+  thread.join()
+  engine.close()
+  return connect_time, ping_time
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-n', '--connections', dest='connections',
+                    default='100,1000,5000,10000',
+                    help='Comma separated connection counts to benchmark')
+  parser.add_option('-r', '--rounds', dest='rounds', type='int', default=10,
+                    help='Ping rounds per connection')
+  parser.add_option('-e', '--selector', dest='selector', default='default',
+                    help='Selector backend: %s' % ', '.join(SELECTORS))
+  (options, args) = parser.parse_args()
+  selector_class = SELECTORS.get(options.selector)
+  if selector_class is None:
+    print('Selector %s not available' % options.selector)
+    return
+
+  limit = raise_fd_limit()
+  print('fd limit %s, selector %s' % (limit, selector_class.__name__))
+  print('%8s %10s %10s %12s' % ('CONNS', 'CONNECT', 'PING', 'MSGS/S'))
+  for count in [int(i) for i in options.connections.split(',')]:
+    if limit and count * 2 + 16 > limit:
+      print('%8d skipped: fd limit too low' % count)
+      continue
+    connect_time, ping_time = run(count, options.rounds, selector_class)
+    print('%8d %9.3fs %9.3fs %12.0f' % (
+        count, connect_time, ping_time, count * options.rounds / ping_time))
+
+if __name__ == '__main__':
+  main()
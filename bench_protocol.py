@@ -0,0 +1,149 @@
+import optparse
+import random
+import time
+
+from kalah import HOUSES, KalahBoard
+from kalah_game import KalahGame
+import protocol
+import server
+
+# What a move costs the server over the text protocol and over binary
+# frames, from the bytes arriving to the replies being queued. Both play the
+# same random games through ClientManager.client_data. The game alone, with
+# the moves handed to the game pool ready parsed and replies thrown away, is
+# timed too, so the protocol's share can be told apart from the sowing.
+# With --boards both players subscribe to the board after every move.
+
+class NullBulk:
+  def find(self, *args, **kwargs):
+    return self
+
+  def upsert(self):
+    return self
+
+  def update_one(self, *args, **kwargs):
+    pass
+
+  def execute(self):
+    pass
+
+class NullCollection:
+  # Enough of a Mongo collection for ClientManager and its results writer.
+  def find(self, *args, **kwargs):
+    return iter(())
+
+  def initialize_unordered_bulk_op(self):
+    return NullBulk()
+
+class NullHandle:
+  def __init__(self):
+    self.written = 0
+
+  def write(self, data):
+    self.written += len(data)
+    return True
+
+class SilentClient(server.Client):
+  def write_frame(self, op, game_name, payload=b''):
+    return True
+
+def random_games(count, seed):
+  # Each game as a list of (player, house) with house counted from the
+  # player's own side, as clients send them.
+  rng = random.Random(seed)
+  games = []
+  for i in range(count):
+    board = KalahBoard(KalahGame.seeds)
+    player = 0
+    moves = []
+    while not board.finished():
+      low = player * (HOUSES + 1)
+      pos = rng.choice([p for p in range(low, low + HOUSES) if board.pits[p]])
+      moves.append((player, pos - low))
+      if not board.sow(player, pos):
+        player = 1 - player
+    games.append(moves)
+  return games
+
+def encode_text(house):
+  return ('DAT KLH MOV %d\n' % house).encode('ascii')
+
+def encode_binary(house):
+  return protocol.frame(protocol.MOV, protocol.GAME_IDS['KLH'], bytes((house,)))
+
+def setup(client_class, binary, boards=False):
+  client_manager = server.ClientManager(NullCollection(), NullCollection())
+  clients = []
+  for name in ('a', 'b'):
+    handle = NullHandle()
+    client = client_manager.clients[handle] = client_class(handle, '127.0.0.1')
+    client.name = name
+    if boards:
+      client.caps.add('BRD')
+    if binary:
+      client.use_binary()
+    clients.append(client)
+  return client_manager, clients
+
+def run(games, binary, boards):
+  client_manager, clients = setup(server.Client, binary, boards)
+  pool = client_manager.get_pool('KLH')
+  encode = encode_binary if binary else encode_text
+  elapsed = 0
+  for moves in games:
+    pool.start_game(*clients)
+    data = [(clients[player].handle, encode(house))
+            for player, house in moves]
+    start = time.perf_counter()
+    for handle, d in data:
+      client_manager.client_data(handle, d)
+    elapsed += time.perf_counter() - start
+  client_manager.close()
+  return elapsed, sum(c.handle.written for c in clients)
+
+def run_game_only(games):
+  client_manager, clients = setup(SilentClient, True)
+  pool = client_manager.get_pool('KLH')
+  elapsed = 0
+  for moves in games:
+    pool.start_game(*clients)
+    data = [(clients[player], ['DAT', 'KLH', 'MOV', house])
+            for player, house in moves]
+    start = time.perf_counter()
+    for client, tok in data:
+      pool.handle_data(client, tok)
+    elapsed += time.perf_counter() - start
+  client_manager.close()
+  return elapsed
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-g', '--games', dest='games', type='int', default=2000,
+                    help='Games to play')
+  parser.add_option('-b', '--boards', dest='boards', action='store_true',
+                    help='Send the board after every move')
+  parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5,
+                    help='Runs of each, keeping the fastest')
+  parser.add_option('--seed', dest='seed', type='int', default=3001,
+                    help='Random seed')
+  (options, args) = parser.parse_args()
+
+  games = random_games(options.games, options.seed)
+  moves = sum(map(len, games))
+  text, text_bytes = min(run(games, False, options.boards)
+                         for i in range(options.repeat))
+  binary, binary_bytes = min(run(games, True, options.boards)
+                             for i in range(options.repeat))
+  game = min(run_game_only(games) for i in range(options.repeat))
+  print('%d moves' % moves)
+  for name, elapsed, written in (('text', text, text_bytes),
+                                 ('binary', binary, binary_bytes)):
+    print('%-8s %7.2fus %6.1f bytes per move' % (
+        name, elapsed / moves * 1e6, written / moves))
+  print('%-8s %7.2fus per move' % ('game', game / moves * 1e6))
+  print('protocol overhead: text %.2fus, binary %.2fus per move (%.1fx)' % (
+      (text - game) / moves * 1e6, (binary - game) / moves * 1e6,
+      (text - game) / max(binary - game, 1e-9)))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,67 @@
+import optparse
+import random
+import sys
+import time
+
+from kalah import KalahBoard
+import bench_kalah
+import rollout
+
+def check(positions, seed):
+  # rollout.sow on a batch of random positions must match KalahBoard.sow
+  # row by row.
+  rng = random.Random(seed)
+  starts = []
+  for i in range(positions):
+    pits = bench_kalah.random_position(rng)
+    player = rng.randint(0, 1)
+    starts.append((pits, player,
+                   rng.choice(bench_kalah.legal_moves(pits, player))))
+  boards = rollout.numpy.array([s[0] for s in starts], rollout.numpy.int16)
+  again = rollout.sow(boards,
+                      rollout.numpy.array([s[1] for s in starts]),
+                      rollout.numpy.array([s[2] for s in starts]))
+  for i, (pits, player, pos) in enumerate(starts):
+    board = KalahBoard.from_pits(pits)
+    expected = board.sow(player, pos)
+    if list(board.pits) != boards[i].tolist() or expected != again[i]:
+      print('Mismatch after player %d sowed %d from %s' % (player, pos, pits))
+      print('  board   %s %s' % (list(board.pits), expected))
+      print('  rollout %s %s' % (boards[i].tolist(), again[i]))
+      return False
+  print('Differential check passed: %d positions' % positions)
+  return True
+
+def run(use_numpy, candidates, seconds, seed):
+  rollouts = rollout.Rollouts(seed, use_numpy)
+  board = KalahBoard(3)
+  start = time.perf_counter()
+  rollouts.evaluate(board.pits, 0, candidates, time.monotonic() + seconds)
+  return rollouts.playouts / (time.perf_counter() - start)
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-c', '--check-positions', dest='check_positions',
+                    type='int', default=100000,
+                    help='Positions in the differential check')
+  parser.add_option('-t', '--time', dest='time', type='float', default=2.0,
+                    help='Seconds to run each engine for')
+  parser.add_option('--seed', dest='seed', type='int', default=3001,
+                    help='Random seed')
+  (options, args) = parser.parse_args()
+
+  if rollout.numpy is None:
+    print('numpy is not installed')
+    sys.exit(1)
+  if not check(options.check_positions, options.seed):
+    sys.exit(1)
+
+  rollout.get_tables()
+  candidates = [(m,) for m in range(6)]
+  python = run(False, candidates, options.time, options.seed)
+  vectorised = run(True, candidates, options.time, options.seed)
+  print('%12s %12s %8s' % ('PYTHON/S', 'NUMPY/S', 'SPEEDUP'))
+  print('%12.0f %12.0f %7.1fx' % (python, vectorised, vectorised / python))
+
+if __name__ == '__main__':
+  main()
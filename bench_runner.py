@@ -0,0 +1,114 @@
+import asyncio
+import optparse
+import shlex
+import sys
+import time
+
+import runner
+
+# Time from the server sending BMP to the runner sending the bot's MOV back.
+# A stand-in server on localhost plays games of nothing but BMPs against
+# runner.run_program, with a bot that answers every BMP straight away, so
+# what's measured is the runner and the pipes. The same bot is also timed
+# on its own, writing BMP to its stdin and reading MOV back, to show how
+# much of that is the pipes.
+
+ECHO_BOT = '''
+import sys
+for l in sys.stdin:
+  if l.startswith('BMP'):
+    sys.stdout.write('MOV 0\\n')
+    sys.stdout.flush()
+  elif l.startswith('NEW'):
+    sys.stdout.write('RDY\\n')
+    sys.stdout.flush()
+'''
+
+class BenchServer:
+  def __init__(self, games, moves):
+    self.games = games
+    self.moves = moves
+    self.latencies = []
+
+  async def handle(self, reader, writer):
+    async def readline():
+      return (await reader.readline()).decode('ascii').strip()
+
+    if (await readline()).count(' ') > 2:
+      writer.write(b'CAP\n')
+    for i in range(self.games):
+      while not (await readline()).startswith('LFG'):
+        pass
+      writer.write(b'SRT KLH bench\n')
+      for j in range(self.moves):
+        start = time.perf_counter()
+        writer.write(b'DAT KLH BMP\n')
+        await writer.drain()
+        while not (await readline()).startswith('DAT KLH MOV'):
+          pass
+        self.latencies.append(time.perf_counter() - start)
+      writer.write(b'FIN KLH DRW\n')
+      await writer.drain()
+    await reader.read()
+    writer.close()
+
+async def bench_runner(program, games, moves, keep):
+  bench = BenchServer(games, moves)
+  server = await asyncio.start_server(bench.handle, 'localhost', 0)
+  address = server.sockets[0].getsockname()[:2]
+  pool = runner.BotPool(program, keep)
+  try:
+    await runner.run_program(address, pool, ('bench', 'bench'), 'KLH', games)
+  finally:
+    await pool.close()
+    server.close()
+    await server.wait_closed()
+  return bench.latencies
+
+async def bench_pipe(program, moves):
+  bot = await runner.Bot.start(program)
+  latencies = []
+  try:
+    for i in range(moves):
+      start = time.perf_counter()
+      bot.send('BMP')
+      await bot.readlines()
+      latencies.append(time.perf_counter() - start)
+  finally:
+    await bot.close()
+  return latencies
+
+def report(name, latencies):
+  latencies = sorted(latencies)
+  n = len(latencies)
+
+  def us(x):
+    return x * 1e6
+
+  print('%-8s %7d moves  mean %7.1fus  p50 %7.1fus  p90 %7.1fus  '
+        'p99 %7.1fus  max %8.1fus' % (
+            name, n, us(sum(latencies) / n), us(latencies[n // 2]),
+            us(latencies[n * 9 // 10]), us(latencies[n * 99 // 100]),
+            us(latencies[-1])))
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-g', '--games', dest='games', type='int', default=5,
+                    help='Games to play')
+  parser.add_option('-m', '--moves', dest='moves', type='int', default=2000,
+                    help='BMPs per game')
+  parser.add_option('-k', '--keep', dest='keep', action='store_true',
+                    help='Keep the bot running between games')
+  parser.add_option('-p', '--program', dest='program',
+                    help='Bot to use instead of the built in one, which '
+                         'must answer any BMP with a MOV')
+  (options, args) = parser.parse_args()
+  program = options.program or '%s -c %s' % (
+      shlex.quote(sys.executable), shlex.quote(ECHO_BOT))
+
+  report('pipe', asyncio.run(bench_pipe(program, options.moves)))
+  report('runner', asyncio.run(bench_runner(program, options.games,
+                                            options.moves, options.keep)))
+
+if __name__ == '__main__':
+  main()
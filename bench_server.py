@@ -0,0 +1,268 @@
+import asyncio
+import collections
+import optparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from network import raise_fd_limit
+import registry
+import runner
+
+# Capacity of a whole server. Thousands of simulated players on one loop
+# register, log in and play game after game against each other over the
+# real protocol, each with a random player that keeps its own board, so
+# every game is played out to the end with legal moves, until the number of
+# games asked for have been played. Players still in a game or waiting for
+# one then go. Run it against a server on this host, where registrations
+# aren't limited to one per address and STA answers, started with -d
+# pointing at a scratch mongod and -j '' if the real ones shouldn't fill up
+# with players and games. What's reported is games a second, move latency,
+# from a player sending its move to its opponent hearing of it, and the CPU
+# time the server, shards included, spent on each game, from the cpu
+# figures STA gives before and after. With --workers it starts shard.py
+# here itself, once for each number of workers given, to show how it scales
+# with cores; the players all run in this one process, so give it a host
+# with a core or two more than the most workers.
+
+class Stats:
+  def __init__(self, games):
+    # Both players of a game count it, so the target is twice the games.
+    self.target = games * 2
+    self.finished = asyncio.Event()
+    self.games = 0
+    self.moves = 0
+    self.errors = collections.Counter()
+    self.latencies = []
+    # When each player last sent a move, by name, for its opponent to take
+    # the time from when it hears of it.
+    self.sent = {}
+
+def legal_moves(board, player):
+  # Houses in the server's layout, where player's side starts at player * 7.
+  if hasattr(board, 'legal_moves'):
+    return board.legal_moves(player)
+  low = player * 7
+  return [pos for pos in range(low, low + 6) if board.pits[pos]]
+
+async def play_game(server, name, game, board, rng, stats):
+  # Plays one game on a connection that has sent LFG. Returns False if the
+  # server has gone.
+  player = None
+  opponent = None
+  while True:
+    msg = await server.readline()
+    if msg is None:
+      return False
+    tok = msg.split(' ')
+    if tok[0] == 'SRT':
+      opponent = tok[2]
+    elif tok[0] == 'DAT' and tok[2] == 'BMP':
+      # Whoever is asked to move before hearing of a move goes first.
+      if player is None:
+        player = 0
+      pos = rng.choice(legal_moves(board, player))
+      board.sow(player, pos)
+      stats.sent[name] = time.perf_counter()
+      server.send('DAT %s MOV %d' % (game, pos - player * 7))
+      if not await server.flush():
+        return False
+      stats.moves += 1
+    elif tok[0] == 'DAT' and tok[2] == 'MOV':
+      start = stats.sent.pop(opponent, None)
+      if start is not None:
+        stats.latencies.append(time.perf_counter() - start)
+      if player is None:
+        player = 1
+      # Moves come as the opponent's house counted from 7.
+      board.sow(1 - player, (1 - player) * 7 + int(tok[3]) - 7)
+    elif tok[0] == 'FIN':
+      stats.games += 1
+      if stats.games >= stats.target:
+        stats.finished.set()
+      return True
+    elif tok[0] == 'ERR':
+      stats.errors[' '.join(tok[1:])] += 1
+
+async def login(address, name, caps):
+  # A connection for a newly registered player, or None. ATH is only
+  # answered once REG is done, and not at all if it fails.
+  server = await runner.Connection.open(address)
+  server.send('REG %s pw' % name, 'ATH %s pw %s' % (name, ' '.join(caps)))
+  reply = await server.readline()
+  if reply is None or not reply.startswith('CAP'):
+    await server.close()
+    return None
+  server.caps = set(reply.split(' ')[1:])
+  server.binary = 'BIN' in server.caps
+  return server
+
+async def play(server, name, game, seed, stats, started):
+  game_class = registry.load(game)
+  rng = random.Random(seed)
+  await started.wait()
+  try:
+    while not stats.finished.is_set():
+      server.send('LFG %s' % game)
+      if not await server.flush():
+        return
+      board = game_class.board_class(game_class.seeds)
+      if not await play_game(server, name, game, board, rng, stats):
+        return
+  finally:
+    await server.close()
+
+async def get_cpu(address):
+  # The CPU seconds STA reports, the server's own and its shards', or None
+  # if it won't say.
+  server = await runner.Connection.open(address)
+  cpu = None
+  try:
+    server.send('STA')
+    while True:
+      line = await server.readline()
+      if line is None or not line.startswith('STA ') or line == 'STA FIN':
+        return cpu
+      tok = line.split(' ')
+      if tok[1] == 'cpu' or tok[1].endswith('.cpu'):
+        cpu = (cpu or 0) + float(tok[2])
+  finally:
+    await server.close()
+
+async def bench_server(address, clients, game, games, prefix, caps, seed):
+  stats = Stats(games)
+  started = asyncio.Event()
+  start = time.monotonic()
+  names = ['%s%d' % (prefix, i) for i in range(clients)]
+  connections = await asyncio.gather(
+      *[login(address, name, caps) for name in names])
+  players = [(s, n) for s, n in zip(connections, names) if s]
+  print('Logged in %d of %d players in %.1fs' % (
+      len(players), clients, time.monotonic() - start))
+  tasks = [asyncio.ensure_future(play(s, n, game, seed + i, stats, started))
+           for i, (s, n) in enumerate(players)]
+  cpu_before = await get_cpu(address)
+  start = time.monotonic()
+  started.set()
+  # All the players stop early if the server goes.
+  playing = asyncio.gather(*tasks, return_exceptions=True)
+  finished = asyncio.ensure_future(stats.finished.wait())
+  await asyncio.wait([finished, playing],
+                     return_when=asyncio.FIRST_COMPLETED)
+  elapsed = time.monotonic() - start
+  cpu_after = await get_cpu(address)
+  finished.cancel()
+  for task in tasks:
+    task.cancel()
+  await playing
+  return stats, elapsed, cpu_before, cpu_after
+
+def report(stats, elapsed, cpu_before, cpu_after):
+  # Prints what was measured and gives the games a second.
+  games = stats.games // 2
+  print('%d games, %d moves in %.1fs: %.1f games/s, %.0f moves/s' % (
+      games, stats.moves, elapsed, games / elapsed, stats.moves / elapsed))
+  latencies = sorted(stats.latencies)
+  n = len(latencies)
+  if n:
+    print('move latency  mean %.2fms  p50 %.2fms  p90 %.2fms  p99 %.2fms  '
+          'max %.2fms' % (
+              sum(latencies) / n * 1e3, latencies[n // 2] * 1e3,
+              latencies[n * 9 // 10] * 1e3, latencies[n * 99 // 100] * 1e3,
+              latencies[-1] * 1e3))
+  if cpu_before is not None and cpu_after is not None and games:
+    cpu = cpu_after - cpu_before
+    print('server CPU %.1fs, %.2fms per game, %.1fus per move' % (
+        cpu, cpu / games * 1e3, cpu / stats.moves * 1e6))
+  for error, count in stats.errors.most_common():
+    print('%6d ERR %s' % (count, error))
+  return games / elapsed
+
+def start_server(workers, port, database):
+  # A shard.py with workers workers on port, once it takes connections.
+  shard = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shard.py')
+  process = subprocess.Popen([sys.executable, shard, '-w', str(workers),
+                              '-p', str(port), '-d', database, '-j', ''])
+  deadline = time.monotonic() + 10
+  while True:
+    try:
+      socket.create_connection(('localhost', port)).close()
+      return process
+    except OSError:
+      if process.poll() is not None or time.monotonic() > deadline:
+        process.kill()
+        raise SystemExit('shard.py did not start')
+      time.sleep(0.1)
+
+def bench_scaling(options, prefix, caps, counts):
+  rates = []
+  for workers in counts:
+    print('--- %d workers' % workers)
+    process = start_server(workers, options.port, options.database)
+    try:
+      rates.append(report(*asyncio.run(bench_server(
+          ('localhost', options.port), options.clients, options.game,
+          options.games, '%s%dw' % (prefix, workers), caps, options.seed))))
+    finally:
+      process.terminate()
+      process.wait()
+  print('workers  games/s  speedup')
+  for workers, rate in zip(counts, rates):
+    print('%7d  %7.1f  %6.2fx' % (workers, rate, rate / rates[0]))
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-s', '--server', dest='server', default='localhost',
+                    help='Server location')
+  parser.add_option('-p', '--port', dest='port', type='int', default=31337,
+                    help='Server port')
+  parser.add_option('-c', '--clients', dest='clients', type='int',
+                    default=1000, help='Players to play at once')
+  parser.add_option('-n', '--games', dest='games', type='int',
+                    default=10000, help='Games to play in all')
+  parser.add_option('-g', '--game', dest='game', default='KLH',
+                    help='Game to play')
+  parser.add_option('--text', dest='text', action='store_true',
+                    help='Play over the text protocol rather than binary '
+                         'frames')
+  parser.add_option('--prefix', dest='prefix',
+                    help='Start of the players\' names, by default one '
+                         'not used before')
+  parser.add_option('--seed', dest='seed', type='int', default=1,
+                    help='Seed for the players\' moves')
+  parser.add_option('--workers', dest='workers',
+                    help='Start shard.py on this host with each of these '
+                         'numbers of workers in turn, as 1,2,4, and '
+                         'compare them')
+  parser.add_option('-d', '--database', dest='database',
+                    default='localhost:27017',
+                    help='Mongo for the servers --workers starts')
+  (options, args) = parser.parse_args()
+  if options.game not in registry.GAMES:
+    parser.error('Unknown game %s' % options.game)
+  counts = []
+  if options.workers:
+    try:
+      counts = [int(n) for n in options.workers.split(',')]
+    except ValueError:
+      parser.error('--workers takes numbers separated by commas')
+  prefix = options.prefix or 'lg%x_' % (int(time.time()) & 0xfffff)
+  longest = len(prefix) + len(str(options.clients))
+  if counts:
+    longest += len('%dw' % max(counts))
+  if longest > 20:
+    parser.error('Names would be over 20 characters')
+  raise_fd_limit()
+  caps = ['BAT'] if options.text else ['BAT', 'BIN']
+  if counts:
+    bench_scaling(options, prefix, caps, counts)
+    return
+  report(*asyncio.run(bench_server(
+      (options.server, options.port), options.clients, options.game,
+      options.games, prefix, caps, options.seed)))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,205 @@
+import math
+import mmap
+import optparse
+import struct
+import sys
+import time
+
+from kalah import HOUSES, STORES, KalahBoard
+
+# Perfect play tables for positions with few seeds left in the houses.
+# Nothing ever moves seeds out of a store, and the rules never look at the
+# stores, so how a position plays out only depends on the 12 houses, seen
+# from the side of the player to move. The table holds, for every way of
+# putting up to max_seeds seeds in the houses, how many seeds the player to
+# move ends up ahead by from here with best play on both sides; add the
+# difference between the stores to get the final margin.
+#
+# Positions are indexed by a combinatorial rank: all positions with fewer
+# seeds come first, then the ones with n seeds in stars and bars order.
+# Values are signed bytes after a short header, so a built table can be
+# mapped into memory and looked up directly.
+
+MAGIC = b'KLHENDG1'
+HEADER = struct.Struct('<8sBQ')
+PARTS = 2 * HOUSES
+UNKNOWN = 0x80
+HOUSE_PITS = tuple(tuple(range(p * (HOUSES + 1), p * (HOUSES + 1) + HOUSES))
+                   for p in (0, 1))
+
+def table_size(max_seeds):
+  return math.comb(max_seeds + PARTS, PARTS)
+
+def build_binomials(max_seeds):
+  return [[math.comb(n, k) for k in range(PARTS)]
+          for n in range(max_seeds + PARTS)]
+
+class Ranker:
+  def __init__(self, max_seeds):
+    self.binom = build_binomials(max_seeds)
+    self.offsets = [math.comb(n + PARTS - 1, PARTS)
+                    for n in range(max_seeds + 1)]
+
+  def rank(self, houses, n):
+    # The bars between the 12 houses sit at positions s + j, where s is the
+    # number of seeds before bar j; the set of bar positions is ranked as a
+    # combination.
+    binom = self.binom
+    r = self.offsets[n]
+    s = 0
+    for j in range(PARTS - 1):
+      s += houses[j]
+      r += binom[s + j][j + 1]
+    return r
+
+def oriented(f, p):
+  # The houses of flat board f with player p's side first.
+  return ([f[i] for i in HOUSE_PITS[p]] +
+          [f[i] for i in HOUSE_PITS[1 - p]])
+
+class EndgameTable:
+  def __init__(self, data, max_seeds, file=None):
+    self.data = data
+    self.max_seeds = max_seeds
+    self.ranker = Ranker(max_seeds)
+    self.file = file
+
+  @classmethod
+  def open(cls, path):
+    f = open(path, 'rb')
+    try:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception:
+      f.close()
+      raise
+    magic, max_seeds, count = HEADER.unpack_from(data)
+    if magic != MAGIC or count != table_size(max_seeds) or (
+        len(data) != HEADER.size + count):
+      data.close()
+      f.close()
+      raise ValueError('%s is not an endgame table' % path)
+    return cls(memoryview(data)[HEADER.size:], max_seeds, (f, data))
+
+  def close(self):
+    if self.file:
+      self.data.release()
+      self.file[1].close()
+      self.file[0].close()
+      self.file = None
+
+  def lookup(self, houses):
+    # Seeds the player to move gets ahead by from here, or None if there
+    # are too many seeds left.
+    n = sum(houses)
+    if n > self.max_seeds:
+      return None
+    v = self.data[self.ranker.rank(houses, n)]
+    return v - 256 if v > 127 else v
+
+  def value(self, f, p):
+    # The final margin for player p, to move on flat board f.
+    v = self.lookup(oriented(f, p))
+    if v is None:
+      return None
+    return v + f[STORES[p]] - f[STORES[1 - p]]
+
+  def value_after(self, f, p, ms):
+    # The final margin for player p after it plays the houses ms.
+    board = KalahBoard.from_pits(f)
+    again = False
+    for m in ms:
+      again = board.sow(p, m)
+    if again:
+      return self.value(board.pits, p)
+    v = self.value(board.pits, 1 - p)
+    return None if v is None else -v
+
+  def best(self, f, p, candidates):
+    # The candidate move with the best outcome, or None when the position
+    # has too many seeds.
+    if sum(f[i] for i in HOUSE_PITS[0] + HOUSE_PITS[1]) > self.max_seeds:
+      return None
+    return max(candidates, key=lambda ms: self.value_after(f, p, ms))
+
+class Builder:
+  # Fills the table in order of seeds left. A move either puts seeds in a
+  # store, leading to a smaller count that is already done, or keeps all
+  # its seeds on the mover's side, strictly moving them closer to its store;
+  # so within a count the positions solve recursively without cycles.
+  def __init__(self, max_seeds):
+    self.max_seeds = max_seeds
+    self.ranker = Ranker(max_seeds)
+    self.data = bytearray([UNKNOWN]) * table_size(max_seeds)
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 64 * max_seeds + 1000))
+
+  def solve(self, houses, n):
+    i = self.ranker.rank(houses, n)
+    v = self.data[i]
+    if v != UNKNOWN:
+      return v - 256 if v > 127 else v
+    own = sum(houses[:HOUSES])
+    if own == 0 or own == n:
+      # Game over: what's left in the houses goes to their owners.
+      best = 2 * own - n
+    else:
+      best = None
+      f = houses[:HOUSES] + [0] + houses[HOUSES:] + [0]
+      for m in range(HOUSES):
+        if not f[m]:
+          continue
+        board = KalahBoard.from_pits(f)
+        again = board.sow(0, m)
+        gain = board.pits[STORES[0]]
+        if again:
+          rest = self.solve(oriented(board.pits, 0), n - gain)
+        else:
+          rest = -self.solve(oriented(board.pits, 1), n - gain)
+        if best is None or gain + rest > best:
+          best = gain + rest
+    self.data[i] = best & 0xff
+    return best
+
+  def build(self, progress=None):
+    for n in range(self.max_seeds + 1):
+      start = time.perf_counter()
+      for houses in compositions(n, PARTS):
+        self.solve(houses, n)
+      if progress:
+        progress(n, math.comb(n + PARTS - 1, PARTS - 1),
+                 time.perf_counter() - start)
+    return self.data
+
+  def write(self, path):
+    with open(path, 'wb') as f:
+      f.write(HEADER.pack(MAGIC, self.max_seeds, len(self.data)))
+      f.write(self.data)
+
+def compositions(n, parts):
+  if parts == 1:
+    yield [n]
+    return
+  for first in range(n + 1):
+    for rest in compositions(n - first, parts - 1):
+      rest.insert(0, first)
+      yield rest
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-n', '--seeds', dest='seeds', type='int', default=10,
+                    help='Most seeds left in the houses to solve, at most 127')
+  parser.add_option('-o', '--output', dest='output',
+                    default='kalah_endgame.bin', help='Table file to write')
+  (options, args) = parser.parse_args()
+  if not 0 <= options.seeds <= 127:
+    parser.error('Seeds must be between 0 and 127')
+
+  def progress(n, count, elapsed):
+    print('%3d seeds: %10d positions in %.1fs' % (n, count, elapsed))
+
+  builder = Builder(options.seeds)
+  builder.build(progress)
+  builder.write(options.output)
+  print('Wrote %d positions to %s' % (len(builder.data), options.output))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,297 @@
+import logging
+import time
+
+import metrics
+import protocol
+
+log = logging.getLogger('game')
+
+class Game:
+  # A game between two clients. commands maps the word after DAT <game> to
+  # (method name, number of arguments); each class gets it compiled into
+  # dispatch, so a command costs one dict lookup to find its handler, and
+  # the histogram its handling time goes to, game.<word> in metrics.
+  # Anything a game keeps about its players is kept here, keyed by client,
+  # rather than on the clients, which outlive it: waiting has when each
+  # started waiting for the other to move, or None.
+  timeout = 10
+  commands = {}
+  dispatch = {}
+
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
+    cls.dispatch = {
+        word: (getattr(cls, name), args + 3,
+               metrics.registry.histogram('game.' + word))
+        for word, (name, args) in cls.commands.items()}
+
+  def __init__(self, a, b, game_name, scheduler=None):
+    self.a = a
+    self.b = b
+    self.waiting = {a: None, b: None}
+    self.scheduler = scheduler
+    self.deadlines = {}
+    self.game_name = game_name
+    self.finished = False
+    self.result = None
+    self.started = time.time()
+    self.a.send_start(game_name, self.b.name)
+    self.b.send_start(game_name, self.a.name)
+    log.debug('Game made %s %s', self.a.name, self.b.name)
+
+  def get_ts(self):
+    return time.monotonic()
+
+  def client_won(self, client):
+    self.finished = True
+    self.result = client
+    self.stop_waiting(self.a)
+    self.stop_waiting(self.b)
+
+  def wait_for_client(self, client):
+    self.waiting[client] = self.get_ts()
+    if self.scheduler:
+      self.arm_timeout(client)
+
+  def stop_waiting(self, client):
+    self.waiting[client] = None
+    self.disarm_timeout(client)
+
+  def arm_timeout(self, client):
+    self.disarm_timeout(client)
+    self.deadlines[client] = self.scheduler.arm(
+        self.waiting[client] + self.timeout, self)
+
+  def disarm_timeout(self, client):
+    entry = self.deadlines.pop(client, None)
+    if entry:
+      self.scheduler.disarm(entry)
+
+  def update(self):
+    ts = self.get_ts()
+    timed_out_client = None
+    a_waiting = self.waiting[self.a]
+    b_waiting = self.waiting[self.b]
+    if a_waiting and ts - a_waiting > self.timeout:
+      timed_out_client = self.a
+    if b_waiting and ts - b_waiting > self.timeout:
+      if not timed_out_client or b_waiting < a_waiting:
+        timed_out_client = self.b
+    if timed_out_client:
+      log.info('Client timed out in %s', self.game_name)
+      self.client_won(self.get_opposite(timed_out_client))
+
+  def expire(self):
+    self.update()
+    if not self.finished:
+      # Woken marginally early; re-arm whoever is still waiting.
+      for client in (self.a, self.b):
+        if self.waiting[client]:
+          self.arm_timeout(client)
+
+  def send_results(self):
+    log.debug('Sending results for game %s: %s won', self.game_name,
+              self.result.name if self.result else 'noone')
+    if self.result:
+      self.result.send_result(self.game_name, 'WIN')
+      self.get_opposite(self.result).send_result(self.game_name, 'LSE')
+    else:
+      self.a.send_result(self.game_name, 'DRW')
+      self.b.send_result(self.game_name, 'DRW')
+
+  def get_opposite(self, p):
+    if p == self.a:
+      return self.b
+    else:
+      return self.a
+
+  def remove_client(self, client):
+    if not self.finished:
+      self.finished = True
+      self.result = self.get_opposite(client)
+      self.disarm_timeout(self.a)
+      self.disarm_timeout(self.b)
+
+  def client_data(self, client, tok):
+    entry = self.dispatch.get(tok[2]) if len(tok) > 2 else None
+    if entry is None or len(tok) != entry[1]:
+      client.error = 'Malformed command'
+      result = False
+    else:
+      start = time.perf_counter()
+      result = entry[0](self, client, tok)
+      entry[2].observe(time.perf_counter() - start)
+    if not result:
+      self.client_won(self.get_opposite(client))
+      return False
+    if self.has_won():
+      self.client_won(self.winner())
+    return True
+
+  def has_won(self):
+    return False
+
+  def winner(self):
+    return None
+
+  def record(self):
+    # What the journal keeps of the game once it is over.
+    winner = None
+    if self.result:
+      winner = 0 if self.result is self.a else 1
+    return {'a': self.a.name, 'b': self.b.name, 'winner': winner,
+            'started': self.started, 'finished': time.time(), 'moves': []}
+
+class Seat:
+  # A player's side of a SowingGame: which player it is to the board, its
+  # houses from low_idx up to its store and high_idx just past the store.
+  __slots__ = ('player', 'low_idx', 'high_idx', 'store')
+
+  def __init__(self, player, low_idx, store):
+    self.player = player
+    self.low_idx = low_idx
+    self.high_idx = store + 1
+    self.store = store
+
+class SowingGame(Game):
+  # The rules engine shared by the mancala games, all played on 14 pits laid
+  # out as in kalah.KalahBoard: a's houses at 0-5 and store at 6, b's houses
+  # at 7-12 and store at 13. board_class(seeds) does the sowing and must
+  # give pits, sow(player, pos) returning whether player goes again,
+  # points() and finished(). Players send MOV <house> with their own houses
+  # at 0-5, and can ask for the board with BRD. seats has each client's
+  # Seat.
+  commands = {'MOV': ('handle_move', 1), 'BRD': ('handle_board', 0)}
+  board_class = None
+  a_store = 6
+  b_store = 13
+  seeds = 3
+
+  def __init__(self, a, b, game_name, scheduler=None):
+    Game.__init__(self, a, b, game_name, scheduler)
+    self.board = self.board_class(self.seeds)
+    self.rendered = {}
+    self.moves = bytearray()
+    self.seats = {a: Seat(0, 0, self.a_store),
+                  b: Seat(1, self.a_store + 1, self.b_store)}
+    self.wait_for_client(self.a)
+
+  def handle_board(self, client, tok):
+    self.send_board(client)
+    return True
+
+  def handle_move(self, client, tok):
+    try:
+      pos = int(tok[3])
+    except ValueError:
+      client.error = 'Malformed command'
+      return False
+    pos = self.normalise_pos_for_client(client, pos)
+    seat = self.seats[client]
+    if pos < seat.low_idx or pos >= seat.store:
+      client.error = 'OOB index'
+      return False
+    if self.board.pits[pos] == 0:
+      client.error = 'Must move non-zero number of seeds'
+      return False
+    if not self.client_owns_house(client, pos):
+      client.error = 'Must move own seeds'
+      return False
+    if not self.waiting[client]:
+      client.error = 'Not your turn'
+      return False
+    error = self.illegal_move(client, pos)
+    if error:
+      client.error = error
+      return False
+    self.stop_waiting(client)
+    opposite_client = self.get_opposite(client)
+    if self.move_seeds(client, pos):
+      self.update_client(opposite_client, pos)
+      if not self.has_won():
+        self.wait_for_client(client)
+    else:
+      self.update_client(opposite_client, pos)
+      if not self.has_won():
+        self.wait_for_client(opposite_client)
+    for c in (self.a, self.b):
+      if 'BRD' in c.caps:
+        self.send_board(c)
+    return True
+
+  def illegal_move(self, client, pos):
+    # For rules beyond sowing from a non-empty house of one's own: the
+    # reason the move isn't allowed, or None.
+    return None
+
+  def normalise_pos_for_client(self, client, pos):
+    if not self.client_owns_house(client, pos):
+      return (pos + 7) % 14
+    return pos
+
+  def send_board(self, client):
+    # Boards are drawn at most once per move for each side and encoding,
+    # however many times they're sent.
+    seat = self.seats[client]
+    key = (seat.player, client.binary)
+    data = self.rendered.get(key)
+    if data is None:
+      if client.binary:
+        pits = self.board.pits
+        data = protocol.frame(protocol.BRD,
+                              protocol.GAME_IDS[self.game_name],
+                              pits[seat.low_idx:] + pits[:seat.low_idx])
+      else:
+        data = (self.print_board(client) + '\n').encode('ascii')
+      self.rendered[key] = data
+    client.handle.write(data)
+
+  def print_board(self, client):
+    seat = self.seats[client]
+    opp = self.seats[self.get_opposite(client)]
+    pits = self.board.pits
+    top_str = ' '.join(
+        str(i) for i in reversed(pits[opp.low_idx:opp.store]))
+    bot_str = ' '.join(str(i) for i in pits[seat.low_idx:seat.store])
+    stores = [pits[self.b_store], pits[self.a_store]]
+    if client != self.a:
+      stores.reverse()
+    return ' %s\n%d%s%d\n %s\n' % (
+        top_str, stores[0], ' ' * len(top_str), stores[1], bot_str)
+
+  def move_seeds(self, client, pos):
+    self.rendered.clear()
+    self.moves.append(pos)
+    return self.board.sow(self.seats[client].player, pos)
+
+  def client_owns_house(self, client, pos):
+    seat = self.seats[client]
+    return pos >= seat.low_idx and pos < seat.high_idx
+
+  def get_points(self):
+    return self.board.points()
+
+  def has_won(self):
+    return self.board.finished()
+
+  def winner(self):
+    a_pts, b_pts = self.get_points()
+    if a_pts > b_pts:
+      return self.a
+    elif a_pts < b_pts:
+      return self.b
+    return None
+
+  def record(self):
+    entry = Game.record(self)
+    entry['seeds'] = self.seeds
+    entry['moves'] = list(self.moves)
+    return entry
+
+  def wait_for_client(self, client):
+    client.send_turn(self.game_name)
+    Game.wait_for_client(self, client)
+
+  def update_client(self, client, pos):
+    npos = self.normalise_pos_for_client(self.b, pos)
+    client.send_move(self.game_name, npos)
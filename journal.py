@@ -0,0 +1,414 @@
+import bisect
+import collections
+import logging
+import mmap
+import optparse
+import os
+import queue
+import struct
+import threading
+import time
+
+from matchmaking import Ratings
+
+log = logging.getLogger('journal')
+
+# An append-only journal of finished games, kept in segment files next to
+# the server rather than in Mongo. A segment is MAGIC and then records one
+# after the other, each a varint length and then the game: a fixed HEADER
+# with its number, when it started and how long it took in milliseconds,
+# seeds per house, who won (0 for a draw, 1 for the first player, 2 for the
+# second) and the lengths of the names that follow it, the game's and the
+# two players'. Then come the moves as a varint count of bytes and a varint
+# for each move, a pit in the server's layout, so one byte each. The header
+# is unpacked in one go rather than varint by varint, as a replay of every
+# game spends most of its time there. Games are numbered from 1 in the
+# order they finish and a segment is named after the number of its first
+# game, so finding one is a bisect over the names and a scan of a single
+# segment. A record cut short by a crash ends its segment, and is cut off
+# when the writer next opens the journal.
+
+MAGIC = b'KLHJRNL1'
+HEADER = struct.Struct('<QQIBBBHH')
+SUFFIX = '.jnl'
+
+GameRecord = collections.namedtuple('GameRecord', [
+    'number', 'game', 'a', 'b', 'seeds', 'winner', 'started', 'duration',
+    'moves'])
+
+def write_varint(out, n):
+  while n > 0x7f:
+    out.append(n & 0x7f | 0x80)
+    n >>= 7
+  out.append(n)
+
+def read_varint(data, pos):
+  b = data[pos]
+  if b < 0x80:
+    return b, pos + 1
+  n = b & 0x7f
+  shift = 7
+  while True:
+    pos += 1
+    b = data[pos]
+    n |= (b & 0x7f) << shift
+    if b < 0x80:
+      return n, pos + 1
+    shift += 7
+
+def write_bytes(out, data):
+  write_varint(out, len(data))
+  out += data
+
+def encode(number, game_name, entry):
+  # entry is what Game.record() gives for a finished game.
+  names = [s.encode('utf-8') for s in (game_name, entry['a'], entry['b'])]
+  duration = int((entry['finished'] - entry['started']) * 1000)
+  winner = 0 if entry['winner'] is None else entry['winner'] + 1
+  body = bytearray(HEADER.pack(
+      number, int(entry['started'] * 1000), min(max(duration, 0), 2 ** 32 - 1),
+      entry.get('seeds', 0), winner, *map(len, names)))
+  for name in names:
+    body += name
+  moves = bytearray()
+  for pos in entry['moves']:
+    write_varint(moves, pos)
+  write_bytes(body, moves)
+  record = bytearray()
+  write_varint(record, len(body))
+  return bytes(record + body)
+
+def decode(data, pos, moves=True, names=None):
+  # The record whose body starts at pos. Without moves, they are skipped
+  # rather than unpacked. names, if given, caches the decoded names by
+  # their bytes, which repeat a lot over a segment.
+  (number, started, duration, seeds, winner,
+   game_len, a_len, b_len) = HEADER.unpack_from(data, pos)
+  pos += HEADER.size
+  end = pos + game_len + a_len + b_len
+  raw = data[pos:end]
+  strings = names.get(raw) if names is not None else None
+  if strings is None:
+    strings = (raw[:game_len].decode('utf-8'),
+               raw[game_len:game_len + a_len].decode('utf-8'),
+               raw[game_len + a_len:].decode('utf-8'))
+    if names is not None:
+      names[raw] = strings
+  played = None
+  if moves:
+    n, pos = read_varint(data, end)
+    packed = data[pos:pos + n]
+    if max(packed, default=0) < 0x80:
+      played = list(packed)
+    else:
+      played = []
+      i = 0
+      while i < n:
+        move, i = read_varint(packed, i)
+        played.append(move)
+  return GameRecord(number, strings[0], strings[1], strings[2], seeds,
+                    winner - 1 if winner else None, started / 1000,
+                    duration / 1000, played)
+
+def scan(data):
+  # (start, end) of the body of each whole record in a segment's data.
+  pos = len(MAGIC)
+  size = len(data)
+  while pos < size:
+    try:
+      length, start = read_varint(data, pos)
+    except IndexError:
+      return
+    end = start + length
+    if end > size:
+      return
+    yield start, end
+    pos = end
+
+def segment_names(path):
+  # Sorted (number of first game, file name) for the journal in path.
+  segments = []
+  for name in os.listdir(path):
+    if name.endswith(SUFFIX) and name[:-len(SUFFIX)].isdigit():
+      segments.append((int(name[:-len(SUFFIX)]), name))
+  segments.sort()
+  return segments
+
+class Segment:
+  # A segment file mapped into memory, as far as it had been written when
+  # opened.
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+    try:
+      size = os.fstat(self.file.fileno()).st_size
+      self.data = b''
+      if size:
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+      if self.data and self.data[:len(MAGIC)] != MAGIC:
+        raise ValueError('%s is not a journal segment' % path)
+    except Exception:
+      self.close()
+      raise
+
+  def records(self, moves=True):
+    data = self.data
+    names = {}
+    for start, end in scan(data):
+      yield decode(data, start, moves, names)
+
+  def close(self):
+    if isinstance(self.data, mmap.mmap):
+      self.data.close()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+class JournalReader:
+  def __init__(self, path):
+    self.path = path
+
+  def segments(self):
+    return segment_names(self.path) if os.path.isdir(self.path) else []
+
+  def open(self, name):
+    return Segment(os.path.join(self.path, name))
+
+  def games(self, start=1, moves=True):
+    # Every game from number start on, oldest first.
+    segments = self.segments()
+    first = max(bisect.bisect_right(segments, (start, '~')) - 1, 0)
+    for number, name in segments[first:]:
+      with self.open(name) as segment:
+        for record in segment.records(moves):
+          if record.number >= start:
+            yield record
+
+  def find(self, number):
+    segments = self.segments()
+    i = bisect.bisect_right(segments, (number, '~')) - 1
+    if i < 0:
+      return None
+    with self.open(segments[i][1]) as segment:
+      data = segment.data
+      for start, end in scan(data):
+        if HEADER.unpack_from(data, start)[0] == number:
+          return decode(data, start)
+    return None
+
+class JournalWriter:
+  # Write-behind like server.ResultsWriter: the game loop numbers and
+  # encodes each finished game and queues it, and a background thread
+  # appends whatever has queued up in one write. Writes are fsynced at most
+  # once every sync_interval seconds, so a burst of games costs one fsync.
+  # A new segment is started once the current one reaches segment_size,
+  # which keeps a lookup by number to a short scan.
+  segment_size = 1 << 20
+  sync_interval = 1.0
+
+  def __init__(self, path, max_backlog=10000):
+    self.path = path
+    os.makedirs(path, exist_ok=True)
+    self.reader = JournalReader(path)
+    self.queue = queue.Queue(max_backlog)
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.file = None
+    self.size = 0
+    self.sync_due = None
+    self.recorded = 0
+    self.written = 0
+    self.dropped = 0
+    self.syncs = 0
+    self.next_number = self.recover() + 1
+
+  def recover(self):
+    # The number of the last whole game in the journal. A record the last
+    # run didn't finish writing is cut off so appends follow on cleanly.
+    segments = self.reader.segments()
+    if not segments:
+      return 0
+    first, name = segments[-1]
+    path = os.path.join(self.path, name)
+    last, end = first - 1, len(MAGIC)
+    with self.reader.open(name) as segment:
+      for start, end in scan(segment.data):
+        last = HEADER.unpack_from(segment.data, start)[0]
+      size = len(segment.data)
+    if size < len(MAGIC):
+      # Made but never written to; it is made again for the next game.
+      os.remove(path)
+      return last
+    if end < size:
+      log.warning('Cutting off %d bytes at the end of journal segment %s',
+                  size - end, name)
+      os.truncate(path, end)
+    self.file = open(path, 'ab')
+    self.size = end
+    return last
+
+  def start(self):
+    self.thread.start()
+
+  def record(self, game_name, entry):
+    # The game's number, or None if the backlog is full, in which case the
+    # game is dropped rather than keep the game loop waiting on the disk,
+    # and its number goes to the next one.
+    number = self.next_number
+    try:
+      self.queue.put_nowait((number, encode(number, game_name, entry)))
+    except queue.Full:
+      if not self.dropped:
+        log.warning('Journal backlog full, dropping games')
+      self.dropped += 1
+      return None
+    self.next_number += 1
+    self.recorded += 1
+    return number
+
+  def stats(self):
+    return {'recorded': self.recorded, 'written': self.written,
+            'dropped': self.dropped, 'backlog': self.queue.qsize(),
+            'syncs': self.syncs}
+
+  def close(self):
+    if self.thread.is_alive():
+      self.queue.put(None)
+      self.thread.join()
+    if self.file:
+      self.file.close()
+      self.file = None
+
+  def run(self):
+    running = True
+    while running:
+      timeout = None
+      if self.sync_due is not None:
+        timeout = max(self.sync_due - time.monotonic(), 0)
+      try:
+        batch = [self.queue.get(timeout=timeout)]
+      except queue.Empty:
+        batch = []
+      while True:
+        try:
+          batch.append(self.queue.get_nowait())
+        except queue.Empty:
+          break
+      if None in batch:
+        running = False
+      batch = [i for i in batch if i is not None]
+      try:
+        if batch:
+          self.write(batch)
+        if self.sync_due is not None and (
+            not running or time.monotonic() >= self.sync_due):
+          self.sync()
+      except OSError:
+        log.exception('Writing the journal')
+
+  def write(self, batch):
+    chunk = []
+    for number, data in batch:
+      if self.file is None or self.size >= self.segment_size:
+        self.flush(chunk)
+        chunk = []
+        self.new_segment(number)
+      chunk.append(data)
+      self.size += len(data)
+    self.flush(chunk)
+    self.written += len(batch)
+    if self.sync_due is None:
+      self.sync_due = time.monotonic() + self.sync_interval
+
+  def flush(self, chunk):
+    # Written through to the OS so readers see it, fsynced or not.
+    if chunk:
+      self.file.write(b''.join(chunk))
+      self.file.flush()
+
+  def new_segment(self, number):
+    if self.file:
+      self.sync()
+      self.file.close()
+    self.file = open(os.path.join(self.path, '%012d%s' % (number, SUFFIX)),
+                     'ab')
+    self.file.write(MAGIC)
+    self.size = len(MAGIC)
+
+  def sync(self):
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.syncs += 1
+    self.sync_due = None
+
+def results(record):
+  # The game's results as recorded on the scoreboard.
+  if record.winner is None:
+    return [(record.a, 'draws'), (record.b, 'draws')]
+  players = (record.a, record.b)
+  return [(players[record.winner], 'wins'),
+          (players[1 - record.winner], 'losses')]
+
+def recompute_ratings(reader):
+  # Ratings for each game, from replaying the results of every game in the
+  # journal in order, and the number of games replayed.
+  ratings = collections.defaultdict(Ratings)
+  count = 0
+  for record in reader.games(moves=False):
+    ratings[record.game].record(results(record))
+    count += 1
+  return ratings, count
+
+def describe(record):
+  winner = 'noone'
+  if record.winner is not None:
+    winner = (record.a, record.b)[record.winner]
+  return '%d %s %s %s %s %d moves, %s won' % (
+      record.number, record.game,
+      time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.started)),
+      record.a, record.b, len(record.moves), winner)
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-j', '--journal', dest='journal', default='journal',
+                    help='Journal directory')
+  parser.add_option('-l', '--list', dest='list', action='store_true',
+                    help='List the games in the journal')
+  parser.add_option('-f', '--from', dest='start', type='int', default=1,
+                    help='First game to list')
+  parser.add_option('-s', '--show', dest='show', type='int',
+                    help='Print the moves of a game')
+  parser.add_option('-r', '--ratings', dest='ratings', action='store_true',
+                    help='Recompute ratings from every game in the journal')
+  parser.add_option('-t', '--top', dest='top', type='int', default=20,
+                    help='Ratings to show for each game with --ratings')
+  (options, args) = parser.parse_args()
+  reader = JournalReader(options.journal)
+
+  if options.list:
+    for record in reader.games(options.start):
+      print(describe(record))
+  elif options.show:
+    record = reader.find(options.show)
+    if record is None:
+      parser.error('No game %d in %s' % (options.show, options.journal))
+    print(describe(record))
+    print(' '.join(map(str, record.moves)))
+  elif options.ratings:
+    start = time.perf_counter()
+    ratings, count = recompute_ratings(reader)
+    elapsed = time.perf_counter() - start
+    for game_name, game_ratings in sorted(ratings.items()):
+      ranked = sorted(game_ratings.ratings.items(), key=lambda r: -r[1])
+      print(game_name)
+      for name, rating in ranked[:options.top]:
+        print('  %-20s %7.1f' % (name, rating))
+    print('Replayed %d games in %.2fs' % (count, elapsed))
+  else:
+    parser.error('Need one of --list, --show or --ratings')
+
+if __name__ == '__main__':
+  main()
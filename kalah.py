@@ -0,0 +1,98 @@
+HOUSES = 6
+PITS = 14
+LAP = PITS - 1
+STORES = (6, 13)
+
+def build_tables():
+  # order[p][pos] lists the 13 pits player p sows into after pos, skipping the
+  # opponent's store and ending back at pos. Everything else is derived from
+  # it so a sow is a few table lookups rather than a loop per seed.
+  order = []
+  prefix = []
+  side0 = []
+  for player in (0, 1):
+    skip = STORES[1 - player]
+    p_order, p_prefix, p_side0 = [], [], []
+    for pos in range(PITS):
+      seq = []
+      npos = pos
+      while len(seq) < LAP:
+        npos = (npos + 1) % PITS
+        if npos != skip:
+          seq.append(npos)
+      p_order.append(tuple(seq))
+      p_prefix.append(tuple(tuple(seq[:r]) for r in range(LAP)))
+      p_side0.append(tuple(sum(1 for i in seq[:r] if i <= STORES[0])
+                           for r in range(LAP + 1)))
+    order.append(tuple(p_order))
+    prefix.append(tuple(p_prefix))
+    side0.append(tuple(p_side0))
+  return tuple(order), tuple(prefix), tuple(side0)
+
+ORDER, PREFIX, SIDE0 = build_tables()
+OPPOSITE = tuple(
+    STORES[1] if i == STORES[0] else STORES[0] if i == STORES[1] else 12 - i
+    for i in range(PITS))
+OWNER = tuple(0 if i <= STORES[0] else 1 for i in range(PITS))
+
+class KalahBoard:
+  # Kalah in the server's layout: player 0 owns houses 0-5 and store 6,
+  # player 1 owns houses 7-12 and store 13. pits is a bytearray, so at most
+  # 21 seeds per house. totals keeps the seeds on each side (houses plus
+  # store) up to date so the end of game check doesn't re-sum the board.
+  max_seeds = 255 // (2 * HOUSES)
+
+  def __init__(self, seeds=3):
+    if seeds > self.max_seeds:
+      raise ValueError('At most %d seeds per house' % self.max_seeds)
+    self.pits = bytearray([seeds] * PITS)
+    self.pits[STORES[0]] = 0
+    self.pits[STORES[1]] = 0
+    self.totals = [seeds * HOUSES, seeds * HOUSES]
+
+  @classmethod
+  def from_pits(cls, pits):
+    board = cls.__new__(cls)
+    board.pits = bytearray(pits)
+    board.totals = [sum(board.pits[:STORES[0] + 1]),
+                    sum(board.pits[STORES[0] + 1:])]
+    return board
+
+  def sow(self, player, pos):
+    # Returns True if the last seed landed in player's store.
+    pits = self.pits
+    totals = self.totals
+    num_seeds = pits[pos]
+    pits[pos] = 0
+    totals[OWNER[pos]] -= num_seeds
+
+    laps, rem = divmod(num_seeds, LAP)
+    if laps:
+      for i in ORDER[player][pos]:
+        pits[i] += laps
+    for i in PREFIX[player][pos][rem]:
+      pits[i] += 1
+    to_side0 = laps * SIDE0[player][pos][LAP] + SIDE0[player][pos][rem]
+    totals[0] += to_side0
+    totals[1] += num_seeds - to_side0
+
+    last = ORDER[player][pos][rem - 1]
+    if last == STORES[player]:
+      return True
+    opp = OPPOSITE[last]
+    if OWNER[last] == player and pits[last] == 1 and pits[opp] > 0:
+      captured = pits[opp]
+      pits[STORES[player]] += captured + 1
+      pits[last] = 0
+      pits[opp] = 0
+      totals[player] += captured
+      totals[1 - player] -= captured
+    return False
+
+  def points(self):
+    return self.totals[0], self.totals[1]
+
+  def finished(self):
+    # One side has no seeds left outside its store.
+    return (self.totals[0] == self.pits[STORES[0]] or
+            self.totals[1] == self.pits[STORES[1]])
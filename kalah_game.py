@@ -0,0 +1,6 @@
+from game import SowingGame
+from kalah import KalahBoard
+
+class KalahGame(SowingGame):
+  board_class = KalahBoard
+  seeds = 3
@@ -0,0 +1,115 @@
+import bisect
+import itertools
+
+class Ratings:
+  # Elo ratings for one game pool, kept in memory and updated from every
+  # finished game. Players nobody has seen yet start at initial.
+  initial = 1500
+  k = 32
+  result_scores = {'wins': 1, 'draws': 0.5, 'losses': 0}
+
+  def __init__(self):
+    self.ratings = {}
+
+  def get(self, name):
+    return self.ratings.get(name, self.initial)
+
+  def expected(self, a, b):
+    return 1 / (1 + 10 ** ((b - a) / 400))
+
+  def record(self, results):
+    # results is [(name, field), (name, field)] for the two players, as
+    # recorded on the scoreboard.
+    (a_name, a_field), (b_name, b_field) = results
+    a = self.get(a_name)
+    b = self.get(b_name)
+    delta = self.k * (self.result_scores[a_field] - self.expected(a, b))
+    self.ratings[a_name] = a + delta
+    self.ratings[b_name] = b - delta
+
+class MatchQueue:
+  # Players waiting for a game, kept sorted on (rating, seq) so each one's
+  # closest opponents are its neighbours, found with a bisect. A player
+  # accepts opponents within window rating points of it, and the window
+  # widens by widen_rate points for every second spent waiting. If given,
+  # compatible(a, b) says whether two players may be paired at all; players
+  # it rules out are skipped over when looking for neighbours.
+  window = 100
+  widen_rate = 25
+  # Allowance for float error, so a pair isn't missed when the wakeup from
+  # next_match() lands exactly on the moment it comes within reach.
+  slack = 1e-6
+
+  def __init__(self, compatible=None):
+    self.ranked = []
+    self.waiting = {}
+    self.seq = itertools.count()
+    self.compatible = compatible
+
+  def __len__(self):
+    return len(self.waiting)
+
+  def __contains__(self, client):
+    return client in self.waiting
+
+  def add(self, client, rating, now):
+    key = (rating, next(self.seq), client)
+    bisect.insort(self.ranked, key)
+    self.waiting[client] = (key, now)
+
+  def remove(self, client):
+    key, since = self.waiting.pop(client)
+    del self.ranked[bisect.bisect_left(self.ranked, key)]
+
+  def neighbour(self, i, step):
+    client = self.ranked[i][2]
+    i += step
+    while 0 <= i < len(self.ranked):
+      other = self.ranked[i]
+      if self.compatible is None or self.compatible(client, other[2]):
+        return other
+      i += step
+    return None
+
+  def reach(self, client, now):
+    key, since = self.waiting[client]
+    return self.window + self.widen_rate * (now - since)
+
+  def pair(self, now):
+    # Goes through the players longest waiting first, matching each with the
+    # nearer of its two neighbours if either of them is willing to play the
+    # other. Returns the pairs made, which are no longer waiting.
+    pairs = []
+    for client in list(self.waiting):
+      if len(self.ranked) < 2:
+        break
+      if client not in self.waiting:
+        continue
+      key = self.waiting[client][0]
+      i = bisect.bisect_left(self.ranked, key)
+      neighbours = [o for o in (self.neighbour(i, -1), self.neighbour(i, 1))
+                    if o is not None]
+      if not neighbours:
+        continue
+      other = min(neighbours, key=lambda o: abs(o[0] - key[0]))
+      gap = abs(other[0] - key[0])
+      reach = max(self.reach(client, now), self.reach(other[2], now))
+      if gap <= reach + self.slack:
+        self.remove(client)
+        self.remove(other[2])
+        pairs.append((client, other[2]))
+    return pairs
+
+  def next_match(self):
+    # The time at which the closest pair of neighbours still waiting comes
+    # within reach of each other, or None if no two can be paired.
+    best = None
+    for i, a in enumerate(self.ranked):
+      b = self.neighbour(i, 1)
+      if b is None:
+        continue
+      since = min(self.waiting[a[2]][1], self.waiting[b[2]][1])
+      ts = since + (b[0] - a[0] - self.window) / self.widen_rate
+      if best is None or ts < best:
+        best = ts
+    return best
@@ -0,0 +1,157 @@
+import threading
+import time
+
+# Counters, gauges and latency histograms for the server, read out as text
+# with STA. Counting or timing something is a few attribute updates, so
+# they can sit on the hot path. Code keeps hold of what it updates, looked
+# up once by name from registry, rather than finding it on every update.
+# Shard workers have registries of their own, sent to the front end as
+# snapshots, which render() turns to text the same way.
+
+class Counter:
+  __slots__ = ('value',)
+
+  def __init__(self):
+    self.value = 0
+
+  def inc(self, n=1):
+    self.value += n
+
+class Histogram:
+  # Seconds, counted in buckets by powers of two microseconds: bucket i
+  # holds values of at least 2 ** (i - 1) and under 2 ** i microseconds, so
+  # percentiles are read back as the top of their bucket, within a factor
+  # of two; the last of the 32 takes anything from 18 minutes up. The count
+  # is only summed from the buckets when read, which keeps observe() to the
+  # fewest updates.
+  def __init__(self):
+    self.counts = [0] * 32
+    self.total = 0.0
+    self.max = 0.0
+
+  def observe(self, seconds):
+    i = int(seconds * 1e6).bit_length()
+    self.counts[i if i < 32 else 31] += 1
+    self.total += seconds
+    if seconds > self.max:
+      self.max = seconds
+
+  def snapshot(self):
+    return {'counts': list(self.counts), 'count': sum(self.counts),
+            'total': self.total, 'max': self.max}
+
+class LockedHistogram(Histogram):
+  # For histograms observed from more than one thread.
+  def __init__(self):
+    Histogram.__init__(self)
+    self.lock = threading.Lock()
+
+  def observe(self, seconds):
+    with self.lock:
+      Histogram.observe(self, seconds)
+
+  def snapshot(self):
+    with self.lock:
+      return Histogram.snapshot(self)
+
+class Registry:
+  def __init__(self):
+    self.counters = {}
+    self.histograms = {}
+    self.gauges = {}
+    self.started = time.monotonic()
+    self.last = None
+
+  def counter(self, name):
+    counter = self.counters.get(name)
+    if counter is None:
+      counter = self.counters[name] = Counter()
+    return counter
+
+  def histogram(self, name, threaded=False):
+    # threaded for one observed outside the loop thread.
+    histogram = self.histograms.get(name)
+    if histogram is None:
+      histogram_class = LockedHistogram if threaded else Histogram
+      histogram = self.histograms[name] = histogram_class()
+    return histogram
+
+  def gauge(self, name, read):
+    # read() gives the value when metrics are read out, or a dict of them,
+    # which are named name.key. A later gauge of the same name replaces it.
+    self.gauges[name] = read
+
+  def snapshot(self):
+    gauges = {}
+    for name, read in list(self.gauges.items()):
+      value = read()
+      if isinstance(value, dict):
+        for key, v in value.items():
+          gauges['%s.%s' % (name, key)] = v
+      else:
+        gauges[name] = value
+    return {
+      'time': time.monotonic(),
+      'uptime': time.monotonic() - self.started,
+      'counters': {n: c.value for n, c in list(self.counters.items())},
+      'histograms': {n: h.snapshot()
+                     for n, h in list(self.histograms.items())},
+      'gauges': gauges,
+    }
+
+  def render(self, prefix=''):
+    # Counter rates are since the last render.
+    snapshot = self.snapshot()
+    lines = render(snapshot, self.last, prefix)
+    self.last = snapshot
+    return lines
+
+def percentile(h, p):
+  # The top of the bucket holding the p-th percentile, in seconds, or the
+  # largest value seen if that's lower.
+  rank = p * h['count']
+  seen = 0
+  for i, n in enumerate(h['counts']):
+    seen += n
+    if n and seen >= rank:
+      return min((1 << i) / 1e6, h['max'])
+  return h['max']
+
+def format_seconds(seconds):
+  if seconds >= 1:
+    return '%.2fs' % seconds
+  if seconds >= 1e-3:
+    return '%.2fms' % (seconds * 1e3)
+  return '%.0fus' % (seconds * 1e6)
+
+def render(snapshot, previous=None, prefix=''):
+  # Lines of text for a snapshot, with counter rates since previous if
+  # given and older, or since the start otherwise.
+  lines = ['%suptime %.1f' % (prefix, snapshot['uptime'])]
+  elapsed = snapshot['uptime']
+  before = {}
+  if previous and previous['time'] < snapshot['time']:
+    elapsed = snapshot['time'] - previous['time']
+    before = previous['counters']
+  for name, value in sorted(snapshot['counters'].items()):
+    rate = (value - before.get(name, 0)) / elapsed if elapsed > 0 else 0
+    lines.append('%s%s %d %.1f/s' % (prefix, name, value, rate))
+  for name, value in sorted(snapshot['gauges'].items()):
+    if isinstance(value, float):
+      lines.append('%s%s %.6g' % (prefix, name, value))
+    else:
+      lines.append('%s%s %s' % (prefix, name, value))
+  for name, h in sorted(snapshot['histograms'].items()):
+    count = h['count']
+    if not count:
+      lines.append('%s%s count=0' % (prefix, name))
+      continue
+    lines.append('%s%s count=%d mean=%s p50=%s p90=%s p99=%s max=%s' % (
+        prefix, name, count, format_seconds(h['total'] / count),
+        format_seconds(percentile(h, 0.5)),
+        format_seconds(percentile(h, 0.9)),
+        format_seconds(percentile(h, 0.99)),
+        format_seconds(h['max'])))
+  return lines
+
+registry = Registry()
@@ -0,0 +1,67 @@
+import optparse
+import time
+
+import server
+
+# Moves scores from the array embedded in each user document, as servers
+# before the results collection kept them, into one results document per
+# user and game. Each user's counts are added to whatever the results
+# collection already has for them, then the user's array is removed, so the
+# migration can be run again, for instance after an old server has been
+# left running for a while, without counting anything twice. Only a batch
+# stopped between the two steps would be counted twice if run again.
+
+def migrate(users_collection, results_collection, batch_size=1000,
+            dry_run=False):
+  # Returns the number of users and of scores moved.
+  users = scores = 0
+  cursor = users_collection.find({'scores.0': {'$exists': True}},
+                                 {'username': 1, 'scores': 1})
+  batch = []
+  for user in cursor:
+    batch.append(user)
+    if len(batch) >= batch_size:
+      scores += move_batch(users_collection, results_collection, batch,
+                           dry_run)
+      users += len(batch)
+      batch = []
+  if batch:
+    scores += move_batch(users_collection, results_collection, batch, dry_run)
+    users += len(batch)
+  return users, scores
+
+def move_batch(users_collection, results_collection, batch, dry_run):
+  increment = results_collection.initialize_unordered_bulk_op()
+  unset = users_collection.initialize_unordered_bulk_op()
+  scores = 0
+  for user in batch:
+    for score in user['scores']:
+      counts = dict((k, score.get(k, 0)) for k in server.Scoreboard.fields)
+      increment.find({'username': user['username'], 'game': score['game']}
+                     ).upsert().update_one({'$inc': counts})
+      scores += 1
+    unset.find({'_id': user['_id']}).update_one({'$unset': {'scores': ''}})
+  if not dry_run:
+    if scores:
+      increment.execute()
+    unset.execute()
+  return scores
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-b', '--batch', dest='batch', type='int', default=1000,
+                    help='Users to move per bulk write')
+  parser.add_option('-n', '--dry-run', dest='dry_run', action='store_true',
+                    help='Count what would be moved without writing')
+  (options, args) = parser.parse_args()
+
+  users_collection, results_collection = server.connect_database()
+  start = time.monotonic()
+  users, scores = migrate(users_collection, results_collection,
+                          options.batch, options.dry_run)
+  print('%s %d scores of %d users in %.1fs' % (
+      'Would move' if options.dry_run else 'Moved', scores, users,
+      time.monotonic() - start))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,439 @@
+import collections
+import logging
+import selectors
+import socket
+import struct
+import time
+
+import metrics
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+def raise_fd_limit():
+  if resource is None:
+    return None
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if hard != resource.RLIM_INFINITY and soft < hard:
+    try:
+      resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+      soft = hard
+    except (ValueError, OSError):
+      pass
+  return soft
+
+log = logging.getLogger('network')
+
+class LineTooLong(Exception):
+  pass
+
+class LineBuffer:
+  # Splits a byte stream into lines. Each received chunk is searched for
+  # newlines once, and everything up to its last newline is decoded and
+  # split in one go; only the unterminated tail is kept as bytes. A line
+  # longer than max_line is dropped up to its newline and reported in its
+  # place by pop_line raising LineTooLong.
+
+  def __init__(self, max_line=4096, encoding='ascii'):
+    self.partial = bytearray()
+    self.lines = collections.deque()
+    self.max_line = max_line
+    self.encoding = encoding
+    self.discarding = False
+
+  def __len__(self):
+    return len(self.partial)
+
+  def feed(self, data):
+    with memoryview(data) as view:
+      last = data.rfind(b'\n')
+      if last == -1:
+        self.extend_partial(view)
+        return
+      start = 0
+      if self.partial or self.discarding:
+        start = data.find(b'\n') + 1
+        self.extend_partial(view[:start - 1])
+        if not self.discarding:
+          self.push([self.partial])
+        self.partial.clear()
+        self.discarding = False
+      if start <= last:
+        try:
+          self.push(str(view[start:last], self.encoding).split('\n'))
+        except UnicodeDecodeError:
+          self.push(bytes(view[start:last]).split(b'\n'))
+      self.extend_partial(view[last + 1:])
+
+  def extend_partial(self, view):
+    if self.discarding:
+      return
+    self.partial += view
+    if len(self.partial) > self.max_line:
+      self.partial.clear()
+      self.discarding = True
+      self.lines.append(LineTooLong())
+
+  def push(self, lines):
+    if max(map(len, lines)) <= self.max_line and isinstance(lines[0], str):
+      self.lines.extend(lines)
+      return
+    for line in lines:
+      if len(line) > self.max_line:
+        line = LineTooLong()
+      elif not isinstance(line, str):
+        try:
+          line = str(line, self.encoding)
+        except UnicodeDecodeError as e:
+          line = e
+      self.lines.append(line)
+
+  def has_line(self):
+    return bool(self.lines)
+
+  def drain(self):
+    # Hands back everything not yet consumed as raw bytes, e.g. to pass the
+    # connection on to another process.
+    data = b''.join(
+        line.encode(self.encoding) + b'\n'
+        for line in self.lines if not isinstance(line, Exception))
+    data += self.partial
+    self.lines.clear()
+    self.partial.clear()
+    self.discarding = False
+    return data
+
+  def pop_line(self):
+    if not self.lines:
+      return None
+    line = self.lines.popleft()
+    if isinstance(line, Exception):
+      raise line
+    return line
+
+class FrameTooLong(Exception):
+  pass
+
+class FrameBuffer:
+  # Splits a byte stream into frames, each a big endian 16 bit length and
+  # then that many bytes. A length over max_frame means the stream can't be
+  # trusted to be in step any more, so pop_frame raises FrameTooLong and
+  # everything received after that is dropped.
+  length = struct.Struct('>H')
+
+  def __init__(self, max_frame=4096):
+    self.partial = bytearray()
+    self.frames = collections.deque()
+    self.max_frame = max_frame
+    self.broken = False
+
+  def __len__(self):
+    return len(self.partial)
+
+  def feed(self, data):
+    # Frames are cut straight out of data; only a frame split across reads
+    # goes through partial.
+    if self.broken:
+      return
+    if self.partial:
+      self.partial += data
+      data = bytes(self.partial)
+      self.partial.clear()
+    start = 0
+    end = len(data)
+    while end - start >= 2:
+      n = (data[start] << 8) | data[start + 1]
+      if n > self.max_frame:
+        self.frames.append(FrameTooLong())
+        self.broken = True
+        return
+      if start + 2 + n > end:
+        break
+      self.frames.append(data[start + 2:start + 2 + n])
+      start += 2 + n
+    self.partial += data[start:]
+
+  def has_frame(self):
+    return bool(self.frames)
+
+  def drain(self):
+    data = b''.join(self.length.pack(len(f)) + f
+                    for f in self.frames if not isinstance(f, Exception))
+    data += self.partial
+    self.frames.clear()
+    self.partial.clear()
+    return data
+
+  def pop_frame(self):
+    if not self.frames:
+      return None
+    f = self.frames.popleft()
+    if isinstance(f, Exception):
+      raise f
+    return f
+
+class Connection:
+  # The handle the engine gives its handler for each client. write() only
+  # queues; the engine sends everything queued during a tick in one go and
+  # waits for writability if the socket can't take it all. A client that
+  # lets more than high_water bytes back up is disconnected.
+  def __init__(self, engine, sock, addr):
+    self.engine = engine
+    self.sock = sock
+    self.addr = addr
+    self.output = bytearray()
+    self.events = selectors.EVENT_READ
+    self.closing = False
+    self.bytes_queued = 0
+    self.bytes_sent = 0
+    self.peak_queued = 0
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def queued(self):
+    return len(self.output)
+
+  def write(self, data):
+    if self.closing:
+      return False
+    self.output += data
+    self.bytes_queued += len(data)
+    if len(self.output) > self.peak_queued:
+      self.peak_queued = len(self.output)
+    if len(self.output) > self.engine.high_water:
+      log.warning('Client %s not reading, %d bytes queued', self.addr,
+                  len(self.output))
+      self.engine.close_later(self)
+      return False
+    self.engine.dirty.add(self)
+    return True
+
+class NetworkEngine:
+  # Drives a connection handler from a selectors backend (epoll/kqueue where
+  # available). The handler must provide add_client(handle, addr),
+  # client_data(handle, data), remove_client(handle), update() and
+  # next_timeout(), which returns seconds until update() next has work to do
+  # or None. timeout caps how long a single select may block. Other threads
+  # hand work back to the loop with call_soon_threadsafe. With no address
+  # the engine only serves connections given to it with adopt(). The time
+  # each tick spends working, from select returning until the loop goes
+  # back to it, goes to loop.tick in metrics.
+  recv_size = 4096
+  high_water = 1 << 20
+
+  def __init__(self, handler, address, backlog=socket.SOMAXCONN,
+               selector_class=selectors.DefaultSelector, timeout=None,
+               verbose=True):
+    self.handler = handler
+    self.address = address
+    self.backlog = backlog
+    self.timeout = timeout
+    self.verbose = verbose
+    self.selector = selector_class()
+    self.server_socket = None
+    self.running = False
+    self.callbacks = collections.deque()
+    self.connections = set()
+    self.dirty = set()
+    self.closing = set()
+    self.waker, self.waker_write = socket.socketpair()
+    self.waker.setblocking(False)
+    self.waker_write.setblocking(False)
+    self.selector.register(self.waker, selectors.EVENT_READ, self.drain_waker)
+    self.tick_time = metrics.registry.histogram('loop.tick')
+    metrics.registry.gauge('network', self.stats)
+
+  def listen(self):
+    self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.server_socket.bind(self.address)
+    self.server_socket.listen(self.backlog)
+    self.server_socket.setblocking(False)
+    self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept)
+    return self.server_socket.getsockname()
+
+  def add_reader(self, fileobj, callback):
+    self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+  def remove_reader(self, fileobj):
+    self.selector.unregister(fileobj)
+
+  def run(self):
+    if self.address and not self.server_socket:
+      self.listen()
+    self.running = True
+    while self.running:
+      self.run_once(self.poll_timeout())
+
+  def stop(self):
+    self.running = False
+
+  def poll_timeout(self):
+    timeout = self.handler.next_timeout()
+    if self.timeout is not None and (timeout is None or timeout > self.timeout):
+      timeout = self.timeout
+    return timeout
+
+  def run_once(self, timeout):
+    if self.callbacks:
+      timeout = 0
+    events = self.selector.select(timeout)
+    start = time.perf_counter()
+    for key, mask in events:
+      conn = key.data
+      if not isinstance(conn, Connection):
+        conn()
+        continue
+      if mask & selectors.EVENT_READ:
+        self.read(conn)
+      if mask & selectors.EVENT_WRITE and not conn.closing:
+        self.flush(conn)
+    self.run_callbacks()
+    self.handler.update()
+    self.flush_dirty()
+    while self.closing:
+      self.drop(self.closing.pop())
+    self.tick_time.observe(time.perf_counter() - start)
+
+  def stats(self):
+    queued = [conn.queued() for conn in self.connections]
+    return {
+      'connections': len(self.connections),
+      'bytes_queued': sum(queued),
+      'max_queued': max(queued) if queued else 0,
+    }
+
+  def call_soon_threadsafe(self, callback, *args):
+    self.callbacks.append((callback, args))
+    try:
+      self.waker_write.send(b'\0')
+    except OSError:
+      # Either already signalled (buffer full) or shutting down.
+      pass
+
+  def drain_waker(self):
+    try:
+      while self.waker.recv(4096):
+        pass
+    except (BlockingIOError, InterruptedError):
+      pass
+
+  def run_callbacks(self):
+    for i in range(len(self.callbacks)):
+      callback, args = self.callbacks.popleft()
+      try:
+        callback(*args)
+      except Exception:
+        log.exception('Callback failed')
+
+  def accept(self):
+    while True:
+      try:
+        sock, addr = self.server_socket.accept()
+      except (BlockingIOError, InterruptedError):
+        return
+      except OSError as e:
+        # Typically EMFILE; leave the rest in the backlog for the next tick.
+        log.warning('Could not accept connection: %s', e)
+        return
+      addr = addr[0]
+      if self.verbose:
+        log.debug('Connection from "%s"', addr)
+      self.handler.add_client(self.adopt(sock, addr), addr)
+
+  def adopt(self, sock, addr):
+    sock.setblocking(False)
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+      # Replies go out once per tick already, so Nagle only adds delay, and
+      # holding back a move behind a delayed ACK stalls chained moves.
+      try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      except OSError:
+        pass
+    conn = Connection(self, sock, addr)
+    self.connections.add(conn)
+    self.selector.register(sock, conn.events, conn)
+    return conn
+
+  def detach(self, conn):
+    # Stops serving conn without closing it or telling the handler. Returns
+    # the socket and any output not yet sent.
+    self.connections.remove(conn)
+    self.dirty.discard(conn)
+    self.closing.discard(conn)
+    self.selector.unregister(conn.sock)
+    conn.closing = True
+    return conn.sock, bytes(conn.output)
+
+  def read(self, conn):
+    success = False
+    try:
+      data = conn.sock.recv(self.recv_size)
+      if data:
+        self.handler.client_data(conn, data)
+      elif self.verbose:
+        log.debug('Client disconnected')
+      success = data
+    except (BlockingIOError, InterruptedError):
+      return
+    except ConnectionError as e:
+      log.info('Lost connection to %s: %s', conn.addr, e)
+    except Exception:
+      log.exception('Handling data from %s', conn.addr)
+    if not success:
+      self.drop(conn)
+
+  def flush_dirty(self):
+    while self.dirty:
+      conn = self.dirty.pop()
+      if not conn.closing:
+        self.flush(conn)
+
+  def flush(self, conn):
+    if conn.output:
+      try:
+        sent = conn.sock.send(conn.output)
+      except (BlockingIOError, InterruptedError):
+        sent = 0
+      except OSError as e:
+        log.info('Could not send data for client %s: %s', conn.addr, e)
+        self.close_later(conn)
+        return
+      del conn.output[:sent]
+      conn.bytes_sent += sent
+    events = selectors.EVENT_READ
+    if conn.output:
+      events |= selectors.EVENT_WRITE
+    if events != conn.events:
+      conn.events = events
+      self.selector.modify(conn.sock, events, conn)
+
+  def close_later(self, conn):
+    conn.closing = True
+    self.closing.add(conn)
+
+  def drop(self, conn):
+    if conn not in self.connections:
+      return
+    conn.closing = True
+    self.connections.remove(conn)
+    self.dirty.discard(conn)
+    self.selector.unregister(conn.sock)
+    conn.sock.close()
+    self.handler.remove_client(conn)
+
+  def close(self):
+    self.flush_dirty()
+    for conn in list(self.connections):
+      self.drop(conn)
+    self.selector.unregister(self.waker)
+    self.waker.close()
+    self.waker_write.close()
+    if self.server_socket:
+      self.selector.unregister(self.server_socket)
+      self.server_socket.close()
+      self.server_socket = None
+    self.selector.close()
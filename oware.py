@@ -0,0 +1,86 @@
+from kalah import HOUSES, PITS, STORES
+
+# The 12 houses in the order seeds go round them. The stores are not part
+# of the round in Oware; they only hold what each player has captured.
+ROUND = tuple(i for i in range(PITS) if i not in STORES)
+ROUND_INDEX = {pos: i for i, pos in enumerate(ROUND)}
+SIDES = (ROUND[:HOUSES], ROUND[HOUSES:])
+
+class OwareBoard:
+  # Oware abapa in KalahBoard's layout, so the server, the protocol and
+  # clients see the same 14 pits: player 0 owns houses 0-5 and keeps its
+  # captures in 6, player 1 owns houses 7-12 and keeps its captures in 13.
+  # A sow skips the house it started from. If it ends on the other side
+  # with 2 or 3 seeds there, those are captured, along with any unbroken run
+  # of 2s and 3s before it on that side, unless that would take every seed
+  # the other player has. A player must leave the other some seeds to play
+  # if it can. The game ends once someone has captured more than half the
+  # seeds, or the player to move has no move, or after max_moves sows, and
+  # seeds still in the houses then go to the side they are on.
+  max_seeds = 255 // (2 * HOUSES)
+  max_moves = 300
+
+  def __init__(self, seeds=4):
+    if seeds > self.max_seeds:
+      raise ValueError('At most %d seeds per house' % self.max_seeds)
+    self.pits = bytearray([seeds] * PITS)
+    self.pits[STORES[0]] = 0
+    self.pits[STORES[1]] = 0
+    self.half = seeds * HOUSES
+    self.to_move = 0
+    self.moves = 0
+
+  def reaches(self, pos):
+    # Whether sowing from pos puts a seed on the other side.
+    return self.pits[pos] >= HOUSES - ROUND_INDEX[pos] % HOUSES
+
+  def starves(self, player, pos):
+    # True if the other player has no seeds and sowing pos leaves it so.
+    pits = self.pits
+    return (not any(pits[i] for i in SIDES[1 - player]) and
+            not self.reaches(pos))
+
+  def legal_moves(self, player):
+    pits = self.pits
+    return [i for i in SIDES[player]
+            if pits[i] and not self.starves(player, i)]
+
+  def sow(self, player, pos):
+    # Never gives another turn, so always returns False.
+    pits = self.pits
+    num_seeds = pits[pos]
+    pits[pos] = 0
+    start = i = ROUND_INDEX[pos]
+    while num_seeds:
+      i = (i + 1) % len(ROUND)
+      if i != start:
+        pits[ROUND[i]] += 1
+        num_seeds -= 1
+
+    low = (1 - player) * HOUSES
+    run = []
+    while low <= i < low + HOUSES and pits[ROUND[i]] in (2, 3):
+      run.append(ROUND[i])
+      i -= 1
+    captured = sum(pits[j] for j in run)
+    if captured and captured < sum(pits[j] for j in SIDES[1 - player]):
+      for j in run:
+        pits[j] = 0
+      pits[STORES[player]] += captured
+
+    self.moves += 1
+    self.to_move = 1 - player
+    return False
+
+  def points(self):
+    pits = self.pits
+    return sum(pits[:STORES[0] + 1]), sum(pits[STORES[0] + 1:])
+
+  def finished(self):
+    pits = self.pits
+    if pits[STORES[0]] > self.half or pits[STORES[1]] > self.half:
+      return True
+    if pits[STORES[0]] == pits[STORES[1]] == self.half:
+      return True
+    return (self.moves >= self.max_moves or
+            not self.legal_moves(self.to_move))
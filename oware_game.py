@@ -0,0 +1,11 @@
+from game import SowingGame
+from oware import OwareBoard
+
+class OwareGame(SowingGame):
+  board_class = OwareBoard
+  seeds = 4
+
+  def illegal_move(self, client, pos):
+    if self.board.starves(self.seats[client].player, pos):
+      return 'Must leave the other player seeds'
+    return None
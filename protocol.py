@@ -0,0 +1,39 @@
+import struct
+
+import registry
+
+# The binary protocol, for clients that ask for BIN on ATH. Once the server
+# has answered with CAP BIN, everything either side sends is a frame: a big
+# endian 16 bit length, then an opcode byte, a game id byte and a payload,
+# the length counting everything after itself. A game is played with SRT,
+# BMP, MOV, BRD and FIN frames; anything else goes through as the text
+# command or reply it would have been, in TXT (or ERR) frames. Positions are
+# as in the text protocol, with the receiving player's houses at 0-5, and a
+# board is 14 bytes laid out the same way: own houses, own store, the other
+# player's houses and store.
+
+TXT = 0  # A text command or reply line. Game id 0.
+SRT = 1  # A game has started. Payload: the opponent's name.
+BMP = 2  # Your move.
+MOV = 3  # A move. Payload: one byte, the position.
+BRD = 4  # The board, after each move with BRD or when asked for with an
+         # empty BRD frame. Payload: 14 bytes.
+FIN = 5  # The game is over. Payload: one byte, a RESULTS index.
+ERR = 6  # An error. Payload: the message. Game id 0.
+LFG = 7  # Look for a game.
+
+HEADER = struct.Struct('>HBB')
+RESULTS = ('LSE', 'DRW', 'WIN')
+RESULT_CODES = {r: i for i, r in enumerate(RESULTS)}
+
+GAME_IDS = {name: game[0] for name, game in registry.GAMES.items()}
+GAME_NAMES = {i: name for name, i in GAME_IDS.items()}
+
+def frame(op, game_id=0, payload=b''):
+  return HEADER.pack(len(payload) + 2, op, game_id) + payload
+
+def parse(data):
+  # (op, game id, payload) for the bytes of a frame after its length.
+  if len(data) < 2:
+    raise ValueError('Frame too short')
+  return data[0], data[1], data[2:]
@@ -22,9 +22,15 @@ variable colours.
 Please report any bugs on help3001. Unless they're embarrassing ones. :-)
 """
 
+import optparse
 import random
 import copy
 import sys
+import time
+
+from kalah import LAP, OPPOSITE, ORDER, OWNER, PREFIX, STORES
+import endgame
+import rollout
 
 #a board position is a 2x7 list with the stores at the ends
 #a player is 0 or 1, and is used to index the board
@@ -89,6 +95,103 @@ def mancalaDisplay(b, m, r, f):
 
 #------------------------------------------------------------- This is the game mechanics code
 
+#The original mechanics below work on the 2x7 board and deepcopy it for every
+#move that ends in the store. MoveGenerator does the same on a flat board in
+#the server's layout (a bytearray, player 0's houses 0-5 and store 6, player
+#1's houses 7-12 and store 13), making and unmaking moves in place.
+
+HOUSES = ((0, 1, 2, 3, 4, 5), (7, 8, 9, 10, 11, 12))
+
+def flatten(b):
+#returns the flat board for a 2x7 board b
+  return bytearray(b[0] + b[1])
+
+def make(f, p, m):
+#sow house m for player p on flat board f, returning what unmake needs
+  x = f[m]
+  f[m] = 0
+  laps, rem = divmod(x, LAP)
+  if laps:
+    for i in ORDER[p][m]:
+      f[i] += laps
+  for i in PREFIX[p][m][rem]:
+    f[i] += 1
+  z = ORDER[p][m][rem - 1]
+  if z != STORES[p] and OWNER[z] == p and f[z] == 1 and f[OPPOSITE[z]] > 0:
+    captured = f[OPPOSITE[z]]
+    f[STORES[p]] += captured + 1
+    f[z] = 0
+    f[OPPOSITE[z]] = 0
+    return x | captured << 8
+  return x
+
+def unmake(f, p, m, undo):
+#undo make(f, p, m), given what it returned
+  x = undo & 255
+  captured = undo >> 8
+  laps, rem = divmod(x, LAP)
+  if captured:
+    z = ORDER[p][m][rem - 1]
+    f[STORES[p]] -= captured + 1
+    f[z] = 1
+    f[OPPOSITE[z]] = captured
+  for i in PREFIX[p][m][rem]:
+    f[i] -= 1
+  if laps:
+    for i in ORDER[p][m]:
+      f[i] -= laps
+  f[m] = x
+
+def endsInStore(f, p, m):
+  return ORDER[p][m][(f[m] - 1) % LAP] == STORES[p]
+
+class MoveGenerator:
+#generates the legal moves for a flat board, each a tuple of houses where
+#every house but the last ends in the store. Positions reached part way
+#through a chain are memoised for the rest of the call, so chains that
+#transpose are only followed once. It also counts positions and moves for
+#the branching factor.
+
+  def __init__(self):
+    self.memo = {}
+    self.positions = 0
+    self.options = 0
+
+  def moves(self, f, p):
+    ms = self.chains(f, p)
+    self.memo.clear()
+    self.positions += 1
+    self.options += len(ms)
+    return ms
+
+  def branchingFactor(self):
+    if self.positions == 0:
+      return 0
+    return self.options / self.positions
+
+  def chains(self, f, p):
+    zs = []
+    for m in HOUSES[p]:
+      if f[m] == 0:
+        continue
+      if endsInStore(f, p, m):
+        undo = make(f, p, m)
+        key = bytes(f)
+        ms = self.memo.get(key)
+        if ms is None:
+          ms = self.memo[key] = self.chains(f, p)
+        unmake(f, p, m, undo)
+        if ms:
+          zs += [(m,) + n for n in ms]
+          continue
+      zs.append((m,))
+    return zs
+
+  def move(self, f, p, ms):
+  #make the move ms for player p on flat board f
+    for m in ms:
+      make(f, p, m)
+
 def moves(b, p):
 #returns a list of legal moves for player p on board b
   zs = []
@@ -133,8 +236,17 @@ def sow(b, p, m, y, x):
     y = 11 - y
   return (y == 5, z)
 
-def mancala(n):
-  b = [[n] * 6 + [0] for p in [0, 1]]
+def monteCarlo(seconds, playouts):
+#returns a chooser that scores each move by random playouts from it, for up
+#to seconds (the server allows 10) or playouts games per move
+  r = rollout.Rollouts()
+  def choose(f, ms):
+    return r.choose(f, 0, ms, time.monotonic() + seconds, playouts)
+  return choose
+
+def mancala(n, choose=None, table=None):
+  f = flatten([[n] * 6 + [0] for p in [0, 1]])
+  g = MoveGenerator()
   bmps = 0
   while True:
     s = [i.strip() for i in sys.stdin.readline().split(' ')]
@@ -143,24 +255,60 @@ def mancala(n):
     if s[0] == 'BMP':
       bmps += 1
       if bmps == 1:
-        ms = moves(b, 0)
-        m = random.choice(ms)
+        ms = g.moves(f, 0)
+        m = None
+        if table:
+          #plays perfectly once few enough seeds are left
+          m = table.best(f, 0, ms)
+        if m is None and choose:
+          m = choose(f, ms)
+        elif m is None:
+          m = random.choice(ms)
         bmps -= len(m)
         for i in m:
           print('MOV %d' % i)
           sys.stdout.flush()
-        move(b, 0, m)
+        g.move(f, 0, m)
     elif s[0] == 'MOV':
-      mov = int(s[1]) - 7
-      waiting = (b[1][mov] + mov) % 13 == 6
-      move(b, 1, [mov])
+      g.move(f, 1, [int(s[1])])
+    elif s[0] == 'NEW':
+      #a new game, for a bot kept running between games by runner.py -k
+      f = flatten([[n] * 6 + [0] for p in [0, 1]])
+      bmps = 0
+      print('RDY')
+      sys.stdout.flush()
+    elif s[0] in ('WIN', 'LSE', 'DRW'):
+      #the game is over; wait for NEW, or the end of input
+      continue
     else:
       break
     #mancalaDisplay(b, m, r, f)
 
-    sys.stderr.write(str(b) + '\n')
+    sys.stderr.write(str([list(f[:7]), list(f[7:])]) + '\n')
+  sys.stderr.write('average branching factor %.2f\n' % g.branchingFactor())
 
 def main():
-  mancala(int(3))
+  parser = optparse.OptionParser()
+  parser.add_option('-s', '--seeds', dest='seeds', type='int', default=3,
+                    help="Seeds per house, for the server's Kalah variants")
+  parser.add_option('-m', '--monte-carlo', dest='monte_carlo',
+                    action='store_true',
+                    help='Pick moves by random playouts rather than at random')
+  parser.add_option('-t', '--time', dest='time', type='float', default=2.0,
+                    help='Seconds to spend per move with -m')
+  parser.add_option('-n', '--playouts', dest='playouts', type='int',
+                    help='Most playouts per candidate move with -m')
+  parser.add_option('-e', '--endgame', dest='endgame',
+                    help='Endgame table built by endgame.py')
+  (options, args) = parser.parse_args()
+
+  choose = None
+  if options.monte_carlo:
+    choose = monteCarlo(options.time, options.playouts)
+  table = None
+  if options.endgame:
+    table = endgame.EndgameTable.open(options.endgame)
+  mancala(options.seeds, choose, table)
 
-main()
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,20 @@
+import importlib
+
+# The games the server hosts, by the name clients use for them, as
+# (binary protocol game id, module, class, class attributes to override).
+# A game's module is only imported when its pool first has a game to play,
+# so hosting more of them costs nothing until they are played. Variants of
+# a game are the same class with different attributes, such as seeds.
+GAMES = {
+  'KLH': (1, 'kalah_game', 'KalahGame', {}),
+  'KL4': (2, 'kalah_game', 'KalahGame', {'seeds': 4}),
+  'KL6': (3, 'kalah_game', 'KalahGame', {'seeds': 6}),
+  'OWR': (4, 'oware_game', 'OwareGame', {}),
+}
+
+def load(name):
+  game_id, module, class_name, attrs = GAMES[name]
+  game_class = getattr(importlib.import_module(module), class_name)
+  if attrs:
+    game_class = type('%s_%s' % (class_name, name), (game_class,), attrs)
+  return game_class
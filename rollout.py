@@ -0,0 +1,165 @@
+import random
+import time
+
+from kalah import HOUSES, LAP, OPPOSITE, ORDER, OWNER, PITS, PREFIX, STORES
+from kalah import KalahBoard
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Monte Carlo move evaluation: every candidate move is scored by the share
+# of random games from the position after it that its player goes on to win
+# (draws count half). With numpy, thousands of games are played at once as
+# rows of an (N, 14) array in the server's board layout, one move per row
+# per step; without it the games are played one at a time on KalahBoard.
+
+MAX_SEEDS = 2 * HOUSES * KalahBoard.max_seeds
+
+def build_tables():
+  # delta[p, pos, n] is what sowing n seeds from pos does to the board for
+  # player p, and last[p, pos, n] is the pit the last of them lands in.
+  delta = numpy.zeros((2, PITS, MAX_SEEDS + 1, PITS), numpy.int16)
+  last = numpy.zeros((2, PITS, MAX_SEEDS + 1), numpy.intp)
+  for p in (0, 1):
+    for pos in range(PITS):
+      for n in range(1, MAX_SEEDS + 1):
+        laps, rem = divmod(n, LAP)
+        d = delta[p, pos, n]
+        d[list(ORDER[p][pos])] += laps
+        d[list(PREFIX[p][pos][rem])] += 1
+        d[pos] -= n
+        last[p, pos, n] = ORDER[p][pos][rem - 1]
+  return delta, last
+
+tables = None
+
+def get_tables():
+  global tables
+  if tables is None:
+    tables = build_tables() + (
+        numpy.array(STORES), numpy.array(OPPOSITE), numpy.array(OWNER))
+  return tables
+
+def sow(boards, player, pos):
+  # Makes the move pos for player[i] on every boards[i] in place, with the
+  # same rules as KalahBoard.sow. Returns which rows get another move.
+  delta, last_pit, stores, opposite, owner = get_tables()
+  rows = numpy.arange(len(boards))
+  n = boards[rows, pos]
+  boards += delta[player, pos, n]
+  last = last_pit[player, pos, n]
+  store = stores[player]
+  opp = opposite[last]
+  capture = ((owner[last] == player) & (last != store) &
+             (boards[rows, last] == 1) & (boards[rows, opp] > 0))
+  if capture.any():
+    rows = rows[capture]
+    boards[rows, store[capture]] += boards[rows, opp[capture]] + 1
+    boards[rows, last[capture]] = 0
+    boards[rows, opp[capture]] = 0
+  return last == store
+
+def finished(boards):
+  return ((boards[:, 0:HOUSES].sum(1) == 0) |
+          (boards[:, STORES[0] + 1:STORES[1]].sum(1) == 0))
+
+def outcome(boards):
+  # 1 where player 0 has more seeds on its side, -1 where player 1 does.
+  return numpy.sign(boards[:, :STORES[0] + 1].sum(1) -
+                    boards[:, STORES[0] + 1:].sum(1))
+
+def playouts(boards, player, rng):
+  # Plays every row out to the end of the game at random and returns
+  # outcome() for each. Finished rows are dropped as they finish, so each
+  # step only works on the games still going.
+  results = numpy.zeros(len(boards), numpy.int8)
+  rows = numpy.arange(len(boards))
+  while True:
+    done = finished(boards)
+    if done.any():
+      results[rows[done]] = outcome(boards[done])
+      live = ~done
+      rows, boards, player = rows[live], boards[live], player[live]
+      if not len(rows):
+        break
+    houses = numpy.where(player[:, None] == 0, boards[:, 0:HOUSES],
+                         boards[:, STORES[0] + 1:STORES[1]])
+    pos = (rng.random(houses.shape) * (houses > 0)).argmax(1)
+    pos += player * (HOUSES + 1)
+    again = sow(boards, player, pos)
+    player = numpy.where(again, player, 1 - player)
+  return results
+
+def python_playout(board, player, rng):
+  while not board.finished():
+    low = player * (HOUSES + 1)
+    pos = rng.choice([i for i in range(low, low + HOUSES) if board.pits[i]])
+    if not board.sow(player, pos):
+      player = 1 - player
+  a_pts, b_pts = board.points()
+  return (a_pts > b_pts) - (a_pts < b_pts)
+
+class Rollouts:
+  # Scores candidate moves for player within a time budget. A candidate is
+  # a sequence of houses as from random_bot.MoveGenerator. Playouts are run
+  # in rounds until the deadline or max_playouts per candidate; with numpy a
+  # round is about numpy_rows games shared between the candidates, which is
+  # where the per-step overhead stops mattering.
+  numpy_rows = 8192
+  python_batch = 8
+
+  def __init__(self, seed=None, use_numpy=True):
+    self.use_numpy = use_numpy and numpy is not None
+    self.rng = random.Random(seed)
+    if self.use_numpy:
+      self.np_rng = numpy.random.default_rng(seed)
+    self.playouts = 0
+
+  def after(self, pits, player, ms):
+    board = KalahBoard.from_pits(pits)
+    again = False
+    for m in ms:
+      again = board.sow(player, m)
+    return board, player if again else 1 - player
+
+  def evaluate(self, pits, player, candidates, deadline, max_playouts=None):
+    starts = [self.after(pits, player, ms) for ms in candidates]
+    totals = [0] * len(candidates)
+    played = 0
+    batch = self.python_batch
+    if self.use_numpy:
+      batch = max(self.numpy_rows // len(candidates), 16)
+    while (time.monotonic() < deadline and
+           (max_playouts is None or played < max_playouts)):
+      if self.use_numpy:
+        results = self.numpy_round(starts, batch)
+      else:
+        results = self.python_round(starts, batch)
+      for i, result in enumerate(results):
+        totals[i] += result
+      played += batch
+      self.playouts += batch * len(candidates)
+    sign = 1 if player == 0 else -1
+    # outcome is from player 0's side, in -1..1; map it to 0..1 for player.
+    return [(sign * t / played + 1) / 2 if played else 0.5 for t in totals]
+
+  def numpy_round(self, starts, batch):
+    boards = numpy.repeat(
+        numpy.array([list(b.pits) for b, p in starts], numpy.int16),
+        batch, axis=0)
+    player = numpy.repeat(numpy.array([p for b, p in starts]), batch)
+    results = playouts(boards, player, self.np_rng)
+    return results.reshape(len(starts), batch).sum(1, dtype=int).tolist()
+
+  def python_round(self, starts, batch):
+    return [sum(python_playout(KalahBoard.from_pits(b.pits), p, self.rng)
+                for i in range(batch))
+            for b, p in starts]
+
+  def choose(self, pits, player, candidates, deadline, max_playouts=None):
+    if len(candidates) == 1:
+      return candidates[0]
+    scores = self.evaluate(pits, player, candidates, deadline, max_playouts)
+    return candidates[max(range(len(candidates)), key=scores.__getitem__)]
@@ -1,102 +1,383 @@
+import asyncio
+import collections
+import logging
+import logging.handlers
 import optparse
-import os
-import queue
 import shlex
 import socket
-import subprocess
 import sys
-import threading
+import time
 
-def read_blocking(q, f):
-  try:
-    while f.readable():
-      l = f.readline()
-      if l:
-        if not isinstance(l, str):
-          l = l.decode('ascii')
-        print('RECV %s' % l.__repr__())
-        q.put((f, l.strip()))
-      else:
-        break
-  except:
-    pass
-  q.put((f, None))
+import protocol
+import registry
+
+# Plays games for a bot program over the server's line protocol. Everything
+# runs on one asyncio loop: each connection reads the server's lines and
+# hands DAT on to its bot, while a pump task passes the bot's lines back,
+# so no line goes through a thread or queue on the way.
 
-def pop_msg(buffer):
-  msg, sep, rest = buffer.partition('\n')
-  return msg.strip('\n\r'), rest
+log = logging.getLogger('runner')
+
+# How a server from before capabilities answers ATH with any.
+OLD_SERVER_ERR = 'ERR Wrong number of arguments for command'
+
+def setup_logging(level):
+  # Log records are held in memory and written out in blocks, or straight
+  # away for warnings, so logging every line doesn't cost a write each.
+  handler = logging.handlers.MemoryHandler(
+      1024, logging.WARNING, logging.StreamHandler(sys.stderr))
+  handler.target.setFormatter(
+      logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+  log.addHandler(handler)
+  log.setLevel(level)
 
 def send_cmd(server, cmd):
   try:
-    print("SEND %s" % cmd.strip().__repr__())
+    log.debug('SEND %r', cmd.strip())
     server.write(cmd.strip() + '\n')
     server.flush()
   except Exception as e:
-    print(e)
+    log.warning('Could not send %r: %s', cmd.strip(), e)
     return False
   return True
 
-def run_program(server, program, user, game):
+def auth(server, user, caps):
+  # Sends ATH asking for caps and returns the ones the server agreed to, or
+  # None if the login failed. A server from before capabilities turns the
+  # extra tokens down with OLD_SERVER_ERR, in which case ATH is sent again
+  # without them.
+  send_cmd(server, 'ATH %s %s %s' % (user + (' '.join(caps),)))
+  reply = server.readline().strip()
+  if reply.startswith('CAP'):
+    return set(reply.split(' ')[1:])
+  if reply != OLD_SERVER_ERR:
+    log.warning('%s', reply)
+    return None
   send_cmd(server, 'ATH %s %s' % user)
-  send_cmd(server, 'LFG %s' % game)
-
-  q = queue.Queue()
-  t_server = threading.Thread(target=read_blocking, args=(q, server))
-  t_server.daemon = True
-  t_server.start()
-  t_process = None
-  process = None
-  running = True
-  while running:
-    f, msg = q.get(timeout=1000000)
-
-    if msg is None:
-      if f == server:
-        print('Closed connection to server' % f)
-        running = False
-      elif process and f == process.stdout:
-        print('Closed connection to program')
+  return set()
+
+class Connection:
+  # A connection to the server on the loop. Once the server agrees to BIN
+  # it speaks the binary protocol, but frames are turned into the text
+  # lines they stand for and back, so the rest of the runner and the bots
+  # only ever see text.
+  def __init__(self, reader, writer):
+    self.reader = reader
+    self.writer = writer
+    self.caps = set()
+    self.binary = False
+    self.lines = collections.deque()
+
+  @classmethod
+  async def open(cls, address):
+    reader, writer = await asyncio.open_connection(*address)
+    return cls(reader, writer)
+
+  async def readline(self):
+    # The next line without its newline, or None once the server is gone.
+    if self.binary:
+      while not self.lines:
+        if not await self.read_frame():
+          return None
+      return self.lines.popleft()
+    try:
+      l = await self.reader.readline()
+    except ConnectionError:
+      l = b''
+    if not l:
+      return None
+    l = l.decode('ascii').strip()
+    log.debug('RECV %r', l)
+    return l
+
+  async def read_frame(self):
+    try:
+      header = await self.reader.readexactly(protocol.HEADER.size)
+      n, op, game_id = protocol.HEADER.unpack(header)
+      payload = await self.reader.readexactly(n - 2)
+    except (asyncio.IncompleteReadError, ConnectionError):
+      return False
+    log.debug('RECV %d %d %r', op, game_id, payload)
+    game = protocol.GAME_NAMES.get(game_id, '')
+    if op == protocol.SRT:
+      self.lines.append('SRT %s %s' % (game, payload.decode('ascii')))
+    elif op == protocol.BMP:
+      self.lines.append('DAT %s BMP' % game)
+    elif op == protocol.MOV:
+      self.lines.append('DAT %s MOV %d' % (game, payload[0]))
+    elif op == protocol.FIN:
+      result = protocol.RESULTS[payload[0]]
+      self.lines.append('DAT %s %s' % (game, result))
+      self.lines.append('FIN %s %s' % (game, result))
+    elif op == protocol.ERR:
+      self.lines.append('ERR %s' % payload.decode('ascii'))
+    elif op == protocol.TXT:
+      self.lines.append(payload.decode('ascii'))
+    return True
+
+  def encode(self, cmd):
+    log.debug('SEND %r', cmd)
+    if not self.binary:
+      return cmd.encode('ascii') + b'\n'
+    tok = cmd.split(' ')
+    game_id = protocol.GAME_IDS.get(tok[1]) if len(tok) > 1 else None
+    if (game_id and len(tok) == 4 and tok[0] == 'DAT' and tok[2] == 'MOV'
+        and tok[3].isdigit() and int(tok[3]) < 256):
+      return protocol.frame(protocol.MOV, game_id, bytes((int(tok[3]),)))
+    if game_id and len(tok) == 2 and tok[0] == 'LFG':
+      return protocol.frame(protocol.LFG, game_id)
+    return protocol.frame(protocol.TXT, 0, cmd.encode('ascii'))
+
+  async def auth(self, user, caps):
+    # As auth() on the loop. Returns False if the login failed or the
+    # server has gone.
+    self.send('ATH %s %s %s' % (user + (' '.join(caps),)))
+    reply = await self.readline()
+    if reply is None:
+      return False
+    if reply.startswith('CAP'):
+      self.caps = set(reply.split(' ')[1:])
+      self.binary = 'BIN' in self.caps
+    elif reply == OLD_SERVER_ERR:
+      self.send('ATH %s %s' % user)
+    else:
+      log.warning('%s', reply)
+      return False
+    return True
+
+  def send(self, *cmds):
+    self.writer.write(b''.join(map(self.encode, cmds)))
+
+  async def flush(self):
+    try:
+      await self.writer.drain()
+    except ConnectionError as e:
+      log.warning('Lost connection to server: %s', e)
+      return False
+    return True
+
+  async def close(self):
+    self.writer.close()
+    try:
+      await self.writer.wait_closed()
+    except ConnectionError:
+      pass
+
+class Bot:
+  # A bot process with its stdin and stdout as pipes on the loop.
+  read_size = 4096
+
+  def __init__(self, process):
+    self.process = process
+    self.partial = b''
+
+  @classmethod
+  async def start(cls, program):
+    process = await asyncio.create_subprocess_exec(
+        *shlex.split(program),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE)
+    return cls(process)
+
+  async def readlines(self):
+    # Every whole line the bot has written so far, waiting for at least
+    # one, or None once it has exited.
+    while b'\n' not in self.partial:
+      data = await self.process.stdout.read(self.read_size)
+      if not data:
+        return None
+      self.partial += data
+    data, sep, self.partial = self.partial.rpartition(b'\n')
+    lines = [l.decode('ascii').strip() for l in data.split(b'\n')]
+    log.debug('BOT %d %r', self.process.pid, lines)
+    return lines
+
+  def send(self, line):
+    try:
+      self.process.stdin.write(line.encode('ascii') + b'\n')
+    except ConnectionError as e:
+      log.warning('Could not write to program: %s', e)
+      return False
+    return True
+
+  def alive(self):
+    return self.process.returncode is None
+
+  async def close(self):
+    self.process.stdin.close()
+    try:
+      await asyncio.wait_for(self.process.wait(), 5)
+    except asyncio.TimeoutError:
+      self.process.kill()
+      await self.process.wait()
+
+class BotPool:
+  # Bot processes shared by the games a runner plays. With keep, a bot is
+  # left running between games and each game starts with NEW on its stdin,
+  # which it answers with RDY once it has reset. Without keep every game
+  # gets a fresh process, as bots that don't know NEW expect.
+  def __init__(self, program, keep=False):
+    self.program = program
+    self.keep = keep
+    self.idle = []
+    self.started = 0
+
+  async def get(self):
+    while self.idle:
+      bot = self.idle.pop()
+      if bot.alive():
+        bot.send('NEW')
+        return bot
+      await bot.close()
+    self.started += 1
+    bot = await Bot.start(self.program)
+    if self.keep:
+      bot.send('NEW')
+    return bot
+
+  async def put(self, bot):
+    if self.keep and bot.alive():
+      self.idle.append(bot)
+    else:
+      await bot.close()
+
+  async def close(self):
+    idle, self.idle = self.idle, []
+    for bot in idle:
+      await bot.close()
+
+async def pump(bot, server, game, keep):
+  # Passes the bot's moves to the server until the game is over. Moves the
+  # bot has written at once go in one write, as one BAT over text. A
+  # bot kept from an earlier game may still have lines from it to come, so
+  # everything up to its RDY is dropped.
+  ready = not keep
+  while True:
+    lines = await bot.readlines()
+    if lines is None:
+      log.warning('Closed connection to program')
+      return
+    if not ready:
+      if 'RDY' not in lines:
         continue
+      lines = lines[lines.index('RDY') + 1:]
+      ready = True
+    cmds = ['DAT %s %s' % (game, l) for l in lines]
+    if len(cmds) > 1 and 'BAT' in server.caps and not server.binary:
+      server.send('BAT %s' % ';'.join(cmds))
+    else:
+      server.send(*cmds)
+    if not await server.flush():
+      return
 
-    if f == server:
+async def play_game(server, pool, game):
+  # Plays one game on a connection that has sent LFG. Returns the result
+  # from FIN, or None if the game couldn't be played.
+  bot = None
+  pumping = None
+  try:
+    while True:
+      msg = await server.readline()
+      if msg is None:
+        log.warning('Closed connection to server')
+        return None
       tok = msg.split(' ')
       if tok[0] == 'SRT':
-        process = subprocess.Popen(
-            shlex.split(program),
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            universal_newlines=True,
-            bufsize=0)
-        t_process = threading.Thread(target=read_blocking,  args=(q, process.stdout))
-        t_process.daemon = True
-        t_process.start()
+        bot = await pool.get()
+        pumping = asyncio.ensure_future(pump(bot, server, game, pool.keep))
       elif tok[0] == 'FIN':
-        print("FINISHING")
-        running = False
-      elif tok[0] == 'DAT':
-        dat = ' '.join(tok[2:]) + '\n'
-        process.stdin.write(dat)
-        process.stdin.flush()
-    else:
-      if process and f == process.stdout:
-        msg = 'DAT %s %s' % (game, msg)
-      if not send_cmd(server, msg):
-        print('Lost connection to server')
-        running = False
-  if process:
-    process.communicate()
+        result = tok[2] if len(tok) > 2 else ''
+        log.info('Finished %s: %s', game, result)
+        return result
+      elif tok[0] == 'DAT' and bot:
+        bot.send(' '.join(tok[2:]))
+      elif tok[0] == 'ERR':
+        log.warning('%s', msg)
+        if not bot:
+          return None
+  finally:
+    if pumping:
+      pumping.cancel()
+      try:
+        await pumping
+      except asyncio.CancelledError:
+        pass
+    if bot:
+      await pool.put(bot)
 
+async def run_program(address, pool, user, game, games=1, results=None,
+                      caps=('BAT', 'BIN')):
+  # Plays games one after another on one connection, forever if games is
+  # 0. Each result is appended to results. caps are the capabilities to ask
+  # the server for.
+  server = await Connection.open(address)
+  played = 0
+  try:
+    if not await server.auth(user, caps):
+      return played
+    while not games or played < games:
+      server.send('LFG %s' % game)
+      if not await server.flush():
+        break
+      result = await play_game(server, pool, game)
+      if result is None:
+        break
+      played += 1
+      if results is not None:
+        results.append(result)
+  finally:
+    await server.close()
+  return played
+
+async def run_programs(address, program, user, game, keep, concurrency,
+                       games, caps):
+  # Plays on concurrency connections at once, sharing one pool of bots.
+  pool = BotPool(program, keep)
+  results = []
+  start = time.monotonic()
+  try:
+    await asyncio.gather(*[
+        run_program(address, pool, user, game, games, results, caps)
+        for i in range(concurrency)])
+  finally:
+    await pool.close()
+  elapsed = time.monotonic() - start
+  print('Played %d games in %.1fs with %d bot processes: %s' % (
+      len(results), elapsed, pool.started,
+      ', '.join('%s %d' % i for i in sorted(
+          collections.Counter(results).items()))))
 
 def register(server, register):
   send_cmd(server, 'REG %s %s' % register)
 
-def get_info(server, game, user):
-  send_cmd(server, 'ATH %s %s' % user)
-  send_cmd(server, 'IFO %s' % game)
-  print(server.readline().strip())
+def get_info(server, games, user, names=()):
+  # Prints the stats of each of names, or of user, in each of games. The
+  # lookups go in one BAT if the server can batch.
+  queries = [(game, name) for game in games for name in names or [None]]
+  cmds = ['IFO %s %s' % q if q[1] else 'IFO %s' % q[0] for q in queries]
+  caps = auth(server, user, ['BAT'])
+  if caps is None:
+    return
+  if len(cmds) > 1 and 'BAT' in caps:
+    send_cmd(server, 'BAT %s' % ';'.join(cmds))
+    replies = iter(server.readline, 'BAT FIN\n')
+  else:
+    for cmd in cmds:
+      send_cmd(server, cmd)
+    replies = (server.readline() for cmd in cmds)
+  for (game, name), reply in zip(queries, replies):
+    if len(queries) > 1:
+      print('%s %s: %s' % (game, name or user[0], reply.strip()))
+    else:
+      print(reply.strip())
 
-def get_board(server, game):
-  send_cmd(server, 'BRD %s' % game)
+def get_board(server, game, top=None, page=None):
+  cmd = 'BRD %s' % game
+  if top:
+    cmd += ' %d' % top
+    if page:
+      cmd += ' %d' % page
+  send_cmd(server, cmd)
   while True:
     l = server.readline().replace('\n', '')
     if l and l != 'BRD FIN':
@@ -104,6 +385,52 @@ def get_board(server, game):
     else:
       break
 
+def draw_board(pits):
+  # The board as the first player sees it, as the server draws it.
+  top = ' '.join(str(i) for i in reversed(pits[7:13]))
+  bottom = ' '.join(str(i) for i in pits[0:6])
+  return ' %s\n%d%s%d\n %s\n' % (top, pits[13], ' ' * len(top), pits[6],
+                                   bottom)
+
+def replay(server, number, delay=0):
+  # Fetches a game from the server's journal and plays it back move by
+  # move, with the board after each one if the game is known here.
+  send_cmd(server, 'RPL %d' % number)
+  header = server.readline().strip().split(' ')
+  if header[0] != 'RPL':
+    print(' '.join(header))
+    return
+  moves = [int(m) for m in server.readline().strip().split(' ')[2:]]
+  server.readline()
+  game, a, b, seeds, result = header[2:]
+  names = (a, b)
+  print('Game %d of %s, %s against %s with %s seeds' % (
+      number, game, a, b, seeds))
+  board = None
+  if game in registry.GAMES:
+    board = registry.load(game).board_class(int(seeds))
+  for pos in moves:
+    player = 0 if pos < 7 else 1
+    print('%s sows %d' % (names[player], pos % 7))
+    if board:
+      board.sow(player, pos)
+      print(draw_board(board.pits))
+    sys.stdout.flush()
+    time.sleep(delay)
+  print('%s: %s' % (a, result))
+
+def get_stats(server):
+  # The server's metrics, which it only gives to its own host.
+  send_cmd(server, 'STA')
+  while True:
+    line = server.readline().strip()
+    if not line or line == 'STA FIN':
+      return
+    if not line.startswith('STA '):
+      print(line)
+      return
+    print(line[4:])
+
 def main():
   parser = optparse.OptionParser()
   parser.add_option('-s', '--server', dest='server',
@@ -116,24 +443,70 @@ def main():
                     help='Get info for a client. Requires --user and --game option')
   parser.add_option('-b', '--board', dest='board', action='store_true',
                     help='Get scoreboard. Requires --game option')
+  parser.add_option('-t', '--top', dest='top', type='int',
+                    help='Only show this many scoreboard entries')
+  parser.add_option('--page', dest='page', type='int',
+                    help='Which page of --top entries to show, starting at 1')
   parser.add_option('-r', '--register', nargs=2, dest='register',
                     help='Register with username and password')
   parser.add_option('-g', '--game',  dest='game', default='KLH',
-                    help='Which game to play')
+                    help='Which game to play, or comma separated games '
+                         'for --info')
+  parser.add_option('-w', '--who', dest='who',
+                    help='Comma separated users to get --info for instead '
+                         'of --user')
+  parser.add_option('-n', '--games', dest='games', type='int', default=1,
+                    help='Games to play per connection with --program, '
+                         '0 to keep playing')
+  parser.add_option('-c', '--concurrency', dest='concurrency', type='int',
+                    default=1,
+                    help='Connections to play on at once with --program')
+  parser.add_option('-k', '--keep', dest='keep', action='store_true',
+                    help='Keep bot processes running between games. The '
+                         'bot must answer NEW with RDY')
+  parser.add_option('--text', dest='text', action='store_true',
+                    help='Play over the text protocol rather than binary '
+                         'frames, e.g. to read the lines with -vv')
+  parser.add_option('--boards', dest='boards', action='store_true',
+                    help='Have the server send the board after every move, '
+                         'to read with -vv')
+  parser.add_option('--replay', dest='replay', type='int',
+                    help='Play back this game from the server\'s journal')
+  parser.add_option('--delay', dest='delay', type='float', default=0,
+                    help='Seconds to wait between moves with --replay')
+  parser.add_option('--stats', dest='stats', action='store_true',
+                    help='Print the server\'s metrics, from its own host')
+  parser.add_option('-v', '--verbose', dest='verbose', action='count',
+                    default=0,
+                    help='Log more: once for each game, twice for every line')
   (options, args) = parser.parse_args()
   if not options.server:
     print('Need server')
     sys.exit(1)
-  server = socket.create_connection((options.server, 31337))
-  server_file = server.makefile('rw', encoding='ascii')
+  setup_logging([logging.WARNING, logging.INFO,
+                 logging.DEBUG][min(options.verbose, 2)])
+  address = (options.server, 31337)
   if options.program and options.user and options.game:
-    run_program(server_file, options.program, options.user, options.game)
-  elif options.register:
+    caps = ['BAT'] if options.text else ['BAT', 'BIN']
+    if options.boards:
+      caps.append('BRD')
+    asyncio.run(run_programs(address, options.program, options.user,
+                             options.game, options.keep, options.concurrency,
+                             options.games, caps))
+    return
+  server = socket.create_connection(address)
+  server_file = server.makefile('rw', encoding='ascii')
+  if options.register:
     register(server_file, options.register)
   elif options.info and options.game and options.user:
-    get_info(server_file, options.game, options.user)
+    get_info(server_file, options.game.split(','), options.user,
+             options.who.split(',') if options.who else ())
   elif options.board and options.game:
-    get_board(server_file, options.game)
+    get_board(server_file, options.game, options.top, options.page)
+  elif options.replay:
+    replay(server_file, options.replay, options.delay)
+  elif options.stats:
+    get_stats(server_file)
   else:
     print('Incorrect command')
   server.close()
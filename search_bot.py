@@ -0,0 +1,253 @@
+import optparse
+import random
+import sys
+import time
+
+import endgame
+from kalah import PITS, STORES
+from random_bot import HOUSES, endsInStore, flatten, make, unmake
+
+# Negamax alpha-beta bot for the same BMP/MOV stdin protocol as random_bot,
+# so runner.py can drive it with -p. Each BMP is answered with a single
+# sow; when that sow ends in the store the server asks again. Positions are
+# flat boards from random_bot (our side is player 0) and values are seeds
+# ahead from the point of view of the player to move.
+
+GAME_TIMEOUT = 10
+# Time kept back from the server's timeout for reading, writing and the
+# last node searched.
+SAFETY_MARGIN = 1.0
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+class Timeout(Exception):
+  pass
+
+def build_zobrist(seed=3001, max_seeds=256):
+  rng = random.Random(seed)
+  pits = tuple(tuple(rng.getrandbits(64) for c in range(max_seeds))
+               for i in range(PITS))
+  return pits, (rng.getrandbits(64), rng.getrandbits(64))
+
+ZOBRIST, ZOBRIST_SIDE = build_zobrist()
+
+def zobrist(f, p):
+  h = ZOBRIST_SIDE[p]
+  for i in range(PITS):
+    h ^= ZOBRIST[i][f[i]]
+  return h
+
+class TranspositionTable:
+  # A fixed number of slots indexed by the low bits of the hash. A slot is
+  # replaced by a search at least as deep, or by anything once its entry is
+  # from an earlier move's search.
+  def __init__(self, bits=20):
+    self.mask = (1 << bits) - 1
+    self.slots = [None] * (1 << bits)
+    self.generation = 0
+
+  def new_search(self):
+    self.generation += 1
+
+  def get(self, key):
+    entry = self.slots[key & self.mask]
+    if entry is not None and entry[0] == key:
+      return entry
+    return None
+
+  def put(self, key, depth, value, flag, move):
+    i = key & self.mask
+    entry = self.slots[i]
+    if (entry is None or entry[5] != self.generation or
+        depth >= entry[1] or entry[0] == key):
+      self.slots[i] = (key, depth, value, flag, move, self.generation)
+
+class Searcher:
+  # Iterative deepening over plies (single sows). A search that runs out of
+  # time is thrown away and the best move of the last finished depth is
+  # played. Positions covered by the endgame table, if given, are leaves
+  # with their exact value.
+  check_every = 1024
+
+  def __init__(self, tt_bits=20, max_depth=64, endgame=None):
+    self.tt = TranspositionTable(tt_bits)
+    self.endgame = endgame
+    self.max_depth = max_depth
+    self.nodes = 0
+    self.cut_off = False
+    self.total_nodes = 0
+    self.total_time = 0.0
+    self.deadline = None
+
+  def evaluate(self, f, p):
+    return f[STORES[p]] - f[STORES[1 - p]]
+
+  def finished(self, f):
+    return (not any(f[i] for i in HOUSES[0]) or
+            not any(f[i] for i in HOUSES[1]))
+
+  def final_score(self, f, p):
+    # As in KalahGame, seeds left in a side's houses count for that side.
+    own = sum(f[i] for i in HOUSES[p]) + f[STORES[p]]
+    other = sum(f[i] for i in HOUSES[1 - p]) + f[STORES[1 - p]]
+    return own - other
+
+  def ordered_moves(self, f, p, first):
+    # The table's best move first, then moves ending in the store, then
+    # the rest from the store end of the row.
+    moves = [m for m in reversed(HOUSES[p]) if f[m]]
+    moves.sort(key=lambda m: not endsInStore(f, p, m))
+    if first in moves:
+      moves.remove(first)
+      moves.insert(0, first)
+    return moves
+
+  def search(self, f, p, depth, alpha, beta, root=False):
+    self.nodes += 1
+    if self.nodes % self.check_every == 0 and self.deadline is not None:
+      if time.monotonic() >= self.deadline:
+        raise Timeout()
+    if self.finished(f):
+      return self.final_score(f, p), None
+    if self.endgame is not None and not root:
+      value = self.endgame.value(f, p)
+      if value is not None:
+        return value, None
+    if depth == 0:
+      self.cut_off = True
+      return self.evaluate(f, p), None
+
+    key = zobrist(f, p)
+    entry = self.tt.get(key)
+    first = None
+    if entry is not None:
+      first = entry[4]
+      if entry[1] >= depth and not root:
+        value, flag = entry[2], entry[3]
+        if (flag == EXACT or (flag == LOWER and value >= beta) or
+            (flag == UPPER and value <= alpha)):
+          # The entry may have come from a search that was cut off too.
+          self.cut_off = True
+          return value, first
+
+    original_alpha = alpha
+    best, best_move = None, None
+    for m in self.ordered_moves(f, p, first):
+      again = endsInStore(f, p, m)
+      undo = make(f, p, m)
+      try:
+        if again:
+          value = self.search(f, p, depth - 1, alpha, beta)[0]
+        else:
+          value = -self.search(f, 1 - p, depth - 1, -beta, -alpha)[0]
+      finally:
+        unmake(f, p, m, undo)
+      if best is None or value > best:
+        best, best_move = value, m
+      if value > alpha:
+        alpha = value
+      if alpha >= beta:
+        break
+
+    if best <= original_alpha:
+      flag = UPPER
+    elif best >= beta:
+      flag = LOWER
+    else:
+      flag = EXACT
+    self.tt.put(key, depth, best, flag, best_move)
+    return best, best_move
+
+  def choose(self, f, p, seconds=None, max_depth=None):
+    # Returns (move, value, depth reached). With seconds, the search stops
+    # deepening once half the time is gone, as the next depth would most
+    # likely not finish.
+    start = time.monotonic()
+    self.deadline = start + seconds if seconds is not None else None
+    self.nodes = 0
+    self.tt.new_search()
+    moves = [m for m in HOUSES[p] if f[m]]
+    result = (moves[0], None, 0)
+    try:
+      for depth in range(1, (max_depth or self.max_depth) + 1):
+        self.cut_off = False
+        value, move = self.search(f, p, depth, -PITS * 256, PITS * 256,
+                                  root=True)
+        result = (move, value, depth)
+        # Deeper searches add nothing once every line reached the end of
+        # the game.
+        if not self.cut_off:
+          break
+        if seconds is not None and time.monotonic() - start > seconds / 2:
+          break
+    except Timeout:
+      pass
+    finally:
+      self.total_nodes += self.nodes
+      self.total_time += time.monotonic() - start
+    return result
+
+  def nodes_per_second(self):
+    if not self.total_time:
+      return 0
+    return self.total_nodes / self.total_time
+
+def bot(board, player, rng):
+  # For tournament.py: a fixed depth search, so results don't depend on how
+  # busy the machine is.
+  return tournament_searcher.choose(board.pits, player, max_depth=6)[0]
+
+tournament_searcher = Searcher(tt_bits=16)
+
+def mancala(n, seconds, max_depth, table=None):
+  f = flatten([[n] * 6 + [0] for p in [0, 1]])
+  searcher = Searcher(endgame=table)
+  while True:
+    s = [i.strip() for i in sys.stdin.readline().split(' ')]
+    if s[0] == 'BMP':
+      start = time.monotonic()
+      move, value, depth = searcher.choose(f, 0, seconds, max_depth)
+      print('MOV %d' % move)
+      sys.stdout.flush()
+      elapsed = time.monotonic() - start
+      sys.stderr.write('move %d value %s depth %d nodes %d %.0f nodes/s\n' % (
+          move, value, depth, searcher.nodes,
+          searcher.nodes / elapsed if elapsed else 0))
+      make(f, 0, move)
+    elif s[0] == 'MOV':
+      make(f, 1, int(s[1]))
+    elif s[0] == 'NEW':
+      # A new game, when runner.py -k keeps the bot running. The
+      # transposition table is kept, as it stays valid between games.
+      f = flatten([[n] * 6 + [0] for p in [0, 1]])
+      print('RDY')
+      sys.stdout.flush()
+    elif s[0] in ('WIN', 'LSE', 'DRW'):
+      # The game is over; wait for NEW, or the end of input.
+      continue
+    else:
+      break
+  sys.stderr.write('searched %d nodes in %.2fs, %.0f nodes/s\n' % (
+      searcher.total_nodes, searcher.total_time,
+      searcher.nodes_per_second()))
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-s', '--seeds', dest='seeds', type='int', default=3,
+                    help="Seeds per house, for the server's Kalah variants")
+  parser.add_option('-t', '--time', dest='time', type='float', default=2.0,
+                    help='Seconds to spend per move, at most %g' % (
+                        GAME_TIMEOUT - SAFETY_MARGIN))
+  parser.add_option('-d', '--depth', dest='depth', type='int',
+                    help='Deepest search in plies')
+  parser.add_option('-e', '--endgame', dest='endgame',
+                    help='Endgame table built by endgame.py')
+  (options, args) = parser.parse_args()
+  table = None
+  if options.endgame:
+    table = endgame.EndgameTable.open(options.endgame)
+  mancala(options.seeds, min(options.time, GAME_TIMEOUT - SAFETY_MARGIN),
+          options.depth, table)
+
+if __name__ == '__main__':
+  main()
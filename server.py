@@ -1,446 +1,731 @@
+import bisect
+import collections
+import concurrent.futures
+import cProfile
+import functools
 import hashlib
+import heapq
+import hmac
+import logging
+import optparse
 import os
-import random
-import select
-import socket
+import pstats
+import queue
+import signal
 import sys
+import threading
 import time
-import traceback
+import uuid
 
 from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import journal
+from matchmaking import MatchQueue, Ratings
+import metrics
+from network import FrameBuffer, FrameTooLong, LineBuffer, LineTooLong
+from network import NetworkEngine, raise_fd_limit
+import protocol
+import registry
+
+log = logging.getLogger('server')
+
+# How long each kind of call to Mongo takes. Logins, registrations and
+# results writes are made from other threads than the game loop's.
+FIND_USER_TIME = metrics.registry.histogram('mongo.find_user', threaded=True)
+UPDATE_USER_TIME = metrics.registry.histogram('mongo.update_user',
+                                              threaded=True)
+INSERT_USER_TIME = metrics.registry.histogram('mongo.insert_user',
+                                              threaded=True)
+RESULTS_WRITE_TIME = metrics.registry.histogram('mongo.results_write',
+                                                threaded=True)
+SCOREBOARD_LOAD_TIME = metrics.registry.histogram('mongo.scoreboard_load')
+
+# Mongo's error codes for a write that would duplicate a unique key.
+DUPLICATE_KEY_CODES = (11000, 11001)
+
+# STA is only answered on connections from these.
+ADMIN_ADDRESSES = ('127.0.0.1', '::1')
+
+# Functions shown from a profile with --profile.
+PROFILE_LINES = 30
 
 class Client:
   def __init__(self, handle, addr):
     self.handle = handle
     self.addr = addr
     self.name = None
+    self.caps = set()
+    # What the client asked for on an ATH still being checked, or None.
+    self.asked_caps = None
+    self.binary = False
     self.error = ''
-    self.read_buffer = ''
+    self.read_buffer = LineBuffer()
+    self.pending = False
+
+  def use_binary(self):
+    # Switches the connection to the binary protocol, reading anything
+    # already received after the switch as frames.
+    data = self.read_buffer.drain()
+    self.read_buffer = FrameBuffer()
+    self.read_buffer.feed(data)
+    self.binary = True
 
   def write_data(self, data):
-    try:
-      self.handle.sendall((data + '\n').encode('ascii'))
-    except Exception as e:
-      print('Could not send data for client %s: %s' % (self, e))
-      return False
-    return True
+    if self.binary:
+      return self.handle.write(
+          protocol.frame(protocol.TXT, 0, data.encode('ascii')))
+    return self.handle.write((data + '\n').encode('ascii'))
+
+  def write_frame(self, op, game_name, payload=b''):
+    return self.handle.write(protocol.HEADER.pack(
+        len(payload) + 2, op, protocol.GAME_IDS[game_name]) + payload)
 
   def write_error(self):
     if self.error:
-        print('Client error: %s' % self.error)
-        self.write_data('ERR ' + self.error)
+        log.info('Client error: %s', self.error)
+        if self.binary:
+          self.handle.write(protocol.frame(protocol.ERR, 0,
+                                           self.error.encode('ascii')))
+        else:
+          self.write_data('ERR ' + self.error)
         self.error = ''
 
+  def send_start(self, game_name, opponent):
+    if self.binary:
+      return self.write_frame(protocol.SRT, game_name,
+                              opponent.encode('ascii'))
+    return self.write_data('SRT %s %s' % (game_name, opponent))
+
+  def send_turn(self, game_name):
+    if self.binary:
+      return self.write_frame(protocol.BMP, game_name)
+    return self.write_data('DAT %s BMP' % game_name)
+
+  def send_move(self, game_name, pos):
+    if self.binary:
+      return self.write_frame(protocol.MOV, game_name, bytes((pos,)))
+    return self.write_data('DAT %s MOV %d' % (game_name, pos))
+
+  def send_result(self, game_name, result):
+    # The text protocol tells the bot with DAT and the runner with FIN.
+    if self.binary:
+      return self.write_frame(protocol.FIN, game_name,
+                              bytes((protocol.RESULT_CODES[result],)))
+    self.write_data('DAT %s %s' % (game_name, result))
+    return self.write_data('FIN %s %s' % (game_name, result))
+
   def add_data(self, data):
-    self.read_buffer += data
+    self.read_buffer.feed(data)
 
   def has_msg(self):
-    return self.read_buffer.find('\n') != -1
+    if self.binary:
+      return self.read_buffer.has_frame()
+    return self.read_buffer.has_line()
 
   def pop_msg(self):
-    msg, sep, rest = self.read_buffer.partition('\n')
-    if msg:
-      self.read_buffer = rest
-      msg = msg.strip()
-      return msg.strip()
-    else:
-      return None
+    # A line, or (op, game id, payload) in binary mode.
+    try:
+      if self.binary:
+        return protocol.parse(self.read_buffer.pop_frame())
+      return self.read_buffer.pop_line().strip()
+    except LineTooLong:
+      self.error = 'Command too long'
+    except FrameTooLong:
+      self.error = 'Frame too long'
+    except UnicodeDecodeError:
+      self.error = 'Commands must be ascii'
+    except ValueError:
+      self.error = 'Malformed command'
+    return None
+
+class TaskPool:
+  # Slow work for a client, such as a database call, a KDF or reading the
+  # journal, runs on a thread pool once start() has been given a way to
+  # call back into the event loop; until then it runs inline. While it is
+  # in flight the client is marked pending and its remaining input waits.
+  # done(client, result) then answers the client on the loop, and
+  # resume(client, ok) carries on with its input.
+  def __init__(self, resume=None):
+    self.resume = resume
+    self.executor = None
+    self.call_soon_threadsafe = None
+
+  def start(self, call_soon_threadsafe, workers=4):
+    self.call_soon_threadsafe = call_soon_threadsafe
+    self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+  def close(self):
+    if self.executor:
+      self.executor.shutdown()
+
+  def run(self, client, work, done):
+    if not self.executor:
+      return done(client, work())
+    client.pending = True
+    future = self.executor.submit(work)
+    future.add_done_callback(
+        lambda f: self.call_soon_threadsafe(self.finish, client, f, done))
+    return True
+
+  def finish(self, client, future, done):
+    client.pending = False
+    try:
+      result = done(client, future.result())
+    except Exception:
+      log.exception('Handling a request off the loop')
+      client.error = 'Internal error'
+      result = False
+    if self.resume:
+      self.resume(client, result)
 
 class AuthManager:
-  def __init__(self, users_collection):
-    self.name_to_password = {}
+  # Password checks and registrations, run on tasks, a TaskPool. Verified
+  # passwords are remembered in name_to_password as keyed digests for
+  # cache_ttl seconds, so a reconnect skips both the database and the KDF.
+  # logged_in(client) is called on the loop once a client's password has
+  # checked out.
+  default_scheme = 'pbkdf2_sha256'
+  pbkdf2_iterations = 100000
+  cache_ttl = 600
+  cache_size = 10000
+
+  def __init__(self, users_collection, tasks, logged_in=None):
+    self.name_to_password = collections.OrderedDict()
     self.users_collection = users_collection
+    self.tasks = tasks
+    self.logged_in = logged_in
+    self.cache_key = os.urandom(32)
+
+  def hash_password(self, password, scheme, salt=None):
+    if scheme == 'sha512':
+      return {'password_digest': hashlib.sha512(password).hexdigest()}
+    if scheme == 'pbkdf2_sha256':
+      salt = salt or os.urandom(16)
+      digest = hashlib.pbkdf2_hmac(
+          'sha256', password, salt, self.pbkdf2_iterations)
+      return {
+        'password_digest': digest.hex(),
+        'password_salt': salt.hex(),
+      }
+    raise ValueError('Unknown hash scheme %s' % scheme)
+
+  def check_password(self, user, password):
+    scheme = user.get('hash_scheme', 'sha512')
+    salt = user.get('password_salt')
+    if salt:
+      salt = bytes.fromhex(salt)
+    digest = self.hash_password(password, scheme, salt)['password_digest']
+    return hmac.compare_digest(digest, user['password_digest'])
+
+  def cache_digest(self, password):
+    return hmac.new(self.cache_key, password.encode('ascii'), 'sha256').digest()
+
+  def cache_lookup(self, name):
+    entry = self.name_to_password.get(name)
+    if entry is None:
+      return None
+    digest, expiry = entry
+    if expiry < time.monotonic():
+      del self.name_to_password[name]
+      return None
+    self.name_to_password.move_to_end(name)
+    return digest
+
+  def cache_store(self, name, password):
+    self.name_to_password[name] = (
+        self.cache_digest(password), time.monotonic() + self.cache_ttl)
+    self.name_to_password.move_to_end(name)
+    while len(self.name_to_password) > self.cache_size:
+      self.name_to_password.popitem(last=False)
 
   def register(self, client, name, password):
-    print('Register %s' % (name))
-    if (self.users_collection.find({'ip_address':client.addr}).count() != 0 and
-        client.addr != '127.0.0.1'):
-      client.error = 'Only one registration per ip'
-      return False
+    log.info('Register %s', name)
     if len(name) > 20:
       client.error = 'Names must be no more than 20 characters'
       return False
+    return self.tasks.run(
+        client,
+        functools.partial(self.insert_user, client.addr, name, password),
+        self.request_done)
+
+  def insert_user(self, addr, name, password):
+    start = time.perf_counter()
+    registered = self.users_collection.find({'ip_address':addr}).count()
+    FIND_USER_TIME.observe(time.perf_counter() - start)
+    if registered != 0 and addr != '127.0.0.1':
+      return 'Only one registration per ip'
+    user = {
+      'username': name,
+      'hash_scheme': self.default_scheme,
+      'ip_address': addr,
+    }
+    user.update(self.hash_password(password.encode('ascii'), self.default_scheme))
+    start = time.perf_counter()
     try:
-      password_digest = hashlib.sha512()
-      password_digest.update(password.encode('ascii'))
-      self.users_collection.insert({
-        'username': name,
-        'password_digest': password_digest.hexdigest(),
-        'ip_address': client.addr,
-        'scores': []
-      })
-      return True
+      self.users_collection.insert(user)
+      return ''
     except DuplicateKeyError:
-      client.error = 'Already registered'
-      return False
+      return 'Already registered'
+    finally:
+      INSERT_USER_TIME.observe(time.perf_counter() - start)
+
+  def request_done(self, client, error):
+    client.error = error
+    return not error
 
   def auth(self, client, name, password):
-    print('Client auth %s' % (name))
-    password_digest = hashlib.sha512()
-    password_digest.update(password.encode('ascii'))
-    user = self.users_collection.find_one({'username':name})
-    if user == None:
+    log.info('Client auth %s', name)
+    cached = self.cache_lookup(name)
+    if cached is not None:
+      if hmac.compare_digest(cached, self.cache_digest(password)):
+        self.login(client, name)
+        return True
       client.error = 'Invalid credentials'
       return False
-    if password_digest.hexdigest() == user['password_digest']:
-      client.name = name
-      return True
-    else:
-      client.error = 'Invalid credentials'
+    return self.tasks.run(
+        client,
+        functools.partial(self.verify_user, name, password),
+        functools.partial(self.auth_done, name, password))
+
+  def verify_user(self, name, password):
+    password = password.encode('ascii')
+    start = time.perf_counter()
+    user = self.users_collection.find_one({'username':name})
+    FIND_USER_TIME.observe(time.perf_counter() - start)
+    if user == None or not self.check_password(user, password):
+      return 'Invalid credentials'
+    if user.get('hash_scheme', 'sha512') != self.default_scheme:
+      # Upgrade legacy digests now that we have the plaintext.
+      update = self.hash_password(password, self.default_scheme)
+      update['hash_scheme'] = self.default_scheme
+      start = time.perf_counter()
+      self.users_collection.update({'_id': user['_id']}, {'$set': update})
+      UPDATE_USER_TIME.observe(time.perf_counter() - start)
+    return ''
+
+  def auth_done(self, name, password, client, error):
+    if error:
+      client.error = error
       return False
+    self.login(client, name)
+    self.cache_store(name, password)
+    return True
 
-class Game:
-  timeout = 10
+  def login(self, client, name):
+    client.name = name
+    if self.logged_in:
+      self.logged_in(client)
 
-  def __init__(self, a, b, game_name):
-    self.a = a
-    self.b = b
-    self.a.waiting = None
-    self.b.waiting = None
-    self.game_name = game_name
-    self.finished = False
-    self.result = None
-    msg = 'SRT %s ' % game_name
-    self.a.write_data(msg + self.b.name)
-    self.b.write_data(msg + self.a.name)
-    print('Game made %s %s' % (self.a.name, self.b.name))
+class DeadlineScheduler:
+  # Min-heap of [deadline, seq, item, active] entries. Disarmed entries are
+  # left in place and skipped when popped; the heap is compacted once they
+  # outnumber the live ones.
+  compact_threshold = 64
+
+  def __init__(self):
+    self.heap = []
+    self.seq = 0
+    self.disarmed = 0
 
   def get_ts(self):
     return time.monotonic()
 
-  def client_won(self, client):
-    self.finished = True
-    self.result = client
-    self.a.waiting = None
-    self.b.waiting = None
+  def arm(self, deadline, item):
+    self.seq += 1
+    entry = [deadline, self.seq, item, True]
+    heapq.heappush(self.heap, entry)
+    return entry
+
+  def disarm(self, entry):
+    if entry[3]:
+      entry[3] = False
+      self.disarmed += 1
+      if (self.disarmed > self.compact_threshold and
+          self.disarmed * 2 > len(self.heap)):
+        self.heap = [e for e in self.heap if e[3]]
+        heapq.heapify(self.heap)
+        self.disarmed = 0
+
+  def skip_disarmed(self):
+    while self.heap and not self.heap[0][3]:
+      heapq.heappop(self.heap)
+      self.disarmed -= 1
+
+  def next_timeout(self):
+    self.skip_disarmed()
+    if not self.heap:
+      return None
+    return max(self.heap[0][0] - self.get_ts(), 0)
 
-  def update(self):
+  def pop_expired(self):
     ts = self.get_ts()
-    timed_out_client = None
-    if self.a.waiting and ts - self.a.waiting > self.timeout:
-      timed_out_client = self.a
-    if self.b.waiting and ts - self.b.waiting > self.timeout:
-      if not timed_out_client or self.b.waiting < self.a.waiting:
-        timed_out_client = self.b
-    if timed_out_client:
-      print('Client timed out in %s' % self.game_name)
-      self.client_won(self.get_opposite(timed_out_client))
-
-  def send_results(self):
-    win_name = 'noone'
-    if self.result:
-      win_name = self.result.name
-    print('Sending results for game %s: %s won' % (self.game_name, win_name))
-    g_prefix = 'DAT %s ' % self.game_name
-    s_prefix = 'FIN %s ' % self.game_name
-    win_str = 'WIN'
-    lose_str = 'LSE'
-    draw_str =  'DRW'
-    if self.result:
-      win = self.result
-      lose = self.get_opposite(self.result)
-      win.write_data(g_prefix + win_str)
-      lose.write_data(g_prefix + lose_str)
-      win.write_data(s_prefix + win_str)
-      lose.write_data(s_prefix + lose_str)
-    else:
-      self.a.write_data(g_prefix + draw_str)
-      self.b.write_data(g_prefix + draw_str)
-      self.a.write_data(s_prefix + draw_str)
-      self.b.write_data(s_prefix + draw_str)
-
-  def get_opposite(self, p):
-    if p == self.a:
-      return self.b
-    else:
-      return self.a
-
-  def remove_client(self, client):
-    if not self.finished:
-      self.finished = True
-      self.result = self.get_opposite(client)
-
-  def client_data(self, client, tok):
-    if not self.handle_data(client, tok):
-      self.client_won(self.get_opposite(client))
-      return False
-    if self.has_won():
-      self.client_won(self.winner())
-    return True
-
-  def handle_data(self, client, tok):
-    return True
-
-  def has_won(self):
-    return False
-
-  def winner(self):
-    return None
-
-class KalahGame(Game):
-  a_store = 6
-  b_store = 13
-
-  def __init__(self, a, b, game_name):
-    Game.__init__(self, a, b, game_name)
-    self.board = [3] * 14
-    self.board[self.a_store] = 0
-    self.board[self.b_store] = 0
-    self.a.low_idx = 0
-    self.a.high_idx = 7
-    self.a.store = self.a_store
-    self.b.low_idx = 7
-    self.b.high_idx = 14
-    self.b.store = self.b_store
-    self.wait_for_client(self.a)
-
-  def handle_data(self, client, tok):
-    if len(tok) != 4:
-      client.error = 'Malformed command'
-      return False
-    cmd, pos = tok[2], int(tok[3])
-    pos = self.normalise_pos_for_client(client, pos)
-    if cmd != 'MOV':
-      client.error = 'Malformed command'
-      return False
-    if pos < client.low_idx or pos >= client.high_idx:
-      client.error = 'OOB index'
-      return False
-    if self.board[pos] == 0:
-      client.error = 'Must move non-zero number of seeds'
-      return False
-    if not self.client_owns_house(client, pos):
-      client.error = 'Must move own seeds'
-      return False
-    if not client.waiting:
-      client.error = 'Not your turn'
-      return False
-    client.waiting = None
-    opposite_client = self.get_opposite(client)
-    if self.move_seeds(client, pos):
-      self.update_client(opposite_client, pos)
-      if not self.has_won():
-        self.wait_for_client(client)
+    expired = []
+    self.skip_disarmed()
+    while self.heap and self.heap[0][0] <= ts:
+      entry = heapq.heappop(self.heap)
+      entry[3] = False
+      expired.append(entry[2])
+      self.skip_disarmed()
+    return expired
+
+class ResultsWriter:
+  # Write-behind persistence for finished games. The game loop only enqueues;
+  # a background thread drains the queue in batches and applies them as one
+  # unordered bulk write of upserts into the results collection. The game
+  # loop never waits: once the queue is full, results are added up in
+  # overflow instead, by user and game, and go out with the next batch.
+  batch_size = 500
+  retries = 3
+
+  def __init__(self, results_collection, max_backlog=10000):
+    self.results_collection = results_collection
+    self.queue = queue.Queue(max_backlog)
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.lock = threading.Lock()
+    self.recorded = 0
+    self.written = 0
+    self.dropped = 0
+    self.overflow = {}
+    self.overflow_games = 0
+    self.overflowed = 0
+    self.flushes = 0
+    self.flush_time_total = 0.0
+    self.flush_time_max = 0.0
+    self.last_flush_time = 0.0
+
+  def start(self):
+    self.thread.start()
+
+  def record(self, game_name, results):
+    # The put is under the lock so that whenever overflow has anything, the
+    # queue still has something for the writer to wake up to.
+    with self.lock:
+      try:
+        self.queue.put_nowait((game_name, results))
+      except queue.Full:
+        if not self.overflow_games:
+          log.warning('Results backlog full, adding up results in memory')
+        add_results(self.overflow, game_name, results)
+        self.overflow_games += 1
+        self.overflowed += 1
+    self.recorded += 1
+
+  def close(self):
+    if self.thread.is_alive():
+      self.queue.put(None)
+      self.thread.join()
+
+  def stats(self):
+    with self.lock:
+      flushes = self.flushes
+      return {
+        'queue_depth': self.queue.qsize(),
+        'recorded': self.recorded,
+        'written': self.written,
+        'dropped': self.dropped,
+        'overflowed': self.overflowed,
+        'flushes': flushes,
+        'flush_time_last': self.last_flush_time,
+        'flush_time_max': self.flush_time_max,
+        'flush_time_avg': self.flush_time_total / flushes if flushes else 0.0,
+      }
+
+  def run(self):
+    running = True
+    while running:
+      batch = [self.queue.get()]
+      while len(batch) < self.batch_size:
+        try:
+          batch.append(self.queue.get_nowait())
+        except queue.Empty:
+          break
+      if batch[-1] is None:
+        running = False
+      batch = [i for i in batch if i is not None]
+      with self.lock:
+        overflow, self.overflow = self.overflow, {}
+        games, self.overflow_games = self.overflow_games, 0
+      deltas = {}
+      for game_name, results in batch:
+        add_results(deltas, game_name, results)
+      for key, delta in overflow.items():
+        total = deltas.setdefault(key, {'wins': 0, 'draws': 0, 'losses': 0})
+        for field, n in delta.items():
+          total[field] += n
+      if deltas:
+        self.flush(deltas, len(batch) + games)
+
+  def flush(self, deltas, games):
+    batch_id = uuid.uuid4().hex
+    start = time.monotonic()
+    for attempt in range(self.retries):
+      try:
+        deltas = self.write(deltas, batch_id)
+      except Exception:
+        log.exception('Writing results, attempt %d', attempt + 1)
+        time.sleep(0.1 * 2 ** attempt)
+        continue
+      if not deltas:
+        break
+      log.info('Writing %d results again after racing another writer',
+               len(deltas))
     else:
-      self.update_client(opposite_client, pos)
-      if not self.has_won():
-        self.wait_for_client(opposite_client)
-    self.a.write_data(self.print_board(self.a))
-    self.b.write_data(self.print_board(self.b))
-    return True
-
-  def normalise_pos_for_client(self, client, pos):
-    if not self.client_owns_house(client, pos):
-      return (pos + 7) % 14
-    return pos
-
-  def print_board(self, client):
-    opp = self.get_opposite(client)
-    top_str = ' '.join(
-        str(i) for i in reversed(self.board[opp.low_idx:opp.high_idx - 1]))
-    bot_str = ' '.join(
-        str(i) for i in self.board[client.low_idx:client.high_idx - 1])
-    stores = [self.board[self.b_store], self.board[self.a_store]]
-    if client != self.a:
-      stores.reverse()
-    return ' %s\n%d%s%d\n %s\n' % (
-        top_str, stores[0], ' ' * len(top_str), stores[1], bot_str)
-
-  def move_seeds(self, client, pos):
-    num_seeds = self.board[pos]
-    self.board[pos] = 0
-
-    npos = pos
-    for i in range(num_seeds):
-      npos = (npos + 1) % 14
-      if npos == self.skip_store(client):
-        npos = (npos + 1) % 14
-      self.board[npos] += 1
-    if not self.is_store(npos):
-      opp = self.get_opposite_house(npos)
-      if (self.client_owns_house(client, npos) and
-          self.board[npos] == 1 and self.board[opp] > 0):
-        self.board[client.store] += self.board[opp] + 1
-        self.board[npos] = 0
-        self.board[opp] = 0
+      log.error('Dropping %d results after %d attempts', games, self.retries)
+      with self.lock:
+        self.dropped += games
+      return
+    elapsed = time.monotonic() - start
+
+    with self.lock:
+      self.written += games
+      self.flushes += 1
+      self.flush_time_total += elapsed
+      self.flush_time_max = max(self.flush_time_max, elapsed)
+      self.last_flush_time = elapsed
+
+  def write(self, deltas, batch_id):
+    # All three counts are incremented, zeros too, so a document made by the
+    # upsert always has them. Each document is stamped with the batch that
+    # last counted into it, and only matched if the stamp is another batch's.
+    # That makes a retry safe after part of the bulk went in, or after a
+    # lost connection leaves it unknown how much did. For a document already
+    # counted, the upsert tries to insert a second one and fails on
+    # RESULTS_KEY. So does an upsert that lost a race with another writer
+    # to make a new document, without counting anything, so the document is
+    # read back to tell the two apart. Returns the deltas still to be
+    # written, those that lost such a race.
+    keys = list(deltas)
+    bulk = self.results_collection.initialize_unordered_bulk_op()
+    for name, game_name in keys:
+      bulk.find({'username': name, 'game': game_name,
+                 'batch': {'$ne': batch_id}}).upsert().update_one(
+          {'$inc': deltas[name, game_name], '$set': {'batch': batch_id}})
+    start = time.perf_counter()
+    try:
+      bulk.execute()
+      return {}
+    except BulkWriteError as e:
+      errors = e.details.get('writeErrors', ())
+      if (e.details.get('writeConcernErrors') or
+          any(error.get('code') not in DUPLICATE_KEY_CODES
+              for error in errors)):
+        raise
+    finally:
+      RESULTS_WRITE_TIME.observe(time.perf_counter() - start)
+    unwritten = {}
+    for error in errors:
+      name, game_name = key = keys[error['index']]
+      if not self.results_collection.find_one(
+          {'username': name, 'game': game_name, 'batch': batch_id},
+          {'_id': 1}):
+        unwritten[key] = deltas[key]
+    return unwritten
+
+def add_results(deltas, game_name, results):
+  # Adds a game's results into deltas, counts by (username, game).
+  for name, field in results:
+    delta = deltas.setdefault(
+        (name, game_name), {'wins': 0, 'draws': 0, 'losses': 0})
+    delta[field] += 1
+
+class Scoreboard:
+  # In-memory ranking for one game pool, loaded once from Mongo and kept up
+  # to date from finished games. ranking is sorted ascending on
+  # (wins, draws, losses, username), so the board reads it back to front.
+  # The load only asks for fields in RANKING_INDEX, so Mongo answers it from
+  # the index without reading any documents.
+  fields = ('wins', 'draws', 'losses')
+  max_cached = 64
+
+  def __init__(self, game_name):
+    self.game_name = game_name
+    self.scores = {}
+    self.ranking = []
+    self.cache = {}
+
+  def load(self, results_collection):
+    start = time.perf_counter()
+    scores_cursor = results_collection.find(
+        {'game': self.game_name},
+        {'_id': 0, 'username': 1, 'wins': 1, 'draws': 1, 'losses': 1}
+    )
+    for s in scores_cursor:
+      self.scores[s['username']] = (s['wins'], s['draws'], s['losses'])
+    SCOREBOARD_LOAD_TIME.observe(time.perf_counter() - start)
+    self.ranking = sorted(i + (name,) for name, i in self.scores.items())
+    self.cache.clear()
+
+  def get(self, name):
+    return self.scores.get(name, (0, 0, 0))
+
+  def add_result(self, name, field):
+    old = self.scores.get(name)
+    if old:
+      del self.ranking[bisect.bisect_left(self.ranking, old + (name,))]
     else:
-      return True
-    return False
-
-  def get_opposite_house(self, pos):
-    if pos == self.a_store:
-      return self.b_store
-    if pos == self.b_store:
-      return self.a_store
-    return abs(pos - 12)
-
-  def skip_store(self, client):
-    if client.store == self.a_store:
-      return self.b_store
-    return self.a_store
-
-  def is_store(self, pos):
-    return pos == self.a_store or pos == self.b_store
-
-  def client_owns_house(self, client, pos):
-    return pos >= client.low_idx and pos < client.high_idx
-
-  def get_points(self):
-    return (sum(self.board[self.a.low_idx:self.a.high_idx]),
-            sum(self.board[self.b.low_idx:self.b.high_idx]))
-
-  def has_won(self):
-    a_pts, b_pts = self.get_points()
-    return a_pts == self.board[self.a_store] or b_pts == self.board[self.b_store]
-
-  def winner(self):
-    a_pts, b_pts = self.get_points()
-    if a_pts > b_pts:
-      return self.a
-    elif a_pts < b_pts:
-      return self.b
-    return None
-
-  def wait_for_client(self, client):
-    client.write_data('DAT %s BMP' % self.game_name)
-    client.waiting = self.get_ts()
-
-  def update_client(self, client, pos):
-    npos = self.normalise_pos_for_client(self.b, pos)
-    client.write_data('DAT %s MOV %d' % (self.game_name, npos))
+      old = (0, 0, 0)
+    new = tuple(v + (f == field) for v, f in zip(old, self.fields))
+    self.scores[name] = new
+    bisect.insort(self.ranking, new + (name,))
+    self.cache.clear()
+
+  def render(self, count=None, page=1):
+    key = (count, page)
+    if key not in self.cache:
+      if len(self.cache) >= self.max_cached:
+        self.cache.clear()
+      end = len(self.ranking)
+      if count:
+        end = max(end - count * (page - 1), 0)
+        rows = self.ranking[max(end - count, 0):end]
+      else:
+        rows = self.ranking
+      self.cache[key] = self.format(rows[::-1])
+    return self.cache[key]
+
+  def format(self, rows):
+    if not rows:
+      return []
+    align = max(max(len(k[3]) for k in rows), 4)
+    name_str = '%%%ds' % align
+    header = '%s   %3s   %3s   %3s' % (name_str % 'NAME', 'WIN', 'DRW', 'LSE')
+    print_str = '%s %%5d %%5d %%5d' % name_str
+    stats = '\n'.join(print_str % (i[3], i[0], i[1], i[2]) for i in rows)
+    return [header, stats]
 
 class GamePoolManager:
-  def __init__(self, game_name, game_class, users_collection):
+  # The players and games of one game from the registry. The game's class
+  # is loaded when the pool first gets a player or a game to play.
+  def __init__(self, game_name, results_collection, scheduler=None,
+               results_writer=None, journal=None):
     self.game_name = game_name
-    self.game_class = game_class
+    self.game_class = None
+    self.scheduler = scheduler
+    self.results_writer = results_writer
+    self.journal = journal
+    self.scoreboard = Scoreboard(game_name)
+    if results_collection:
+      self.scoreboard.load(results_collection)
     self.games = set()
     self.stats = {}
-    self.clients_not_in_game = set()
+    self.ratings = Ratings()
+    self.queue = MatchQueue(self.can_play)
+    self.pairing_due = False
+    self.pairing_entry = None
     self.client_to_game = {}
-    self.users_collection = users_collection
 
   def has_client(self, client):
-    return client in self.client_to_game or client in self.clients_not_in_game
+    return client in self.client_to_game or client in self.queue
 
-  def handle_game_finished(self, game):
-    self.users_collection.update(
-        {
-          'username': {'$in': [game.a.name, game.b.name]},
-          'scores.game': {'$ne': self.game_name}
-        },
-        {
-          '$addToSet':
-            {'scores':
-              {'game': self.game_name, 'wins': 0, 'draws': 0, 'losses': 0}
-            }
-        },
-        multi=True
-    )
+  def can_play(self, a, b):
+    # A user may have several connections waiting, but not play itself.
+    return a.name != b.name
 
+  def handle_game_finished(self, game):
     if game.result:
       winner = game.result
       loser = game.get_opposite(game.result)
-
-      self.users_collection.update(
-        {'username': winner.name, 'scores.game': self.game_name},
-        {'$inc': {'scores.$.wins': 1}}
-      )
-      self.users_collection.update(
-        {'username': loser.name, 'scores.game': self.game_name},
-        {'$inc': {'scores.$.losses': 1}}
-      )
+      results = [(winner.name, 'wins'), (loser.name, 'losses')]
     else:
-      self.users_collection.update(
-        {
-          'username':
-            {'$in': [game.a.name, game.b.name]},
-          'scores.game':
-            self.game_name
-        },
-        {'$inc': {'scores.$.draws': 1}},
-        multi=True
-      )
+      results = [(game.a.name, 'draws'), (game.b.name, 'draws')]
+    self.record_results(results)
+    self.record_game(game.record())
     game.send_results()
     self.client_to_game.pop(game.a, None)
     self.client_to_game.pop(game.b, None)
 
-  def update(self):
-    for game in self.games:
-      game.update()
-    self.reap_games()
+  def record_results(self, results):
+    self.results_writer.record(self.game_name, results)
+    for name, field in results:
+      self.scoreboard.add_result(name, field)
+    self.ratings.record(results)
+
+  def record_game(self, entry):
+    if self.journal:
+      self.journal.record(self.game_name, entry)
+
+  def expire(self, item):
+    # The scheduler holds this pool's matchmaking wakeup as well as the
+    # deadlines of its games.
+    if item is self:
+      self.pairing_entry = None
+      self.pairing_due = True
+    else:
+      self.expire_game(item)
+
+  def expire_game(self, game):
+    game.expire()
+    self.reap_game(game)
 
-  def reap_games(self):
-    for game in self.games.copy():
-      if game.finished:
-        print('Reaping game from game pool %s' % self.game_name)
-        self.handle_game_finished(game)
-        self.games.remove(game)
+  def reap_game(self, game):
+    if game.finished and game in self.games:
+      log.debug('Reaping game from game pool %s', self.game_name)
+      self.handle_game_finished(game)
+      self.games.remove(game)
 
   def do_pairing(self):
-    if len(self.clients_not_in_game) >= 2:
-      a, b = random.sample(self.clients_not_in_game, 2)
-      self.clients_not_in_game.remove(a)
-      self.clients_not_in_game.remove(b)
-      game = self.game_class(a, b, self.game_name)
-      self.client_to_game[a] = game
-      self.client_to_game[b] = game
-      self.games.add(game)
+    # Called every tick, but only does anything when players have joined or
+    # left the queue or a search window has widened enough for a match.
+    if not self.pairing_due:
+      return
+    self.pairing_due = False
+    for a, b in self.queue.pair(time.monotonic()):
+      self.start_game(a, b)
+    if self.pairing_entry:
+      self.scheduler.disarm(self.pairing_entry)
+      self.pairing_entry = None
+    ts = self.queue.next_match()
+    if ts is not None and self.scheduler:
+      self.pairing_entry = self.scheduler.arm(ts, self)
+
+  def load_game(self):
+    if self.game_class is None:
+      self.game_class = registry.load(self.game_name)
+    return self.game_class
+
+  def start_game(self, a, b):
+    game = self.load_game()(a, b, self.game_name, self.scheduler)
+    self.client_to_game[a] = game
+    self.client_to_game[b] = game
+    self.games.add(game)
+    return game
 
   def add_client(self, client):
     if self.has_client(client):
       client.error = 'Already lfg'
       return False
-    print('Game pool %s added client' % self.game_name)
-    self.clients_not_in_game.add(client)
-    self.do_pairing()
+    try:
+      self.load_game()
+    except (ImportError, AttributeError):
+      log.exception('Loading game %s', self.game_name)
+      client.error = 'Game unavailable'
+      return False
+    log.debug('Game pool %s added client', self.game_name)
+    self.queue.add(client, self.ratings.get(client.name), time.monotonic())
+    self.pairing_due = True
     return True
 
   def remove_client(self, client):
     if self.has_client(client):
-      print('Game pool %s removed client' % self.game_name)
-    if client in self.client_to_game:
-      self.client_to_game[client].remove_client(client)
-      del self.client_to_game[client]
-    if client in self.clients_not_in_game:
-      self.clients_not_in_game.remove(client)
-    self.reap_games()
-
-  def send_scoreboard(self, client):
-    scores_cursor = self.users_collection.find(
-        {'scores.game':self.game_name},
-        {'username':1, 'scores.$':1}
-    )
-    if scores_cursor.count() == 0:
-      client.write_data('BRD FIN')
-      return True
-    scores = []
-    for s in scores_cursor:
-      score = s['scores'][0]
-      scores.append((score['wins'], score['draws'], score['losses'], s['username']))
-    align = max(max(len(k[3]) for k in scores), 4)
-    name_str = '%%%ds' % align
-    header = '%s   %3s   %3s   %3s' % (name_str % 'NAME', 'WIN', 'DRW', 'LSE')
-    print_str = '%s %%5d %%5d %%5d' % name_str
-    sorted_stats = sorted(scores, reverse=True)
-    stats = '\n'.join(print_str % (i[3], i[0], i[1], i[2]) for i in sorted_stats)
-    client.write_data(header)
-    client.write_data(stats)
+      log.debug('Game pool %s removed client', self.game_name)
+    game = self.client_to_game.pop(client, None)
+    if game:
+      game.remove_client(client)
+      self.reap_game(game)
+    if client in self.queue:
+      self.queue.remove(client)
+      self.pairing_due = True
+
+  def send_scoreboard(self, client, count=None, page=1):
+    for line in self.scoreboard.render(count, page):
+      client.write_data(line)
     client.write_data('BRD FIN')
     return True
 
-  def send_stats(self, client):
-    score = self.users_collection.find_one(
-        {'username': client.name, 'scores.game': self.game_name},
-        {'scores.$': 1}
-    )
-
-    if score == None:
-      stats = (0, 0, 0)
-    else:
-      score = score['scores'][0]
-      stats = (score['wins'], score['draws'], score['losses'])
-
+  def send_stats(self, client, name=None):
+    stats = self.scoreboard.get(name or client.name)
     client.write_data('%d wins, %d draws, %d losses' % stats)
     return True
 
@@ -448,25 +733,144 @@ class GamePoolManager:
     if client not in self.client_to_game:
       client.error = 'Client not in game'
       return False
-    result = self.client_to_game[client].client_data(client, tok)
-    self.reap_games()
+    game = self.client_to_game[client]
+    result = game.client_data(client, tok)
+    self.reap_game(game)
     return result
 
 class ClientManager:
-  commands = ['REG', 'ATH', 'IFO', 'LFG', 'DAT', 'BRD']
-
-  def __init__(self, users_collection):
+  # Capabilities a client can ask for with extra tokens on ATH, answered
+  # with CAP and the ones it got once the password checks out; a failed ATH
+  # gets its ERR as text, with nothing negotiated. With BAT a client may send
+  # BAT <cmd>;<cmd>;... to have the commands handled in order as if sent on
+  # lines of their own; the replies come in one go followed by BAT FIN. An
+  # error stops the batch there. With BIN the connection switches to the
+  # binary protocol in protocol.py once CAP has been sent; its frames are
+  # handled as the text commands they stand for. Only clients with BRD are
+  # sent the board after every move; anyone in a game can ask for it with
+  # DAT <game> BRD. RPL <number> fetches a game from the journal: a line
+  # with the game, players, seeds and the first player's result, one with
+  # its moves, then RPL FIN. STA, from the server's own host only, sends
+  # what metrics has counted and timed, a STA line each, then STA FIN. Each
+  # command maps to (handler, whether it needs ATH first), bound once per
+  # ClientManager into dispatch along with its counter in metrics. Pools for
+  # the games in registry.GAMES are made the first time anyone mentions
+  # them.
+  commands = {
+    'REG': ('handle_register', False),
+    'ATH': ('handle_auth', False),
+    'BRD': ('handle_scoreboard', False),
+    'IFO': ('handle_get_stats', True),
+    'LFG': ('handle_lfg', True),
+    'DAT': ('handle_data', True),
+    'BAT': ('handle_batch', True),
+    'RPL': ('handle_replay', False),
+    'STA': ('handle_stats', False),
+  }
+  capabilities = ['BAT', 'BIN', 'BRD']
+  batch_commands = ['IFO', 'LFG', 'DAT', 'BRD']
+  pool_class = GamePoolManager
+
+  def __init__(self, users_collection, results_collection, journal=None,
+               ratings=None):
+    # journal is a journal.JournalWriter, and ratings the ratings for each
+    # game to start the pools from. Without results_collection results are
+    # neither loaded nor written, which a subclass recording them some other
+    # way wants.
     self.clients = {}
-    self.auth_manager = AuthManager(users_collection)
-    self.game_to_pool_mgr = {'KLH':GamePoolManager('KLH', KalahGame, users_collection)}
+    self.dispatch = self.bind_commands()
+    self.results_collection = results_collection
+    self.tasks = TaskPool(self.resume_client)
+    self.auth_manager = AuthManager(users_collection, self.tasks,
+                                    self.logged_in)
+    self.scheduler = DeadlineScheduler()
+    self.results_writer = None
+    if results_collection is not None:
+      self.results_writer = ResultsWriter(results_collection)
+      self.results_writer.start()
+      metrics.registry.gauge('results', self.results_writer.stats)
+    self.journal = journal
+    if journal:
+      journal.start()
+    self.ratings = ratings or {}
+    self.game_to_pool_mgr = {}
+    self.register_metrics()
+    if journal:
+      metrics.registry.gauge('journal', journal.stats)
+
+  def bind_commands(self):
+    self.unrecognised = metrics.registry.counter('commands.unrecognised')
+    return {cmd: (getattr(self, name), needs_auth,
+                  metrics.registry.counter('commands.' + cmd))
+            for cmd, (name, needs_auth) in self.commands.items()}
+
+  def register_metrics(self):
+    metrics.registry.gauge('cpu', time.process_time)
+    metrics.registry.gauge('clients', lambda: len(self.clients))
+    metrics.registry.gauge('pools', self.pool_stats)
+
+  def pool_stats(self):
+    stats = {'games': 0, 'waiting': 0}
+    for game_name, pool_mgr in self.game_to_pool_mgr.items():
+      stats[game_name + '.games'] = len(pool_mgr.games)
+      stats[game_name + '.waiting'] = len(pool_mgr.queue)
+      stats['games'] += len(pool_mgr.games)
+      stats['waiting'] += len(pool_mgr.queue)
+    return stats
+
+  def stats_lines(self):
+    return metrics.registry.render()
+
+  def make_pool(self, game_name):
+    pool_mgr = self.pool_class(game_name, self.results_collection,
+                               self.scheduler, self.results_writer,
+                               self.journal)
+    if game_name in self.ratings:
+      pool_mgr.ratings = self.ratings[game_name]
+    return pool_mgr
+
+  def get_pool(self, game_name):
+    # The game's pool, made on first use, or None for a game not hosted.
+    pool_mgr = self.game_to_pool_mgr.get(game_name)
+    if pool_mgr is None and game_name in registry.GAMES:
+      pool_mgr = self.game_to_pool_mgr[game_name] = self.make_pool(game_name)
+    return pool_mgr
+
+  def find_pool(self, client, game_name):
+    pool_mgr = self.get_pool(game_name)
+    if pool_mgr is None:
+      client.error = 'Unrecognised game type'
+    return pool_mgr
+
+  def close(self):
+    self.tasks.close()
+    if self.results_writer:
+      self.results_writer.close()
+    if self.journal:
+      self.journal.close()
 
   def update(self):
+    for item in self.scheduler.pop_expired():
+      self.game_to_pool_mgr[item.game_name].expire(item)
     for pool_mgr in self.game_to_pool_mgr.values():
-      pool_mgr.update()
+      pool_mgr.do_pairing()
+
+  def next_timeout(self):
+    return self.scheduler.next_timeout()
 
   def add_client(self, handle, addr):
     self.clients[handle] = Client(handle, addr)
 
+  def adopt_client(self, handle, addr, name, caps=()):
+    # For a connection that was authenticated by another process.
+    client = Client(handle, addr)
+    client.name = name
+    client.caps = set(caps)
+    if 'BIN' in client.caps:
+      client.use_binary()
+    self.clients[handle] = client
+    return client
+
   def remove_client(self, handle):
     for pool_mgr in self.game_to_pool_mgr.values():
       pool_mgr.remove_client(self.clients[handle])
@@ -479,132 +883,312 @@ class ClientManager:
     return self.auth_manager.register(client, tok[1], tok[2])
 
   def handle_auth(self, client, tok):
-    if len(tok) != 3:
+    if len(tok) < 3:
       client.error = 'Wrong number of arguments for command'
       return False
+    client.asked_caps = None
+    if len(tok) > 3:
+      client.asked_caps = set(tok[3:]) & set(self.capabilities)
     return self.auth_manager.auth(client, tok[1], tok[2])
 
+  def logged_in(self, client):
+    if client.asked_caps is not None:
+      client.caps = client.asked_caps
+      client.asked_caps = None
+      client.write_data(' '.join(['CAP'] + sorted(client.caps)))
+      if 'BIN' in client.caps:
+        client.use_binary()
+
   def handle_scoreboard(self, client, tok):
-    if len(tok) != 2:
+    if len(tok) < 2 or len(tok) > 4:
       client.error = 'Wrong number of arguments for command'
       return False
-    if tok[1] not in self.game_to_pool_mgr:
-      client.error = 'Unrecognised game type'
+    pool_mgr = self.find_pool(client, tok[1])
+    if pool_mgr is None:
+      return False
+    count, page = None, 1
+    try:
+      if len(tok) > 2:
+        count = int(tok[2])
+      if len(tok) > 3:
+        page = int(tok[3])
+    except ValueError:
+      client.error = 'Malformed command'
+      return False
+    if (count is not None and count < 1) or page < 1:
+      client.error = 'Malformed command'
       return False
 
-    return self.game_to_pool_mgr[tok[1]].send_scoreboard(client)
+    return pool_mgr.send_scoreboard(client, count, page)
 
   def handle_get_stats(self, client, tok):
-    if len(tok) != 2:
+    if len(tok) < 2 or len(tok) > 3:
       client.error = 'Wrong number of arguments for command'
       return False
-    if tok[1] not in self.game_to_pool_mgr:
-      client.error = 'Unrecognised game type'
+    pool_mgr = self.find_pool(client, tok[1])
+    if pool_mgr is None:
       return False
 
-    return self.game_to_pool_mgr[tok[1]].send_stats(client)
+    name = tok[2] if len(tok) > 2 else None
+    return pool_mgr.send_stats(client, name)
 
   def handle_lfg(self, client, tok):
     if len(tok) != 2:
       client.error = 'Wrong number of arguments for command'
       return False
-    if tok[1] not in self.game_to_pool_mgr:
-      client.error = 'Unrecognised game type'
+    pool_mgr = self.find_pool(client, tok[1])
+    if pool_mgr is None:
       return False
+    # A connection plays one game at a time, whichever pool it is in.
+    for other in self.game_to_pool_mgr.values():
+      if other.has_client(client):
+        client.error = 'Already lfg'
+        return False
 
-    return self.game_to_pool_mgr[tok[1]].add_client(client)
+    return pool_mgr.add_client(client)
 
   def handle_data(self, client, tok):
     if len(tok) < 2:
       client.error = 'Not enough arguments for command'
       return False
-    if tok[1] not in self.game_to_pool_mgr:
-      client.error = 'Unrecognised game type'
+    pool_mgr = self.find_pool(client, tok[1])
+    if pool_mgr is None:
       return False
 
-    return self.game_to_pool_mgr[tok[1]].handle_data(client, tok)
+    return pool_mgr.handle_data(client, tok)
+
+  def handle_replay(self, client, tok):
+    if len(tok) != 2:
+      client.error = 'Wrong number of arguments for command'
+      return False
+    if not self.journal:
+      client.error = 'No journal kept'
+      return False
+    try:
+      number = int(tok[1])
+    except ValueError:
+      client.error = 'Malformed command'
+      return False
+    # Finding a game reads journal files, so it's done off the loop.
+    return self.tasks.run(
+        client, functools.partial(self.journal.reader.find, number),
+        functools.partial(self.replay_found, number))
+
+  def replay_found(self, number, client, record):
+    if record is None:
+      client.error = 'No such game'
+      return False
+    result = 1 if record.winner is None else 2 - 2 * record.winner
+    client.write_data('RPL %d %s %s %s %d %s' % (
+        number, record.game, record.a, record.b, record.seeds,
+        protocol.RESULTS[result]))
+    client.write_data(' '.join(['RPL', 'MOV'] + list(map(str, record.moves))))
+    client.write_data('RPL FIN')
+    return True
+
+  def handle_stats(self, client, tok):
+    if len(tok) != 1:
+      client.error = 'Wrong number of arguments for command'
+      return False
+    if client.addr not in ADMIN_ADDRESSES:
+      client.error = 'Not allowed'
+      return False
+    for line in self.stats_lines():
+      client.write_data('STA ' + line)
+    client.write_data('STA FIN')
+    return True
+
+  def handle_batch(self, client, tok):
+    if 'BAT' not in client.caps:
+      client.error = 'Batching not negotiated'
+      return False
+    result = True
+    for cmd in ' '.join(tok[1:]).split(';'):
+      cmd = cmd.strip()
+      if cmd.split(' ', 1)[0] not in self.batch_commands:
+        client.error = 'Command not allowed in batch'
+        result = False
+      else:
+        result = self.handle_msg(client, cmd)
+      if not result:
+        client.write_error()
+        break
+    client.write_data('BAT FIN')
+    return result
 
   def handle_msg(self, client, msg):
     if not msg:
       client.error = 'Empty command'
-    tok = msg.split(' ')
-    if len(tok) == 0:
-      client.error = 'Empty command'
       return False
-    if tok[0] == 'REG':
-      return self.handle_register(client, tok)
-    if tok[0] == 'ATH':
-      return self.handle_auth(client, tok)
-    if tok[0] == 'BRD':
-      return self.handle_scoreboard(client, tok)
-    if tok[0] == 'IFO' and client.name:
-      return self.handle_get_stats(client, tok)
-    if tok[0] == 'LFG' and client.name:
-      return self.handle_lfg(client, tok)
-    if tok[0] == 'DAT' and client.name:
-      return self.handle_data(client, tok)
-    if tok[0] in self.commands:
-      if not client.name:
-        client.error = 'Client not authed'
-      else:
-        client.error = 'Unknown error'
-    else:
+    return self.handle_tok(client, msg.split(' '))
+
+  def handle_frame(self, client, frame):
+    op, game_id, payload = frame
+    game_name = protocol.GAME_NAMES.get(game_id)
+    if op == protocol.MOV and game_name and len(payload) == 1:
+      return self.handle_tok(client, ['DAT', game_name, 'MOV', payload[0]])
+    if op == protocol.TXT:
+      try:
+        msg = payload.decode('ascii').strip()
+      except UnicodeDecodeError:
+        client.error = 'Commands must be ascii'
+        return False
+      return self.handle_msg(client, msg)
+    if game_name is None:
+      client.error = 'Unrecognised game type'
+      return False
+    if op == protocol.LFG and not payload:
+      return self.handle_tok(client, ['LFG', game_name])
+    if op == protocol.BRD and not payload:
+      return self.handle_tok(client, ['DAT', game_name, 'BRD'])
+    client.error = 'Unrecognised command'
+    return False
+
+  def handle_tok(self, client, tok):
+    entry = self.dispatch.get(tok[0])
+    if entry is None:
+      self.unrecognised.inc()
       client.error = 'Unrecognised command'
-    return client.error == ''
+      return False
+    handler, needs_auth, counter = entry
+    counter.inc()
+    if needs_auth and not client.name:
+      client.error = 'Client not authed'
+      return False
+    return handler(client, tok)
 
   def client_data(self, handle, data):
     client = self.clients[handle]
     client.add_data(data)
-    while client.has_msg():
-      if not self.handle_msg(client, client.pop_msg()):
+    return self.process_msgs(client)
+
+  def process_msgs(self, client):
+    while not client.pending and client.has_msg():
+      msg = client.pop_msg()
+      if msg is None:
+        result = False
+      elif client.binary:
+        result = self.handle_frame(client, msg)
+      else:
+        result = self.handle_msg(client, msg)
+      if not result:
         client.write_error()
         return False
     return True
 
+  def resume_client(self, client, result):
+    if self.clients.get(client.handle) is not client:
+      return
+    if not result:
+      client.write_error()
+      return
+    self.process_msgs(client)
+
+
+# Results are kept one document per user and game, with the counts of
+# wins, draws and losses and the ResultsWriter batch that last wrote it.
+# Upserts find theirs through RESULTS_KEY, and RANKING_INDEX is the
+# scoreboard's order, best first, with every field a Scoreboard loads, so
+# that load is an index only scan of one game.
+RESULTS_KEY = [('username', 1), ('game', 1)]
+RANKING_INDEX = [('game', 1), ('wins', -1), ('draws', -1), ('losses', -1),
+                 ('username', -1)]
+
+def ensure_indexes(users_collection, results_collection):
+  users_collection.ensure_index('username', unique=True)
+  users_collection.ensure_index('ip_address')
+  results_collection.ensure_index(RESULTS_KEY, unique=True)
+  results_collection.ensure_index(RANKING_INDEX)
 
-def main():
-  server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-  server_socket.bind(('', 31337))
-  server_socket.listen(5)
-
-  database_client = MongoClient('localhost', 27017)
+def connect_database(host='localhost:27017'):
+  database_client = MongoClient(host)
   database = database_client['ai3001']
 
   users_collection = database['users']
-  users_collection.ensure_index('username', unique=True)
+  results_collection = database['results']
+  ensure_indexes(users_collection, results_collection)
+  return users_collection, results_collection
+
+def open_journal(path):
+  # The journal writer for path and the ratings replayed from it, or Nones
+  # for no journal.
+  if not path:
+    return None, None
+  writer = journal.JournalWriter(path)
+  start = time.monotonic()
+  ratings, count = journal.recompute_ratings(writer.reader)
+  log.info('Replayed %d games from %s in %.2fs', count, path,
+           time.monotonic() - start)
+  return writer, ratings
+
+def setup_logging(verbosity):
+  # Warnings and worse, then INFO and DEBUG with each -v. Below the level,
+  # a log call returns before formatting anything.
+  handler = logging.StreamHandler(sys.stderr)
+  handler.setFormatter(
+      logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s'))
+  root = logging.getLogger()
+  root.addHandler(handler)
+  root.setLevel([logging.WARNING, logging.INFO,
+                 logging.DEBUG][min(verbosity, 2)])
+
+def run_engine(engine, profile=None):
+  # Runs the loop until it stops. With profile, a file name, it runs under
+  # cProfile, and SIGTERM stops it too, so the stats are always written
+  # there to read with pstats, and the functions the loop spent most of
+  # its own time in go to stderr. Threads other than the loop's aren't
+  # profiled.
+  if not profile:
+    return engine.run()
+  signal.signal(signal.SIGTERM,
+                lambda *args: engine.call_soon_threadsafe(engine.stop))
+  profiler = cProfile.Profile()
+  try:
+    profiler.runcall(engine.run)
+  finally:
+    profiler.dump_stats(profile)
+    pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+        'tottime').print_stats(PROFILE_LINES)
+
+def add_server_options(parser):
+  # What server.py and shard.py have in common.
+  parser.add_option('-p', '--port', dest='port', type='int', default=31337,
+                    help='Port to listen on')
+  parser.add_option('-d', '--database', dest='database',
+                    default='localhost:27017',
+                    help='Mongo to keep users and results in, as host:port')
+  parser.add_option('-j', '--journal', dest='journal', default='journal',
+                    help='Directory to keep the game journal in, empty for '
+                         'none')
+  parser.add_option('--profile', dest='profile',
+                    help='Run the game loop under cProfile and write the '
+                         'stats to this file when stopped')
+  parser.add_option('-v', '--verbose', dest='verbose', action='count',
+                    default=0,
+                    help='Log more: once for logins and errors, twice for '
+                         'every game and connection')
 
-  client_manager = ClientManager(users_collection)
-
-  sockets = [server_socket]
-  while True:
-    input_sockets, _, _ = select.select(sockets, [], [], 0.2)
-    for input_socket in input_sockets:
-      if input_socket == server_socket:
-        sock, addr = server_socket.accept()
-        addr = addr[0]
-        print('Connection from "%s"' % addr)
-        sockets.append(sock)
-        client_manager.add_client(sock, addr)
-      else:
-        success = False
-        try:
-          data = input_socket.recv(4096)
-          if data:
-            data = data.decode('ascii')
-            client_manager.client_data(input_socket, data)
-          else:
-            print('Client disconnected')
-          success = data
-        except Exception as e:
-          print(traceback.format_exc())
-        if not success:
-          input_socket.close()
-          client_manager.remove_client(input_socket)
-          sockets.remove(input_socket)
-    client_manager.update()
-  server_socket.close()
+def main():
+  parser = optparse.OptionParser()
+  add_server_options(parser)
+  (options, args) = parser.parse_args()
+
+  setup_logging(options.verbose)
+  raise_fd_limit()
+
+  users_collection, results_collection = connect_database(options.database)
+  journal_writer, ratings = open_journal(options.journal)
+
+  client_manager = ClientManager(users_collection, results_collection,
+                                 journal_writer, ratings)
+
+  engine = NetworkEngine(client_manager, ('', options.port))
+  client_manager.tasks.start(engine.call_soon_threadsafe)
+  try:
+    run_engine(engine, options.profile)
+  finally:
+    engine.close()
+    client_manager.close()
 
 if __name__ == '__main__':
   main()
-
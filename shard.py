@@ -0,0 +1,372 @@
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import socket
+import time
+
+import metrics
+from network import NetworkEngine, raise_fd_limit
+import server
+
+log = logging.getLogger('shard')
+
+# Sharded deployment: a front end process accepts connections and handles
+# REG/ATH/IFO/BRD/LFG and pairing. Once a pair is made both sockets are
+# passed to a worker process over a unix socket (SCM_RIGHTS), the worker
+# plays the game and passes the sockets back with the results when it ends.
+# Workers also send a snapshot of their metrics every so often, which STA on
+# the front end shows after its own, named shard.<pid>.
+
+class ControlChannel:
+  # One end of a SOCK_SEQPACKET socketpair. Each message is a JSON object,
+  # optionally carrying sockets, sent as one packet. The reader peeks at
+  # the size of the next packet first, so it only ever asks for as many
+  # bytes as are coming. Buffers are made large enough that neither side
+  # blocks on the other in practice. A message carries at most max_socks
+  # sockets, well under the kernel's limit of 253.
+  max_message = 4 << 20
+  max_socks = 64
+
+  def __init__(self, sock):
+    self.sock = sock
+    for opt in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+      try:
+        self.sock.setsockopt(socket.SOL_SOCKET, opt, self.max_message)
+      except OSError:
+        pass
+
+  @classmethod
+  def pair(cls):
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    return cls(a), cls(b)
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def send(self, msg, socks=()):
+    if len(socks) > self.max_socks:
+      raise ValueError('%d sockets in one message' % len(socks))
+    data = json.dumps(msg).encode('ascii')
+    socket.send_fds(self.sock, [data], [s.fileno() for s in socks])
+
+  def recv(self):
+    # Raises ValueError for a message that isn't JSON or lost sockets.
+    size = self.sock.recv_into(
+        bytearray(1), 1, socket.MSG_PEEK | socket.MSG_TRUNC)
+    data, fds, flags, addr = socket.recv_fds(
+        self.sock, max(size, 1), self.max_socks)
+    socks = [socket.socket(fileno=fd) for fd in fds]
+    if not data:
+      for sock in socks:
+        sock.close()
+      return None, []
+    try:
+      if flags & socket.MSG_CTRUNC:
+        raise ValueError('Sockets cut off a control message')
+      return json.loads(data), socks
+    except ValueError:
+      for sock in socks:
+        sock.close()
+      raise
+
+  def close(self):
+    self.sock.close()
+
+def detach_client(engine, client_manager, client):
+  sock, output = engine.detach(client.handle)
+  del client_manager.clients[client.handle]
+  info = {
+    'name': client.name,
+    'addr': client.addr,
+    'caps': sorted(client.caps),
+    'input': client.read_buffer.drain().decode('latin-1'),
+    'output': output.decode('latin-1'),
+  }
+  return info, sock
+
+def adopt_client(engine, client_manager, info, sock):
+  conn = engine.adopt(sock, info['addr'])
+  if info['output']:
+    conn.write(info['output'].encode('latin-1'))
+  return client_manager.adopt_client(conn, info['addr'], info['name'],
+                                     info['caps'])
+
+def feed_input(client_manager, info, client):
+  # Handles what an adopted client sent before it was handed over.
+  if info['input']:
+    client_manager.client_data(client.handle, info['input'].encode('latin-1'))
+
+def send_clients(channel, msg, socks):
+  try:
+    channel.send(msg, socks)
+  finally:
+    # The receiver has its own descriptors now (or the send failed and the
+    # clients are lost either way).
+    for sock in socks:
+      sock.close()
+
+class Shard:
+  def __init__(self, channel, process):
+    self.channel = channel
+    self.process = process
+    self.games = 0
+    self.metrics = None
+    self.metrics_shown = None
+
+class ShardedGamePoolManager(server.GamePoolManager):
+  front_end = None
+
+  def start_game(self, a, b):
+    if not self.front_end.hand_off(self.game_name, a, b):
+      return server.GamePoolManager.start_game(self, a, b)
+
+class FrontEnd(server.ClientManager):
+  pool_class = ShardedGamePoolManager
+
+  def __init__(self, users_collection, results_collection, shards,
+               journal=None, ratings=None):
+    server.ClientManager.__init__(self, users_collection, results_collection,
+                                  journal, ratings)
+    self.shards = shards
+    self.engine = None
+
+  def make_pool(self, game_name):
+    pool_mgr = server.ClientManager.make_pool(self, game_name)
+    pool_mgr.front_end = self
+    return pool_mgr
+
+  def start(self, engine):
+    self.engine = engine
+    self.tasks.start(engine.call_soon_threadsafe)
+    for shard in self.shards:
+      engine.add_reader(
+          shard.channel, lambda shard=shard: self.shard_msg(shard))
+
+  def close(self):
+    for shard in self.shards:
+      shard.channel.close()
+    for shard in self.shards:
+      shard.process.join(5)
+    server.ClientManager.close(self)
+
+  def hand_off(self, game_name, a, b):
+    # Gives the game to the least loaded shard, or the next if that one
+    # can't be reached. If none can, the clients are taken back and the
+    # game is played here.
+    if not self.shards:
+      return False
+    infos, socks = zip(
+        *[detach_client(self.engine, self, c) for c in (a, b)])
+    msg = {'op': 'game', 'pool': game_name, 'players': infos}
+    for shard in sorted(self.shards, key=lambda s: s.games):
+      log.debug('Handing game in pool %s to shard %d', game_name,
+                shard.process.pid)
+      try:
+        shard.channel.send(msg, socks)
+      except OSError as e:
+        log.warning('Could not reach shard %d: %s', shard.process.pid, e)
+        self.lose_shard(shard)
+        continue
+      for sock in socks:
+        sock.close()
+      shard.games += 1
+      return True
+    clients = [adopt_client(self.engine, self, info, sock)
+               for info, sock in zip(infos, socks)]
+    server.GamePoolManager.start_game(self.get_pool(game_name), *clients)
+    for info, client in zip(infos, clients):
+      feed_input(self, info, client)
+    return True
+
+  def stats_lines(self):
+    lines = server.ClientManager.stats_lines(self)
+    for shard in self.shards:
+      if shard.metrics:
+        lines += metrics.render(shard.metrics, shard.metrics_shown,
+                                'shard.%d.' % shard.process.pid)
+        shard.metrics_shown = shard.metrics
+    return lines
+
+  def lose_shard(self, shard):
+    log.warning('Lost shard %d', shard.process.pid)
+    self.engine.remove_reader(shard.channel)
+    shard.channel.close()
+    self.shards.remove(shard)
+
+  def shard_msg(self, shard):
+    try:
+      msg, socks = shard.channel.recv()
+    except (OSError, ValueError):
+      msg, socks = None, []
+    if msg is None:
+      self.lose_shard(shard)
+      return
+    if msg['op'] == 'metrics':
+      shard.metrics = msg['snapshot']
+      return
+    pool_mgr = self.get_pool(msg['pool'])
+    if msg['op'] == 'result':
+      shard.games -= 1
+      pool_mgr.record_results([tuple(i) for i in msg['results']])
+    elif msg['op'] == 'record':
+      pool_mgr.record_game(msg['record'])
+    elif msg['op'] == 'return':
+      for info, sock in zip(msg['players'], socks):
+        client = adopt_client(self.engine, self, info, sock)
+        feed_input(self, info, client)
+
+class WorkerGamePoolManager(server.GamePoolManager):
+  worker = None
+
+  def record_results(self, results):
+    self.worker.channel.send(
+        {'op': 'result', 'pool': self.game_name, 'results': results})
+
+  def record_game(self, entry):
+    self.worker.channel.send(
+        {'op': 'record', 'pool': self.game_name, 'record': entry})
+
+  def handle_game_finished(self, game):
+    server.GamePoolManager.handle_game_finished(self, game)
+    self.worker.return_client(self.game_name, game.a)
+    self.worker.return_client(self.game_name, game.b)
+
+class ShardWorker(server.ClientManager):
+  # Plays games handed over by the front end. Only DAT is served here; once
+  # a game ends its clients stop being read and go back to the front end
+  # with whatever they have sent since.
+  pool_class = WorkerGamePoolManager
+  metrics_interval = 1.0
+
+  def __init__(self, channel):
+    # Results and games go back to the front end to be written.
+    server.ClientManager.__init__(self, None, None)
+    self.channel = channel
+    self.engine = None
+    self.returning = []
+    self.metrics_due = 0
+
+  def make_pool(self, game_name):
+    pool_mgr = server.ClientManager.make_pool(self, game_name)
+    pool_mgr.worker = self
+    return pool_mgr
+
+  def start(self, engine):
+    self.engine = engine
+    engine.add_reader(self.channel, self.control_msg)
+
+  def close(self):
+    self.channel.close()
+    server.ClientManager.close(self)
+
+  def control_msg(self):
+    try:
+      msg, socks = self.channel.recv()
+    except (OSError, ValueError):
+      msg, socks = None, []
+    if msg is None:
+      self.engine.stop()
+      return
+    if msg['op'] == 'game':
+      clients = [adopt_client(self.engine, self, info, sock)
+                 for info, sock in zip(msg['players'], socks)]
+      self.get_pool(msg['pool']).start_game(*clients)
+      for info, client in zip(msg['players'], clients):
+        feed_input(self, info, client)
+
+  def handle_tok(self, client, tok):
+    if tok[0] not in ('DAT', 'BAT'):
+      client.error = 'Only DAT is available during a game'
+      return False
+    return server.ClientManager.handle_tok(self, client, tok)
+
+  def return_client(self, pool_name, client):
+    client.pending = True
+    self.returning.append((pool_name, client))
+
+  def update(self):
+    server.ClientManager.update(self)
+    by_pool = {}
+    for pool_name, client in self.returning:
+      if self.clients.get(client.handle) is client:
+        by_pool.setdefault(pool_name, []).append(client)
+    self.returning = []
+    step = self.channel.max_socks
+    for pool_name, clients in by_pool.items():
+      for i in range(0, len(clients), step):
+        infos, socks = zip(*[detach_client(self.engine, self, c)
+                             for c in clients[i:i + step]])
+        send_clients(
+            self.channel,
+            {'op': 'return', 'pool': pool_name, 'players': infos}, socks)
+    now = time.monotonic()
+    if now >= self.metrics_due:
+      self.metrics_due = now + self.metrics_interval
+      self.channel.send(
+          {'op': 'metrics', 'snapshot': metrics.registry.snapshot()})
+
+  def next_timeout(self):
+    timeout = server.ClientManager.next_timeout(self)
+    wait = max(self.metrics_due - time.monotonic(), 0)
+    return wait if timeout is None else min(timeout, wait)
+
+def run_worker(channel, others, profile=None):
+  for other in others:
+    other.close()
+  worker = ShardWorker(channel)
+  engine = NetworkEngine(worker, None)
+  worker.start(engine)
+  try:
+    server.run_engine(engine, profile and '%s.%d' % (profile, os.getpid()))
+  except KeyboardInterrupt:
+    pass
+  except Exception:
+    log.exception('Shard worker failed')
+  finally:
+    engine.close()
+    worker.close()
+
+def start_shards(count, profile=None):
+  # With profile, each worker profiles its loop into profile.<pid>.
+  shards = []
+  for i in range(count):
+    ours, theirs = ControlChannel.pair()
+    process = multiprocessing.Process(
+        target=run_worker,
+        args=(theirs, [s.channel for s in shards] + [ours], profile))
+    process.daemon = True
+    process.start()
+    theirs.close()
+    shards.append(Shard(ours, process))
+  return shards
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-w', '--workers', dest='workers', type='int',
+                    default=os.cpu_count(),
+                    help='Number of game worker processes')
+  server.add_server_options(parser)
+  (options, args) = parser.parse_args()
+
+  server.setup_logging(options.verbose)
+  raise_fd_limit()
+  # Fork before connecting to Mongo or starting any threads.
+  shards = start_shards(options.workers, options.profile)
+  users_collection, results_collection = server.connect_database(
+      options.database)
+  journal_writer, ratings = server.open_journal(options.journal)
+
+  front_end = FrontEnd(users_collection, results_collection, shards,
+                       journal_writer, ratings)
+  engine = NetworkEngine(front_end, ('', options.port))
+  front_end.start(engine)
+  try:
+    server.run_engine(engine, options.profile)
+  finally:
+    engine.close()
+    front_end.close()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,142 @@
+import random
+import unittest
+
+from kalah import KalahBoard, PITS, STORES
+from kalah_game import KalahGame
+from oware_game import OwareGame
+
+class LegacyBoard:
+  # KalahGame's board code before kalah.KalahBoard: a list sown one seed at
+  # a time, with the sides re-summed after every move.
+  def __init__(self, pits):
+    self.board = list(pits)
+
+  def move_seeds(self, player, pos):
+    store = STORES[player]
+    skip = STORES[1 - player]
+    num_seeds = self.board[pos]
+    self.board[pos] = 0
+
+    npos = pos
+    for i in range(num_seeds):
+      npos = (npos + 1) % 14
+      if npos == skip:
+        npos = (npos + 1) % 14
+      self.board[npos] += 1
+    if not self.is_store(npos):
+      opp = self.get_opposite_house(npos)
+      if (self.owns_house(player, npos) and
+          self.board[npos] == 1 and self.board[opp] > 0):
+        self.board[store] += self.board[opp] + 1
+        self.board[npos] = 0
+        self.board[opp] = 0
+    else:
+      return True
+    return False
+
+  def get_opposite_house(self, pos):
+    if pos == STORES[0]:
+      return STORES[1]
+    if pos == STORES[1]:
+      return STORES[0]
+    return abs(pos - 12)
+
+  def is_store(self, pos):
+    return pos in STORES
+
+  def owns_house(self, player, pos):
+    return pos >= player * 7 and pos < player * 7 + 7
+
+  def get_points(self):
+    return sum(self.board[0:7]), sum(self.board[7:14])
+
+  def has_won(self):
+    a_pts, b_pts = self.get_points()
+    return a_pts == self.board[STORES[0]] or b_pts == self.board[STORES[1]]
+
+def legal_moves(pits, player):
+  return [i for i in range(player * 7, player * 7 + 6) if pits[i]]
+
+def random_position(rng):
+  # Arbitrary, not necessarily reachable, positions so that multi-lap sowing
+  # and odd captures get exercised too.
+  pits = [rng.randint(0, 15) if rng.random() < 0.8 else 0
+          for i in range(PITS)]
+  if not legal_moves(pits, 0):
+    pits[rng.randint(0, 5)] = rng.randint(1, 15)
+  if not legal_moves(pits, 1):
+    pits[rng.randint(7, 12)] = rng.randint(1, 15)
+  return pits
+
+class FakeClient:
+  # Just enough of server.Client for a game to talk to.
+  def __init__(self, name):
+    self.name = name
+    self.caps = set()
+    self.binary = False
+    self.error = ''
+    self.sent = []
+
+  def send_start(self, game_name, opponent):
+    self.sent.append('SRT %s %s' % (game_name, opponent))
+
+  def send_turn(self, game_name):
+    self.sent.append('DAT %s BMP' % game_name)
+
+  def send_move(self, game_name, pos):
+    self.sent.append('DAT %s MOV %d' % (game_name, pos))
+
+class StoreMoveTest(unittest.TestCase):
+  # Naming one's own store as the house to sow from is out of bounds, even
+  # with seeds in it, as Oware's stores have after a capture.
+  def check_store_move(self, game_class, game_name):
+    a, b = FakeClient('a'), FakeClient('b')
+    game = game_class(a, b, game_name)
+    game.board.pits[game.a_store] = 3
+    self.assertFalse(game.client_data(a, ['DAT', game_name, 'MOV', '6']))
+    self.assertEqual(a.error, 'OOB index')
+    self.assertIs(game.result, b)
+
+  def test_kalah(self):
+    self.check_store_move(KalahGame, 'KLH')
+
+  def test_oware(self):
+    self.check_store_move(OwareGame, 'OWR')
+
+  def test_second_player_store(self):
+    a, b = FakeClient('a'), FakeClient('b')
+    game = OwareGame(a, b, 'OWR')
+    self.assertTrue(game.client_data(a, ['DAT', 'OWR', 'MOV', '0']))
+    game.board.pits[game.b_store] = 3
+    self.assertFalse(game.client_data(b, ['DAT', 'OWR', 'MOV', '6']))
+    self.assertEqual(b.error, 'OOB index')
+
+class KalahBoardTest(unittest.TestCase):
+  # KalahBoard against LegacyBoard, move by move, through whole games from
+  # a few hundred seeded positions, half of them arbitrary.
+  games = 300
+
+  def test_against_legacy(self):
+    rng = random.Random(3001)
+    for game in range(self.games):
+      if game % 2:
+        pits = random_position(rng)
+      else:
+        pits = [rng.randint(1, KalahBoard.max_seeds)] * PITS
+        pits[STORES[0]] = pits[STORES[1]] = 0
+      legacy = LegacyBoard(pits)
+      board = KalahBoard.from_pits(pits)
+      player = 0
+      while not legacy.has_won():
+        pos = rng.choice(legal_moves(legacy.board, player))
+        again = legacy.move_seeds(player, pos)
+        self.assertEqual(board.sow(player, pos), again, pits)
+        self.assertEqual(list(board.pits), legacy.board, pits)
+        self.assertEqual(board.points(), legacy.get_points(), pits)
+        self.assertEqual(board.finished(), legacy.has_won(), pits)
+        if not again:
+          player = 1 - player
+      self.assertTrue(board.finished(), pits)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,295 @@
+import collections
+import concurrent.futures
+import csv
+import importlib
+import json
+import optparse
+import os
+import random
+import sys
+import time
+
+from kalah import HOUSES, STORES, KalahBoard
+
+# Plays bots against each other in process, with the same rules as the
+# server's KalahGame but no server or sockets. A bot is a callable
+# bot(board, player, rng) returning the pit to sow from, in the server's
+# layout (see kalah.KalahBoard); player 0 moves first. Bots are named either
+# from BOTS or as module:function. Games are played in batches on a process
+# pool and each batch is written out as it finishes.
+
+HOUSE_RANGES = tuple(range(p * (HOUSES + 1), p * (HOUSES + 1) + HOUSES)
+                     for p in (0, 1))
+
+def legal_moves(board, player):
+  pits = board.pits
+  return [i for i in HOUSE_RANGES[player] if pits[i]]
+
+def random_bot(board, player, rng):
+  return rng.choice(legal_moves(board, player))
+
+def greedy_bot(board, player, rng):
+  # Takes a move ending in its store if there is one, otherwise whichever
+  # move adds the most to its store.
+  store = STORES[player]
+  best, best_gain = None, -1
+  for pos in legal_moves(board, player):
+    trial = KalahBoard.from_pits(board.pits)
+    if trial.sow(player, pos):
+      return pos
+    gain = trial.pits[store] - board.pits[store]
+    if gain > best_gain:
+      best, best_gain = pos, gain
+  return best
+
+BOTS = {
+  'random': random_bot,
+  'greedy': greedy_bot,
+}
+
+def load_bot(name):
+  if name in BOTS:
+    return BOTS[name]
+  module, sep, attr = name.partition(':')
+  if not sep:
+    raise ValueError('Unknown bot %s' % name)
+  return getattr(importlib.import_module(module), attr)
+
+# Bots loaded in this process, so each worker imports them once.
+loaded_bots = {}
+
+def get_bot(name):
+  bot = loaded_bots.get(name)
+  if bot is None:
+    bot = loaded_bots[name] = load_bot(name)
+  return bot
+
+def play_game(bots, seeds, rng):
+  # Returns (winner, moves, forfeit) where winner is 0, 1 or None for a
+  # draw. A bot that returns an illegal move forfeits the game.
+  board = KalahBoard(seeds)
+  pits = board.pits
+  player = 0
+  moves = 0
+  while not board.finished():
+    pos = bots[player](board, player, rng)
+    if pos not in HOUSE_RANGES[player] or not pits[pos]:
+      return 1 - player, moves, True
+    moves += 1
+    if not board.sow(player, pos):
+      player = 1 - player
+  a_pts, b_pts = board.points()
+  if a_pts == b_pts:
+    return None, moves, False
+  return (0 if a_pts > b_pts else 1), moves, False
+
+def play_batch(job):
+  # Plays games between bots a and b, alternating which of them moves first
+  # starting from game number first, and returns the totals as a row.
+  round_num, a, b, games, first, seeds, seed = job
+  rng = random.Random('%s %s %s %s %d' % (seed, round_num, a, b, first))
+  bots = (get_bot(a), get_bot(b))
+  row = collections.OrderedDict([
+    ('round', round_num), ('a', a), ('b', b), ('games', games),
+    ('a_wins', 0), ('draws', 0), ('b_wins', 0), ('forfeits', 0),
+    ('moves', 0), ('seconds', 0.0),
+  ])
+  start = time.perf_counter()
+  for i in range(first, first + games):
+    swapped = i % 2
+    winner, moves, forfeit = play_game(bots[::-1] if swapped else bots,
+                                       seeds, rng)
+    row['moves'] += moves
+    row['forfeits'] += forfeit
+    if winner is None:
+      row['draws'] += 1
+    elif winner == swapped:
+      row['a_wins'] += 1
+    else:
+      row['b_wins'] += 1
+  row['seconds'] = round(time.perf_counter() - start, 6)
+  return row
+
+class ResultsFile:
+  # Streams result rows to a CSV file, or one JSON object per line.
+  def __init__(self, path, use_json=False):
+    self.file = open(path, 'w', newline='') if path else None
+    self.use_json = use_json
+    self.writer = None
+
+  def write(self, row):
+    if not self.file:
+      return
+    if self.use_json:
+      self.file.write(json.dumps(row) + '\n')
+    else:
+      if not self.writer:
+        self.writer = csv.DictWriter(self.file, list(row))
+        self.writer.writeheader()
+      self.writer.writerow(row)
+    self.file.flush()
+
+  def close(self):
+    if self.file:
+      self.file.close()
+
+class Tournament:
+  def __init__(self, names, games, seeds, seed, chunk, results):
+    self.names = names
+    self.games = games
+    self.seeds = seeds
+    self.seed = seed
+    self.chunk = chunk
+    self.results = results
+    self.rng = random.Random(seed)
+    self.scores = {name: collections.Counter() for name in names}
+    self.points = collections.Counter()
+    self.played = set()
+    self.byes = set()
+    self.total_games = 0
+    self.total_moves = 0
+
+  def jobs(self, round_num, pairs):
+    for a, b in pairs:
+      for first in range(0, self.games, self.chunk):
+        yield (round_num, a, b, min(self.chunk, self.games - first), first,
+               self.seeds, self.seed)
+
+  def run_round(self, executor, round_num, pairs):
+    # Plays every pairing for its games and returns the totals per pairing.
+    jobs = list(self.jobs(round_num, pairs))
+    if executor:
+      rows = (f.result() for f in concurrent.futures.as_completed(
+          [executor.submit(play_batch, job) for job in jobs]))
+    else:
+      rows = map(play_batch, jobs)
+    matches = collections.defaultdict(collections.Counter)
+    for row in rows:
+      self.results.write(row)
+      self.add_row(row)
+      matches[row['a'], row['b']].update(
+          {k: row[k] for k in ('a_wins', 'b_wins')})
+    return matches
+
+  def add_row(self, row):
+    a, b = self.scores[row['a']], self.scores[row['b']]
+    a.update(wins=row['a_wins'], draws=row['draws'], losses=row['b_wins'])
+    b.update(wins=row['b_wins'], draws=row['draws'], losses=row['a_wins'])
+    self.total_games += row['games']
+    self.total_moves += row['moves']
+
+  def round_robin(self, executor):
+    pairs = [(a, b) for i, a in enumerate(self.names)
+             for b in self.names[i + 1:]]
+    self.run_round(executor, 1, pairs)
+    for name, score in self.scores.items():
+      self.points[name] = score['wins'] + score['draws'] / 2
+
+  def swiss(self, executor, rounds):
+    # Match points: 1 for winning more of the games in a pairing than the
+    # opponent, a half for an even match, 1 for a bye.
+    for round_num in range(1, rounds + 1):
+      pairs, bye = self.swiss_pairs()
+      if bye:
+        self.byes.add(bye)
+        self.points[bye] += 1
+      matches = self.run_round(executor, round_num, pairs)
+      for (a, b), match in matches.items():
+        self.played.add(frozenset((a, b)))
+        if match['a_wins'] == match['b_wins']:
+          self.points[a] += 0.5
+          self.points[b] += 0.5
+        else:
+          self.points[a if match['a_wins'] > match['b_wins'] else b] += 1
+
+  def swiss_pairs(self):
+    # Pairs each bot, best first, with the next best it hasn't played yet
+    # (or the next best at all once it has played everyone). With an odd
+    # number of bots the lowest ranked one without a bye yet sits out.
+    order = sorted(self.names,
+                   key=lambda n: (-self.points[n], self.rng.random()))
+    bye = None
+    if len(order) % 2:
+      bye = next((n for n in reversed(order) if n not in self.byes),
+                 order[-1])
+      order.remove(bye)
+    pairs = []
+    while order:
+      a = order.pop(0)
+      b = next((n for n in order if frozenset((a, n)) not in self.played),
+               order[0])
+      order.remove(b)
+      pairs.append((a, b))
+    return pairs, bye
+
+  def standings(self):
+    lines = ['%-24s %8s %10s %10s %10s' % (
+        'BOT', 'POINTS', 'WINS', 'DRAWS', 'LOSSES')]
+    for name in sorted(self.names, key=lambda n: -self.points[n]):
+      score = self.scores[name]
+      lines.append('%-24s %8g %10d %10d %10d' % (
+          name, self.points[name], score['wins'], score['draws'],
+          score['losses']))
+    return lines
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-b', '--bots', dest='bots', default='random,greedy',
+                    help='Comma separated bots, by name or module:function')
+  parser.add_option('-f', '--format', dest='format', default='round-robin',
+                    choices=['round-robin', 'swiss'],
+                    help='round-robin or swiss')
+  parser.add_option('-r', '--rounds', dest='rounds', type='int', default=5,
+                    help='Rounds for a swiss tournament')
+  parser.add_option('-g', '--games', dest='games', type='int', default=1000,
+                    help='Games per pairing')
+  parser.add_option('-c', '--chunk', dest='chunk', type='int', default=1000,
+                    help='Games per batch handed to a worker')
+  parser.add_option('-s', '--seeds', dest='seeds', type='int', default=3,
+                    help='Seeds per house')
+  parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                    default=os.cpu_count(),
+                    help='Worker processes, 1 to play in this process')
+  parser.add_option('-o', '--output', dest='output',
+                    help='File to stream batch results to')
+  parser.add_option('--json', dest='json', action='store_true',
+                    help='Write JSON lines rather than CSV')
+  parser.add_option('--seed', dest='seed', type='int', default=3001,
+                    help='Random seed')
+  (options, args) = parser.parse_args()
+
+  names = options.bots.split(',')
+  if len(names) < 2 or len(set(names)) != len(names):
+    parser.error('Need at least two different bots')
+  for name in names:
+    try:
+      load_bot(name)
+    except (ImportError, AttributeError, ValueError) as e:
+      parser.error('Could not load bot %s: %s' % (name, e))
+
+  results = ResultsFile(options.output, options.json)
+  tournament = Tournament(names, options.games, options.seeds, options.seed,
+                          options.chunk, results)
+  executor = None
+  if options.jobs > 1:
+    executor = concurrent.futures.ProcessPoolExecutor(options.jobs)
+  start = time.perf_counter()
+  try:
+    if options.format == 'swiss':
+      tournament.swiss(executor, options.rounds)
+    else:
+      tournament.round_robin(executor)
+  finally:
+    if executor:
+      executor.shutdown()
+    results.close()
+  elapsed = time.perf_counter() - start
+
+  for line in tournament.standings():
+    print(line)
+  print('%d games, %d moves in %.2fs (%.0f games/hour)' % (
+      tournament.total_games, tournament.total_moves, elapsed,
+      tournament.total_games / elapsed * 3600), file=sys.stderr)
+
+if __name__ == '__main__':
+  main()